@@ -0,0 +1,376 @@
+import os
+import re
+import tempfile
+from collections import namedtuple
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+from dialect import to_duckdb, to_postgres
+from preflight import staging_columns
+from bulk_writer import parse_insert
+from local_ingest import EVENT_FIELDS, SONG_FIELDS
+from sql_queries import (staging_events_table_create, staging_songs_table_create, staging_events_insert,
+                         staging_songs_insert)
+
+try:
+    import duckdb
+except ImportError:
+    # only needed with BACKEND = duckdb
+    duckdb = None
+
+# 'redshift' - the cluster of the config file through psycopg2 (PostgreSQL works the same way)
+# 'duckdb'   - an embedded DuckDB database file, for development and CI without a cluster
+BACKENDS = ('redshift', 'duckdb')
+DEFAULT_DUCKDB_PATH = 'sparkify.duckdb'
+
+PARAM = re.compile(r'%\((\w+)\)s|%s|%%')
+DML = re.compile(r'^\s*(INSERT|UPDATE|DELETE|COPY)\b', re.IGNORECASE)
+COPY_STDIN = re.compile(r'COPY\s+(\w+)\s*(\([^)]*\))?\s+FROM\s+STDIN\s+WITH\s+CSV', re.IGNORECASE)
+
+# cursor.description entries as psycopg2 has them, type_code the PostgreSQL type OID
+Column = namedtuple('Column', 'name type_code display_size internal_size precision scale null_ok')
+PG_TYPE_OIDS = {'BOOLEAN': 16, 'BIGINT': 20, 'SMALLINT': 21, 'INTEGER': 23, 'FLOAT': 700, 'DOUBLE': 701,
+                'DECIMAL': 1700, 'DATE': 1082, 'TIMESTAMP': 1114, 'TIMESTAMP WITH TIME ZONE': 1184, 'VARCHAR': 25}
+
+# Staging column types -> DuckDB casts of the JSON fields; a value that does not cast is
+# loaded as NULL, like an empty string in a numeric column of a Redshift COPY
+DUCKDB_CASTS = {'int': 'INTEGER', 'float': 'DOUBLE', 'numeric': 'DOUBLE'}
+
+
+def backend_of(config):
+    backend = config.get('DWH', 'BACKEND', fallback='redshift').strip().lower()
+    if backend not in BACKENDS:
+        raise ValueError('Unknown backend {}, expected one of {}'.format(backend, BACKENDS))
+    return backend
+
+
+def duckdb_path(config):
+    return config.get('DWH', 'DUCKDB_PATH', fallback=DEFAULT_DUCKDB_PATH).strip()
+
+
+def to_qmark(query, vars):
+    """
+    Description:
+        psycopg2 placeholders to DuckDB: %s -> ?, %(name)s -> $name, %% -> %.
+    """
+    if vars is None:
+        return query
+    return PARAM.sub(lambda m: '$' + m.group(1) if m.group(1) else '?' if m.group(0) == '%s' else '%', query)
+
+
+def description(duckdb_description):
+    """
+    Description:
+        psycopg2 style cursor.description of a DuckDB result.  Column names are folded
+        to lower case, as PostgreSQL and Redshift return unquoted identifiers.
+    """
+    if not duckdb_description:
+        return None
+    return [Column(d[0].lower(), PG_TYPE_OIDS.get(str(d[1]).split('(')[0]), *d[2:])
+            for d in duckdb_description]
+
+
+class PostgresCursor(psycopg2.extensions.cursor):
+    """
+    Description:
+        psycopg2 cursor for a local PostgreSQL stand-in of the cluster: the Redshift DDL
+        of the statements is translated with dialect.to_postgres, e.g. the tables the
+        stages create themselves.  Connect with cursor_factory=PostgresCursor.
+    """
+
+    def execute(self, query, vars=None):
+        # statements built by psycopg2.extras (bytes, sql.Composed) are not DDL
+        if isinstance(query, str):
+            query = to_postgres(query)
+        return super().execute(query, vars)
+
+
+class DuckDBCursor:
+    """
+    Description:
+        psycopg2 style cursor over a DuckDBConnection.  Statements are translated with
+        dialect.to_duckdb, results are fetched when a statement runs so cursors of one
+        connection do not disturb each other, and DuckDB errors are raised as
+        psycopg2.DatabaseError so the ETL error handling applies unchanged.
+    """
+
+    def __init__(self, conn):
+        self.connection = conn
+        self.rows = []
+        self.pos = 0
+        self.rowcount = -1
+        self.description = None
+        self.itersize = 2000
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __iter__(self):
+        while self.pos < len(self.rows):
+            self.pos += 1
+            yield self.rows[self.pos - 1]
+
+    def run(self, call):
+        self.connection.begin_if_needed()
+        try:
+            return call(self.connection.db)
+        except duckdb.Error as e:
+            self.connection.failed = self.connection.in_transaction
+            raise psycopg2.DatabaseError(str(e)) from e
+
+    def execute(self, query, vars=None):
+        if isinstance(query, bytes):
+            query = query.decode('utf-8')
+        sql = to_qmark(to_duckdb(query), vars)
+        if isinstance(vars, dict):
+            # DuckDB rejects named parameters the statement does not use, psycopg2 ignores them
+            vars = {k: v for k, v in vars.items() if '$' + k in sql}
+        result = self.run(lambda db: db.execute(sql, vars) if vars is not None else db.execute(sql))
+        self.description = description(result.description)
+        self.rows, self.pos = result.fetchall(), 0
+        if DML.match(sql) and self.rows and self.description and len(self.description) == 1:
+            self.rowcount, self.rows, self.description = self.rows[0][0], [], None
+        else:
+            self.rowcount = len(self.rows)
+
+    def executemany(self, query, vars_list):
+        sql = to_qmark(to_duckdb(query), ())
+        vars_list = list(vars_list)
+        self.run(lambda db: db.executemany(sql, vars_list))
+        self.rows, self.pos, self.description, self.rowcount = [], 0, None, len(vars_list)
+
+    def execute_values(self, query, values):
+        """
+        Description:
+            psycopg2.extras.execute_values for bulk_writer.BulkWriter: the VALUES %s of
+            query becomes one row of placeholders, run with executemany.
+        """
+        values = list(values)
+        if values:
+            row = '({})'.format(', '.join(['%s'] * len(values[0])))
+            self.executemany(query.replace('VALUES %s', 'VALUES ' + row), values)
+
+    def copy_expert(self, sql, file, size=8192):
+        """
+        Description:
+            COPY ... FROM STDIN WITH CSV through a temporary file read by the DuckDB CSV reader.
+        """
+        match = COPY_STDIN.search(sql)
+        if match is None:
+            raise psycopg2.NotSupportedError('Only COPY ... FROM STDIN WITH CSV is supported: {}'.format(sql))
+        data = file.read()
+        with tempfile.NamedTemporaryFile('wb', suffix='.csv', delete=False) as f:
+            f.write(data.encode('utf-8') if isinstance(data, str) else data)
+        try:
+            self.execute("COPY {} {} FROM '{}' (FORMAT CSV, HEADER false)".format(
+                match.group(1), match.group(2) or '', f.name))
+        finally:
+            os.remove(f.name)
+
+    def fetchone(self):
+        if self.pos >= len(self.rows):
+            return None
+        self.pos += 1
+        return self.rows[self.pos - 1]
+
+    def fetchmany(self, size=None):
+        size = size or self.itersize
+        rows = self.rows[self.pos:self.pos + size]
+        self.pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.rows[self.pos:]
+        self.pos = len(self.rows)
+        return rows
+
+    def close(self):
+        self.closed = True
+        self.rows = []
+
+
+class DuckDBNamedCursor(DuckDBCursor):
+    """
+    Description:
+        Named (server-side) cursor: the query runs on its own DuckDB connection to the
+        database and rows are pulled from its streaming result as they are fetched, so
+        reading a large result in chunks keeps client memory bounded while the
+        connection of the cursor goes on writing.  Read only, and it sees the committed
+        data, not the uncommitted writes of its connection's transaction.
+    """
+
+    def __init__(self, conn):
+        super().__init__(conn)
+        self.stream = conn.db.cursor()
+        self.result = None
+
+    def execute(self, query, vars=None):
+        sql = to_qmark(to_duckdb(query), vars)
+        try:
+            self.result = self.stream.execute(sql, vars) if vars is not None else self.stream.execute(sql)
+        except duckdb.Error as e:
+            raise psycopg2.DatabaseError(str(e)) from e
+        self.description = description(self.result.description)
+        self.rowcount = -1
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany()
+            if not rows:
+                return
+            yield from rows
+
+    def fetchone(self):
+        return self.result.fetchone()
+
+    def fetchmany(self, size=None):
+        return self.result.fetchmany(size or self.itersize)
+
+    def fetchall(self):
+        return self.result.fetchall()
+
+    def close(self):
+        if not self.closed:
+            self.result = None
+            self.stream.close()
+        super().close()
+
+
+class DuckDBConnection:
+    """
+    Description:
+        psycopg2 style connection over a DuckDB connection: autocommit, commit /
+        rollback, transaction status and set_session, as used by the ETL.
+
+    Arguments:
+        db - duckdb connection
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.autocommit = False
+        self.in_transaction = False
+        self.failed = False
+        self.closed = 0
+
+    def cursor(self, name=None):
+        return DuckDBNamedCursor(self) if name else DuckDBCursor(self)
+
+    def set_session(self, autocommit=None, **kwargs):
+        if autocommit is not None:
+            self.autocommit = autocommit
+
+    def begin_if_needed(self):
+        if not self.autocommit and not self.in_transaction:
+            self.db.execute('BEGIN TRANSACTION')
+            self.in_transaction, self.failed = True, False
+
+    def commit(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            try:
+                self.db.execute('ROLLBACK' if self.failed else 'COMMIT')
+            except duckdb.Error as e:
+                raise psycopg2.DatabaseError(str(e)) from e
+
+    def rollback(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self.db.execute('ROLLBACK')
+
+    def get_transaction_status(self):
+        if not self.in_transaction:
+            return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        if self.failed:
+            return psycopg2.extensions.TRANSACTION_STATUS_INERROR
+        return psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+    def close(self):
+        if not self.closed:
+            self.rollback()
+            self.db.close()
+            self.closed = 1
+
+
+def connect_duckdb(path=DEFAULT_DUCKDB_PATH):
+    """
+    Returns:
+        cur, conn - autocommit cursor and connection on the DuckDB database file
+    """
+    if duckdb is None:
+        raise ImportError('BACKEND = duckdb needs the duckdb package')
+    conn = DuckDBConnection(duckdb.connect(path))
+    conn.set_session(autocommit=True)
+    return conn.cursor(), conn
+
+
+class DuckDBPool:
+    """
+    Description:
+        create_tables.DWHConnectionPool for the DuckDB backend: every checkout is a new
+        connection to the same database, so stages can run in their own threads.
+    """
+
+    def __init__(self, path=DEFAULT_DUCKDB_PATH):
+        if duckdb is None:
+            raise ImportError('BACKEND = duckdb needs the duckdb package')
+        self.db = duckdb.connect(path)
+
+    def acquire(self):
+        conn = DuckDBConnection(self.db.cursor())
+        conn.set_session(autocommit=True)
+        return conn.cursor(), conn
+
+    def release(self, cur, conn):
+        cur.close()
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        cur, conn = self.acquire()
+        try:
+            yield cur, conn
+        finally:
+            self.release(cur, conn)
+
+    def closeall(self):
+        self.db.close()
+
+
+def read_json_insert(insert_sql, table_create, fields, path):
+    """
+    Description:
+        INSERT ... SELECT of the staging columns of insert_sql from the JSON files under
+        path with DuckDB's vectorized JSON reader.  Every field is read as text and cast
+        to the type of its staging column.
+    """
+    table, columns = parse_insert(insert_sql)
+    types = staging_columns(table_create)
+    casts = ['TRY_CAST("{}" AS {})'.format(field, DUCKDB_CASTS.get(types[column.lower()][0], 'VARCHAR'))
+             for column, field in zip(columns, fields)]
+    reader = "read_json('{}', format='auto', columns={{{}}})".format(
+        os.path.join(path, '**', '*.json'), ', '.join("'{}': 'VARCHAR'".format(f) for f in fields))
+    return 'INSERT INTO {} ({}) SELECT {} FROM {}'.format(table, ', '.join(columns), ', '.join(casts), reader)
+
+
+def load_json_staging(cur, song_dir, log_dir):
+    """
+    Description:
+        Load local song_data / log_data JSON into staging_songs / staging_events on the
+        DuckDB backend, the equivalent of the S3 COPYs.
+
+    Returns:
+        dict of staging table -> rows loaded
+    """
+    rows = {}
+    for insert_sql, table_create, fields, path in [
+            (staging_songs_insert, staging_songs_table_create, SONG_FIELDS, song_dir),
+            (staging_events_insert, staging_events_table_create, EVENT_FIELDS, log_dir)]:
+        cur.execute(read_json_insert(insert_sql, table_create, fields, path))
+        rows[parse_insert(insert_sql)[0]] = cur.rowcount
+    return rows
@@ -0,0 +1,14 @@
+import random
+
+
+def backoff_delays(base, cap, rng=random):
+    """
+    Description:
+        Endless exponential backoff delays with full jitter: uniform(0, min(cap, base * 2**n)).
+        Shared by the cluster readiness polling (create_DWH.py) and the window retries
+        of the load (staging_windows.py).
+    """
+    attempt = 0
+    while True:
+        yield rng.uniform(0, min(cap, base * 2 ** attempt))
+        attempt += 1
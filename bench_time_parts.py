@@ -0,0 +1,49 @@
+import sys
+import time
+import datetime as dt
+import numpy as np
+
+from time_dim import time_parts
+
+
+def per_row_time_parts(ts_values):
+    """
+    Description:
+        The original per-row loop from insert_time_table, kept here as the baseline.
+        Uses UTC so both sides compute the same values.
+    """
+    rows = []
+    for ts in ts_values:
+        dts = dt.datetime.utcfromtimestamp(int(ts)/1000.0)
+        rows.append((dts.isoformat(), dts.hour, dts.day, dts.isocalendar()[1], dts.month, dts.year, dts.weekday()))
+    return rows
+
+
+def main(n=1000000):
+    """
+    Description:
+        Micro-benchmark of the vectorized time_parts against the per-row loop.
+
+    Arguments:
+        n - number of epoch-ms timestamps to convert (default 1M)
+    """
+    rng = np.random.default_rng(0)
+    # Nov 2018, the range of the Sparkify event log
+    ts_values = rng.integers(1541030400000, 1543622400000, size=n, dtype='int64')
+
+    start = time.perf_counter()
+    per_row_time_parts(ts_values)
+    per_row = time.perf_counter() - start
+
+    start = time.perf_counter()
+    time_parts(ts_values)
+    vectorized = time.perf_counter() - start
+
+    print('timestamps:  {}'.format(n))
+    print('per-row:     {:.3f}s ({:.0f} ts/sec)'.format(per_row, n / per_row))
+    print('vectorized:  {:.3f}s ({:.0f} ts/sec)'.format(vectorized, n / vectorized))
+    print('speedup:     {:.1f}x'.format(per_row / vectorized))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
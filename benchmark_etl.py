@@ -0,0 +1,193 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import tracemalloc
+import datetime as dt
+import psycopg2
+
+from sql_queries import *
+from create_tables import run_queries
+from dialect import to_postgres
+from generate_data import generate
+from local_ingest import load_local_staging
+from backends import PostgresCursor
+import etl
+
+DEFAULT_SCALES = [10000, 100000, 1000000]
+DEFAULT_OUTPUT = 'bench_results.json'
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def reset_peak_rss():
+    """
+    Description:
+        Reset the peak resident set size of the process (Linux, /proc/self/clear_refs),
+        so the next peak_rss_kb() is the peak of one stage.
+
+    Returns:
+        False where the peak cannot be reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_kb():
+    """
+    Returns:
+        peak resident set size in KB since the last reset_peak_rss()
+    """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+
+
+def count_rows(cur, tables):
+    total = 0
+    for table in tables:
+        cur.execute('SELECT COUNT(*) FROM {}'.format(table))
+        total += cur.fetchone()[0]
+    return total
+
+
+def create_local_tables(cur, conn):
+    """
+    Description:
+        drop_tables / create_tables with the Redshift DDL translated for PostgreSQL.
+    """
+    run_queries(cur, conn, drop_staging_table_queries + drop_table_queries + drop_control_table_queries
+                + drop_aggregate_table_queries + drop_quarantine_table_queries)
+    run_queries(cur, conn, [to_postgres(q) for q in create_staging_table_queries + create_table_queries
+                            + create_control_table_queries + create_aggregate_table_queries
+                            + create_quarantine_table_queries])
+
+
+def bench_stages(data_dir, mode, bulk_options, ingest_workers=None):
+    """
+    Description:
+        The stages of etl.main, in order, as (name, function(cur, conn), tables written).
+        Staging is loaded from the local JSON files instead of S3.
+    """
+    def staging(cur, conn):
+        load_local_staging(cur, conn, os.path.join(data_dir, 'song_data'), os.path.join(data_dir, 'log_data'),
+                           ingest_workers, **bulk_options)
+        etl.build_match_keys(cur, conn)
+
+    return [('create',   create_local_tables, []),
+            ('staging',  staging, ['staging_events', 'staging_songs']),
+            ('validate', etl.validate_staging, ['quarantine_staging_events', 'quarantine_staging_songs']),
+            ('artists',  lambda cur, conn: etl.insert_artists_table(cur, conn, mode, **bulk_options), ['artists']),
+            ('users',    lambda cur, conn: etl.insert_users_table(cur, conn, mode, **bulk_options), ['users']),
+            ('time',     lambda cur, conn: etl.insert_time_table(cur, conn, mode, **bulk_options), ['time']),
+            ('songs',    lambda cur, conn: etl.insert_songs_table(cur, conn, mode, **bulk_options), ['songs']),
+            ('songplay', lambda cur, conn: etl.insert_songplay_table(cur, conn, mode, **bulk_options), ['songplay']),
+            ('aggregates', etl.refresh_aggregates, ['agg_daily_plays', 'agg_daily_song_plays', 'agg_daily_artist_plays',
+                                                    'agg_daily_level_plays', 'agg_hourly_plays'])]
+
+
+def run_benchmark(dsn, data_dir, events, mode='sql', trace_memory=False, ingest_workers=None, **bulk_options):
+    """
+    Description:
+        Run each stage of the ETL against a local PostgreSQL database and measure it.
+
+    Arguments:
+        dsn - libpq connection string of the local PostgreSQL stand-in
+        data_dir - generated source tree (see generate_data.py)
+        events - number of events in the source tree, recorded with the results
+        mode - etl transform mode
+        trace_memory - also record the python heap peak of each stage with tracemalloc (slower)
+        ingest_workers - processes parsing the local JSON sources (bulk method 'copy')
+        bulk_options - batch_size / method passed to BulkWriter
+
+    Returns:
+        list of per-stage result dicts; peak_rss_kb is the peak resident set size of the
+        stage, or where it cannot be reset per stage, process_max_rss_kb the peak of the
+        process so far
+    """
+    conn = psycopg2.connect(dsn, cursor_factory=PostgresCursor)
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+
+    results = []
+    try:
+        for name, func, tables in bench_stages(data_dir, mode, bulk_options, ingest_workers):
+            if trace_memory:
+                tracemalloc.start()
+            rss_per_stage = reset_peak_rss()
+            start = time.perf_counter()
+            func(cur, conn)
+            elapsed = time.perf_counter() - start
+
+            rows = count_rows(cur, tables)
+            result = {'events': events, 'mode': mode, 'stage': name, 'seconds': round(elapsed, 4),
+                      'rows': rows, 'rows_per_sec': round(rows / elapsed, 1) if elapsed > 0 else None}
+            if rss_per_stage:
+                result['peak_rss_kb'] = peak_rss_kb()
+            else:
+                result['process_max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if trace_memory:
+                result['heap_peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+                tracemalloc.stop()
+
+            print('{events:>9} {stage:<9} {seconds:9.3f}s {rows:>10} rows {rows_per_sec} rows/sec'.format(**result))
+            results.append(result)
+    finally:
+        cur.close()
+        conn.close()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end ETL benchmark against a local PostgreSQL')
+    parser.add_argument('--dsn', default=os.environ.get('SPARKIFY_BENCH_DSN', 'dbname=sparkify_bench'),
+                        help='local PostgreSQL connection string (env SPARKIFY_BENCH_DSN)')
+    parser.add_argument('--events', type=int, nargs='+', default=DEFAULT_SCALES,
+                        help='event counts to benchmark, e.g. 10000 100000 10000000')
+    parser.add_argument('--data-dir', default='bench_data', help='where generated sources are cached')
+    parser.add_argument('--mode', choices=etl.TRANSFORM_MODES, default='sql')
+    parser.add_argument('--batch-size', type=int, default=etl.DEFAULT_BATCH_SIZE)
+    parser.add_argument('--bulk-method', choices=etl.BULK_METHODS, default='copy')
+    parser.add_argument('--ingest-workers', type=int, help='processes parsing the JSON sources, default one per core')
+    parser.add_argument('--trace-memory', action='store_true')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='results are appended to this JSON file')
+    args = parser.parse_args()
+
+    run = {'commit': git_commit(), 'started': dt.datetime.utcnow().isoformat(), 'python': sys.version.split()[0],
+           'mode': args.mode, 'batch_size': args.batch_size, 'bulk_method': args.bulk_method,
+           'ingest_workers': args.ingest_workers or os.cpu_count(), 'results': []}
+
+    for events in args.events:
+        data_dir = os.path.join(args.data_dir, str(events))
+        if not os.path.isdir(data_dir):
+            print('Generating {} events into {}'.format(events, data_dir))
+            generate(data_dir, events, songs_per_file=100)
+        run['results'].extend(run_benchmark(args.dsn, data_dir, events, args.mode, args.trace_memory,
+                                            args.ingest_workers, batch_size=args.batch_size, method=args.bulk_method))
+
+    runs = []
+    if os.path.exists(args.output):
+        with open(args.output) as f:
+            runs = json.load(f)
+    runs.append(run)
+    with open(args.output, 'w') as f:
+        json.dump(runs, f, indent=2)
+    print('Results appended to {}'.format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import io
+import re
+import math
+import time
+import psycopg2.extras
+from unit_of_work import savepoint
+
+DEFAULT_BATCH_SIZE = 5000
+# 'values' - multi-row INSERT ... VALUES (works on Redshift and PostgreSQL)
+# 'copy'   - COPY ... FROM STDIN from an in-memory CSV buffer (PostgreSQL only,
+#            Redshift COPY cannot read from STDIN)
+BULK_METHODS = ('values', 'copy')
+
+# Rejected rows printed when a writer is closed
+MAX_REPORTED_REJECTS = 5
+
+INSERT_PATTERN = re.compile(r'INSERT\s+INTO\s+(\w+)\s*\(([^)]*)\)', re.IGNORECASE | re.DOTALL)
+
+
+def parse_insert(insert_sql):
+    """
+    Description:
+        Extract target table and column order from one of the INSERT statements
+        defined in sql_queries.py, so they remain the single source of column order.
+
+    Arguments:
+        insert_sql - INSERT INTO table (col, ...) VALUES (...) statement
+
+    Returns:
+        table   - name of the target table
+        columns - list of column names in insert order
+    """
+    match = INSERT_PATTERN.search(insert_sql)
+    if match is None:
+        raise ValueError('Not an INSERT INTO table (columns) statement: {}'.format(insert_sql))
+
+    columns = [c.strip() for c in match.group(2).split(',') if c.strip()]
+    return match.group(1), columns
+
+
+def to_python(value):
+    """
+    Description:
+        Convert numpy / pandas scalars to plain python values psycopg2 can adapt,
+        mapping NaN and NaT to None.
+    """
+    if value is None:
+        return None
+    if hasattr(value, 'item') and not isinstance(value, (str, bytes)):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if type(value).__name__ == 'NaTType':
+        return None
+    return value
+
+
+def csv_field(value):
+    """
+    Description:
+        Render one value for COPY ... CSV.  NULL is an unquoted empty field,
+        every other value is quoted so an empty string stays an empty string.
+    """
+    value = to_python(value)
+    if value is None:
+        return ''
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+class BulkWriter:
+    """
+    Description:
+        Accumulates rows for one target table and flushes them in batches, either
+        with multi-row INSERT ... VALUES or COPY ... FROM STDIN.  Reports rows/sec
+        for the table when closed.
+
+        With isolate_errors inside a transaction (see unit_of_work.py) every batch runs
+        under a savepoint.  A failing batch is rolled back to it and bisected until the
+        offending rows are found; those are kept in rejected and the rest is written.
+        Needs SAVEPOINT, so PostgreSQL only.
+
+    Arguments:
+        cur        - cursor of the database connection
+        insert_sql - INSERT statement from sql_queries.py defining table and column order
+        batch_size - number of rows per flush
+        method     - one of BULK_METHODS
+        isolate_errors - bisect failing batches down to the bad rows instead of failing
+    """
+
+    def __init__(self, cur, insert_sql, batch_size=DEFAULT_BATCH_SIZE, method='values', isolate_errors=False):
+        if method not in BULK_METHODS:
+            raise ValueError('Unknown bulk method {}, expected one of {}'.format(method, BULK_METHODS))
+
+        self.cur = cur
+        self.table, self.columns = parse_insert(insert_sql)
+        self.batch_size = batch_size
+        self.method = method
+        self.isolate_errors = isolate_errors
+        self.rows = []
+        self.rejected = []
+        self.row_count = 0
+        self.batch_count = 0
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+        column_list = ', '.join(self.columns)
+        self.values_sql = 'INSERT INTO {} ({}) VALUES %s'.format(self.table, column_list)
+        self.copy_sql = 'COPY {} ({}) FROM STDIN WITH CSV'.format(self.table, column_list)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        return False
+
+    def write(self, row):
+        if len(row) != len(self.columns):
+            raise ValueError('{} expects {} columns, got {}'.format(self.table, len(self.columns), len(row)))
+
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def write_many(self, rows):
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        if not self.rows:
+            return
+
+        batch, self.rows = self.rows, []
+        if self.isolate_errors and not self.cur.connection.autocommit:
+            self.insert_isolated(batch)
+        else:
+            self.insert(batch)
+            self.row_count += len(batch)
+        self.batch_count += 1
+
+    def insert(self, batch):
+        if self.method == 'copy':
+            buf = io.StringIO()
+            for row in batch:
+                buf.write(','.join(csv_field(v) for v in row))
+                buf.write('\n')
+            buf.seek(0)
+            self.cur.copy_expert(self.copy_sql, buf)
+        else:
+            values = [tuple(to_python(v) for v in row) for row in batch]
+            if hasattr(self.cur, 'execute_values'):
+                # backends.DuckDBCursor: no libpq, the cursor binds the rows itself
+                self.cur.execute_values(self.values_sql, values)
+            else:
+                psycopg2.extras.execute_values(self.cur, self.values_sql, values, page_size=len(values))
+
+    def insert_isolated(self, batch):
+        """
+        Description:
+            Insert batch under a savepoint, bisecting it on failure.  A bad row costs
+            about 2 * log2(batch_size) extra statements.
+        """
+        try:
+            with savepoint(self.cur, 'bulk_writer'):
+                self.insert(batch)
+            self.row_count += len(batch)
+        except psycopg2.Error as e:
+            if len(batch) == 1:
+                self.rejected.append((batch[0], str(e).strip()))
+                return
+            middle = len(batch) // 2
+            self.insert_isolated(batch[:middle])
+            self.insert_isolated(batch[middle:])
+
+    def close(self):
+        self.flush()
+        self.elapsed = time.perf_counter() - self.started
+        print('{}: {} rows in {} batches, {:.2f}s ({:.0f} rows/sec)'.format(
+            self.table, self.row_count, self.batch_count, self.elapsed, self.rows_per_sec()))
+        if self.rejected:
+            print('{}: {} rows rejected'.format(self.table, len(self.rejected)))
+            for row, error in self.rejected[:MAX_REPORTED_REJECTS]:
+                print('    {!r}: {}'.format(row, error.splitlines()[0]))
+
+    def rows_per_sec(self):
+        return self.row_count / self.elapsed if self.elapsed > 0 else 0.0
@@ -0,0 +1,161 @@
+import os
+import json
+import hashlib
+import inspect
+import threading
+import functools
+import datetime as dt
+from scheduler import check_graph
+
+DEFAULT_CHECKPOINT_FILE = 'etl_checkpoint.json'
+
+# Values taken into a stage fingerprint as they are; anything else by type only
+PLAIN_TYPES = (str, int, float, bool, type(None))
+
+
+def fingerprint(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+def plain(value):
+    if isinstance(value, PLAIN_TYPES):
+        return value
+    if isinstance(value, dt.date):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)):
+        return [plain(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): plain(v) for k, v in value.items()}
+    return type(value).__name__
+
+
+def function_inputs(func):
+    """
+    Description:
+        What a stage function does: the source of the underlying function, unwrapped from
+        partials and decorators in any nesting (e.g. atomic(partial(...))), and the
+        arguments bound by partials.  Connections, configs and other objects count by
+        type only, so the fingerprint is stable across runs.
+    """
+    args, keywords = (), {}
+    while True:
+        if isinstance(func, functools.partial):
+            args, keywords = func.args + args, dict(func.keywords, **keywords)
+            func = func.func
+        elif hasattr(func, '__wrapped__'):
+            func = func.__wrapped__
+        else:
+            break
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        # never the repr, it holds the address of the object
+        source = getattr(func, '__qualname__', type(func).__name__)
+    return [source, plain(args), plain(keywords)]
+
+
+def stage_fingerprints(stages, run_inputs):
+    """
+    Description:
+        Fingerprint of every stage from its own inputs (function_inputs), the inputs of
+        the run and the fingerprints of its dependencies, so a change invalidates the
+        stage and everything downstream of it.
+
+    Returns:
+        dict of stage name -> fingerprint
+    """
+    by_name = check_graph(stages)
+    memo = {}
+
+    def visit(name):
+        if name not in memo:
+            stage = by_name[name]
+            memo[name] = fingerprint(name, run_inputs, function_inputs(stage.func),
+                                     sorted(visit(d) for d in stage.deps))
+        return memo[name]
+
+    for name in by_name:
+        visit(name)
+    return memo
+
+
+class Checkpoint:
+    """
+    Description:
+        Completed steps of an ETL run, kept in a local JSON file so a failed run can be
+        resumed.  Each step is recorded with the fingerprint of its inputs when it
+        finishes; a resumed run skips the steps whose fingerprint still matches.
+
+    Arguments:
+        path - JSON checkpoint file
+    """
+
+    def __init__(self, path=DEFAULT_CHECKPOINT_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {'run': {}, 'steps': {}, 'completed': False}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    @property
+    def run(self):
+        return self.state['run']
+
+    def resumable(self):
+        return bool(self.state['run']) and not self.state['completed']
+
+    def start(self, **run):
+        """
+        Description:
+            Start a new run, forgetting the steps of the previous one.
+        """
+        with self.lock:
+            self.state = {'run': dict(run, started=dt.datetime.utcnow().isoformat()), 'steps': {}, 'completed': False}
+            self.save()
+
+    def done(self, name, step_fingerprint):
+        with self.lock:
+            step = self.state['steps'].get(name)
+        return step is not None and step['fingerprint'] == step_fingerprint
+
+    def record(self, name, step_fingerprint):
+        with self.lock:
+            self.state['steps'][name] = {'fingerprint': step_fingerprint,
+                                         'finished': dt.datetime.utcnow().isoformat()}
+            self.save()
+
+    def complete(self):
+        with self.lock:
+            self.state['completed'] = True
+            self.save()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def step(self, name, step_fingerprint, func, *args, **kwargs):
+        """
+        Description:
+            Run func unless step name already completed with the same fingerprint, and
+            record it when it returns.
+        """
+        if self.done(name, step_fingerprint):
+            print('skip  step {} (checkpoint {})'.format(name, step_fingerprint))
+            return None
+        result = func(*args, **kwargs)
+        self.record(name, step_fingerprint)
+        return result
+
+    def wrap_stages(self, stages, run_inputs):
+        """
+        Description:
+            Make every scheduler.Stage skip itself when completed with the same
+            fingerprint and record itself when it succeeds.
+        """
+        fingerprints = stage_fingerprints(stages, run_inputs)
+        for stage in stages:
+            stage.func = functools.partial(self.step, stage.name, fingerprints[stage.name], stage.func)
+        return stages
@@ -1,6 +1,19 @@
+import time
+import argparse
+import random
+import socket
 import configparser
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import boto3
+from botocore.exceptions import ClientError
+from backoff import backoff_delays
+
+# Readiness polling: exponential backoff with full jitter, delays in seconds
+POLL_BASE_DELAY = 5
+POLL_MAX_DELAY = 60
+READY_TIMEOUT = 30 * 60
+CONNECT_TIMEOUT = 3
 
 def prettyRedshiftProps(props):
     """
@@ -151,22 +164,182 @@ def open_DWH_Port (newClusterProps, AWS_DWH_ConfigFile):
     except Exception as e:
         print(e)
 
-def main():
-    
-    #  We can put the config as an input parameter.
-    AWS_DWH_ConfigFile = 'dwh_sp.cfg'
+def aws_clients (config, region_name='us-west-2'):
+    """
+    Description: 
+        boto3 clients used by provision_DWH, created from the [AWS] credentials.
+
+    Returns:  
+        dict of 'redshift', 'iam' and 'ec2' clients
+    """
+    credentials = {'aws_access_key_id': config.get('AWS', 'KEY'), 'aws_secret_access_key': config.get('AWS', 'SECRET'),
+                   'region_name': region_name}
+    return {name: boto3.client(name, **credentials) for name in ('redshift', 'iam', 'ec2')}
+
+
+def wait_until (check, timeout=READY_TIMEOUT, base=POLL_BASE_DELAY, cap=POLL_MAX_DELAY,
+                sleep=time.sleep, clock=time.monotonic, rng=random):
+    """
+    Description: 
+        Call check() with backoff between the attempts until it returns a truthy value.
+
+    Arguments:  
+        check - callable polled for readiness
+        timeout - seconds before giving up
+        base, cap - backoff delays, see backoff_delays
+        sleep, clock, rng - injectable for tests
+
+    Returns:  
+        the first truthy result of check()
+    """
+    deadline = clock() + timeout
+    for delay in backoff_delays(base, cap, rng):
+        result = check()
+        if result:
+            return result
+        if clock() + delay > deadline:
+            raise TimeoutError('Not ready after {} seconds'.format(timeout))
+        sleep(delay)
+
+
+def lookup_role_arn (iam, role_name):
+    return iam.get_role(RoleName=role_name)['Role']['Arn']
+
+
+def create_cluster (redshift, config, role_arn):
+    """
+    Description: 
+        Request the cluster defined in [DWH].  An existing cluster with the same
+        identifier is reused.
+
+    Returns:  
+        True if a new cluster was requested, False if it already existed
+    """
+    try:
+        redshift.create_cluster(ClusterType=config.get("DWH", "DWH_CLUSTER_TYPE"),
+                                NodeType=config.get("DWH", "DWH_NODE_TYPE"),
+                                NumberOfNodes=int(config.get("DWH", "DWH_NUM_NODES")),
+                                DBName=config.get("DWH", "DWH_DB"),
+                                ClusterIdentifier=config.get("DWH", "DWH_CLUSTER_IDENTIFIER"),
+                                MasterUsername=config.get("DWH", "DWH_DB_USER"),
+                                MasterUserPassword=config.get("DWH", "DWH_DB_PASSWORD"),
+                                IamRoles=[role_arn])
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ClusterAlreadyExists':
+            raise
+        return False
+
+
+def open_ingress (ec2, port, vpc_id=None):
+    """
+    Description: 
+        Allow incoming TCP on port in the default security group of vpc_id, or of the
+        default VPC where create_cluster places the cluster.  An existing rule is kept.
+
+    Returns:  
+        id of the security group
+    """
+    if vpc_id is None:
+        vpc_id = ec2.describe_vpcs(Filters=[{'Name': 'isDefault', 'Values': ['true']}])['Vpcs'][0]['VpcId']
+    group = ec2.describe_security_groups(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]},
+                                                  {'Name': 'group-name', 'Values': ['default']}])['SecurityGroups'][0]
+    try:
+        ec2.authorize_security_group_ingress(GroupId=group['GroupId'], IpProtocol='tcp', CidrIp='0.0.0.0/0',
+                                             FromPort=int(port), ToPort=int(port))
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidPermission.Duplicate':
+            raise
+    return group['GroupId']
+
+
+def cluster_available (redshift, cluster_id):
+    """
+    Returns:  
+        the cluster properties once it is available with an endpoint, else None
+    """
+    props = redshift.describe_clusters(ClusterIdentifier=cluster_id)['Clusters'][0]
+    if props.get('ClusterStatus') == 'available' and props.get('Endpoint'):
+        return props
+    return None
+
+
+def endpoint_reachable (host, port, timeout=CONNECT_TIMEOUT):
+    try:
+        with socket.create_connection((host, int(port)), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def provision_DWH (AWS_DWH_ConfigFile, clients=None, probe=endpoint_reachable, timeout=READY_TIMEOUT,
+                   sleep=time.sleep, clock=time.monotonic, rng=random):
+    """
+    Description: 
+        Provision the cluster defined in the config and wait until it accepts connections.
+        The security group ingress runs concurrently with the IAM role lookup, the cluster
+        creation and the readiness polling; readiness is polled with exponential backoff
+        and jitter, first for the 'available' status, then for a TCP connection.
 
+    Arguments:  
+        AWS_DWH_ConfigFile - Config for the Redshift cluster.
+        clients - dict of boto3 'redshift', 'iam' and 'ec2' clients (stubbed in tests),
+                  None to create them from the config
+        probe - callable (host, port) -> bool checking that the endpoint is connectable
+        timeout - seconds to wait for each of the two readiness checks
+        sleep, clock, rng - injectable for tests
+
+    Returns:  
+        dict with cluster_id, endpoint, port, role_arn, security_group, props and
+        timings (seconds per step and total time-to-ready)
+    """
     config = configparser.ConfigParser()
     config.read(AWS_DWH_ConfigFile)
+    clients = clients or aws_clients(config)
+    cluster_id = config.get("DWH", "DWH_CLUSTER_IDENTIFIER")
+
+    timings = {}
+    start = clock()
+
+    def timed(name, func, *args):
+        t = clock()
+        try:
+            return func(*args)
+        finally:
+            timings[name] = round(clock() - t, 3)
+
+    def poll(check):
+        return wait_until(check, timeout, sleep=sleep, clock=clock, rng=rng)
 
-    DWH_PORT               = config.get("DWH","DWH_PORT")
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        ingress = pool.submit(timed, 'ingress', open_ingress, clients['ec2'], config.get("DWH", "DWH_PORT"))
+        role_arn = timed('role', lookup_role_arn, clients['iam'], config.get("DWH", "DWH_IAM_ROLE_NAME"))
+        created = timed('create', create_cluster, clients['redshift'], config, role_arn)
+        print('Cluster {} {}, waiting until available'.format(cluster_id, 'requested' if created else 'exists'))
+        props = timed('available', poll, lambda: cluster_available(clients['redshift'], cluster_id))
+        security_group = ingress.result()
 
-    CLUSTER_IDENTIFIER = start_DWH(AWS_DWH_ConfigFile)
-    #  This program should have the option to add to the config 
-    newClusterProp = get_DWH_Info (CLUSTER_IDENTIFIER, AWS_DWH_ConfigFile) 
+    endpoint, port = props['Endpoint']['Address'], props['Endpoint']['Port']
+    timed('connectable', poll, lambda: probe(endpoint, port))
+    timings['total'] = round(clock() - start, 3)
+
+    print('Cluster {} ready at {}:{} after {}s {}'.format(cluster_id, endpoint, port, timings['total'], timings))
+    return {'cluster_id': cluster_id, 'endpoint': endpoint, 'port': port, 'role_arn': role_arn,
+            'security_group': security_group, 'props': props, 'timings': timings}
+
+
+def main():
+    """
+    Description: 
+        Provision the cluster and wait until its endpoint is connectable.
+    """
+    parser = argparse.ArgumentParser(description='Provision the Sparkify Redshift cluster')
+    parser.add_argument('--config', default='dwh-sp.cfg', help='DWH config file')
+    parser.add_argument('--timeout', type=int, default=READY_TIMEOUT, help='seconds to wait for the cluster')
+    args = parser.parse_args()
 
-    open_DWH_Port (newClusterProp, AWS_DWH_ConfigFile)
+    provision_DWH(args.config, timeout=args.timeout)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,9 +1,16 @@
 import configparser
+import threading
+import time
+from contextlib import contextmanager
 import psycopg2
+import psycopg2.pool
 import pandas as pd
 from sql_queries import *
 import boto3
+from instrumentation import instrumented
+from backends import backend_of, duckdb_path, connect_duckdb, DuckDBPool
 
+@instrumented('run_queries')
 def run_queries (cur, conn, queries):
     """
     Description: 
@@ -39,9 +46,12 @@ def drop_tables(cur, conn):
     """   
     run_queries (cur, conn, drop_staging_table_queries)
     run_queries (cur, conn, drop_table_queries)
+    run_queries (cur, conn, drop_control_table_queries)
+    run_queries (cur, conn, drop_aggregate_table_queries)
+    run_queries (cur, conn, drop_quarantine_table_queries)
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, table_queries=None):
     """
     Description: 
         Drop all Tables as defined in global variable drop_table_queries
@@ -49,32 +59,83 @@ def create_tables(cur, conn):
     Arguments:  
         cur - cursor of the database connection
         conn - connection to the target database
+        table_queries - star schema DDL replacing create_table_queries, e.g. from ddl_advisor.py
 
     Returns:  
         None
     """   
     run_queries (cur, conn, create_staging_table_queries)
-    run_queries (cur, conn, create_table_queries)
+    run_queries (cur, conn, table_queries or create_table_queries)
+    run_queries (cur, conn, create_control_table_queries)
+    run_queries (cur, conn, create_aggregate_table_queries)
+    run_queries (cur, conn, create_quarantine_table_queries)
 
 
 
 
 # -- Set up DWH & DB connections
 
-def connect_DWH_db (AWS_DWH_ConfigFile, CLUSTER_ID='Default'):
+# Resolved cluster endpoints: CLUSTER_ID -> (expires_at, endpoint address)
+ENDPOINT_CACHE_TTL = 300
+_endpoint_cache = {}
+_endpoint_lock = threading.Lock()
+
+
+def resolve_DWH_endpoint (config, CLUSTER_ID, redshift=None, ttl=ENDPOINT_CACHE_TTL):
     """
     Description: 
-        Connects to an existing AWS Redshift cluster that is already started using
-        the config in the file AWH_DWH_ConfigFile.
+        Resolve the endpoint address of a Redshift cluster with describe_clusters.
+        The result is cached for ttl seconds so repeated callers reuse the host.
+
+    Arguments:  
+        config - ConfigParser of the DWH config file
+        CLUSTER_ID - Identifier of a running AWS Redshift cluster
+        redshift - optional boto3 Redshift client (a stub in tests)
+        ttl - seconds a resolved endpoint stays valid
+
+    Returns:  
+        endpoint address of the cluster
+    """
+    now = time.monotonic()
+    with _endpoint_lock:
+        cached = _endpoint_cache.get(CLUSTER_ID)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+    if redshift is None:
+        redshift = boto3.client('redshift',
+                               region_name="us-west-2",
+                               aws_access_key_id=config.get('AWS','KEY'),
+                               aws_secret_access_key=config.get('AWS','SECRET')
+                               )
+
+    myClusterProps = redshift.describe_clusters(ClusterIdentifier=CLUSTER_ID)['Clusters'][0]
+    DWH_ENDPOINT = myClusterProps['Endpoint']['Address']
+
+    with _endpoint_lock:
+        _endpoint_cache[CLUSTER_ID] = (now + ttl, DWH_ENDPOINT)
+
+    return DWH_ENDPOINT
+
+
+def clear_endpoint_cache ():
+    with _endpoint_lock:
+        _endpoint_cache.clear()
+
+
+def DWH_conn_string (AWS_DWH_ConfigFile, CLUSTER_ID='Default', redshift=None):
+    """
+    Description: 
+        Build the libpq connection string for the cluster defined in AWS_DWH_ConfigFile.
 
     Arguments:  
-        CLUSTER_ID  - Identifier of a running AWS Redshift cluster
         AWS_DWH_ConfigFile - Config for an exisiting Redshift cluster.
+        CLUSTER_ID  - Identifier of a running AWS Redshift cluster
+        redshift - optional boto3 Redshift client
 
     Returns:  
-        cur - cursor of the database connection
-        conn - connection to the target database
-    """   
+        conn_string - connection string, or None if CLUSTER_ID does not match the config
+    """
     config = configparser.ConfigParser()
     config.read_file(open(AWS_DWH_ConfigFile))
 
@@ -87,24 +148,11 @@ def connect_DWH_db (AWS_DWH_ConfigFile, CLUSTER_ID='Default'):
     elif CLUSTER_ID != DWH_CLUSTER_IDENTIFIER :
         
         print('***  ERROR ***: Provided Cluster ID {} does not match with config.   Please double check the cluster before connect!'.format(CLUSTER_ID))
-        return CLUSTER_ID
-
-    KEY                    = config.get('AWS','KEY')
-    SECRET                 = config.get('AWS','SECRET')
+        return None
 
     print('Connect Redshift CLuster {}'.format(CLUSTER_ID))
 
-    redshift = boto3.client('redshift',
-                           region_name="us-west-2",
-                           aws_access_key_id=KEY,
-                           aws_secret_access_key=SECRET
-                           )
-
-    myClusterProps = redshift.describe_clusters(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
-    DWH_ENDPOINT = myClusterProps['Endpoint']['Address']
-    DWH_ROLE_ARN = myClusterProps['IamRoles'][0]['IamRoleArn']
-
-    HOST                = DWH_ENDPOINT
+    HOST                = resolve_DWH_endpoint(config, DWH_CLUSTER_IDENTIFIER, redshift)
     DB_NAME             = config.get("DWH","DWH_DB")
     DB_USER             = config.get("DWH","DWH_DB_USER")
     DB_PASSWORD         = config.get("DWH","DWH_DB_PASSWORD")
@@ -114,12 +162,140 @@ def connect_DWH_db (AWS_DWH_ConfigFile, CLUSTER_ID='Default'):
     print_conn_string = "host={} dbname={} user={} password=XXXXX port={}".format(HOST, DB_NAME, DB_USER, DB_PORT)
     print(print_conn_string)
 
+    return conn_string
+
+
+def DWH_backend (AWS_DWH_ConfigFile):
+    """
+    Returns:  
+        backend of the config ([DWH] BACKEND, redshift by default) and the config
+    """
+    config = configparser.ConfigParser()
+    config.read_file(open(AWS_DWH_ConfigFile))
+    return backend_of(config), config
+
+
+def connect_DWH_db (AWS_DWH_ConfigFile, CLUSTER_ID='Default', redshift=None):
+    """
+    Description: 
+        Connects to an existing AWS Redshift cluster that is already started using
+        the config in the file AWH_DWH_ConfigFile.  With BACKEND = duckdb in the
+        config, opens the embedded DuckDB database DUCKDB_PATH instead.
+
+    Arguments:  
+        CLUSTER_ID  - Identifier of a running AWS Redshift cluster
+        AWS_DWH_ConfigFile - Config for an exisiting Redshift cluster.
+        redshift - optional boto3 Redshift client
+
+    Returns:  
+        cur - cursor of the database connection
+        conn - connection to the target database
+    """   
+    backend, config = DWH_backend(AWS_DWH_ConfigFile)
+    if backend == 'duckdb':
+        print('Connect DuckDB {}'.format(duckdb_path(config)))
+        return connect_duckdb(duckdb_path(config))
+
+    conn_string = DWH_conn_string(AWS_DWH_ConfigFile, CLUSTER_ID, redshift)
+    if conn_string is None:
+        return CLUSTER_ID
+
     conn = psycopg2.connect(conn_string)
     conn.set_session(autocommit=True)
     cur = conn.cursor()	
 
     return cur, conn
 
+
+class DWHConnectionPool:
+    """
+    Description: 
+        Thread safe pool of autocommit connections to the DWH.  Connections are
+        health checked on checkout and replaced when broken; callers block while
+        all maxconn connections are checked out.
+
+    Arguments:  
+        conn_string - libpq connection string (see DWH_conn_string)
+        minconn - connections opened up front
+        maxconn - upper bound of open connections
+    """
+
+    def __init__ (self, conn_string, minconn=1, maxconn=8):
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, conn_string)
+        self.available = threading.BoundedSemaphore(maxconn)
+
+    def healthy (self, conn):
+        """
+        Description: 
+            Switch conn to autocommit and check it with SELECT 1.  Autocommit is set
+            first: psycopg2 refuses set_session inside the transaction the check
+            would otherwise open.
+        """
+        if conn.closed:
+            return False
+        try:
+            conn.rollback()
+            conn.set_session(autocommit=True)
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            return True
+        except psycopg2.Error:
+            return False
+
+    def acquire (self):
+        """
+        Returns:  cur, conn - a cursor on a healthy connection from the pool
+        """
+        self.available.acquire()
+        conn = None
+        try:
+            conn = self.pool.getconn()
+            if not self.healthy(conn):
+                self.pool.putconn(conn, close=True)
+                conn = None
+                conn = self.pool.getconn()
+                conn.set_session(autocommit=True)
+            return conn.cursor(), conn
+        except Exception:
+            # a connection checked out of the pool goes back to it, closed
+            if conn is not None:
+                self.pool.putconn(conn, close=True)
+            self.available.release()
+            raise
+
+    def release (self, cur, conn):
+        try:
+            cur.close()
+            self.pool.putconn(conn, close=conn.closed != 0)
+        finally:
+            self.available.release()
+
+    @contextmanager
+    def connection (self):
+        cur, conn = self.acquire()
+        try:
+            yield cur, conn
+        finally:
+            self.release(cur, conn)
+
+    def closeall (self):
+        self.pool.closeall()
+
+
+def get_DWH_pool (AWS_DWH_ConfigFile, minconn=1, maxconn=8, redshift=None):
+    """
+    Description: 
+        Connection pool for the cluster defined in AWS_DWH_ConfigFile.
+        The endpoint is resolved through the cached resolve_DWH_endpoint.
+
+    Returns:  
+        DWHConnectionPool, or backends.DuckDBPool with BACKEND = duckdb
+    """
+    backend, config = DWH_backend(AWS_DWH_ConfigFile)
+    if backend == 'duckdb':
+        return DuckDBPool(duckdb_path(config))
+    return DWHConnectionPool(DWH_conn_string(AWS_DWH_ConfigFile, redshift=redshift), minconn, maxconn)
+
 def main():
     """
     Description: 
@@ -0,0 +1,339 @@
+import math
+import difflib
+import argparse
+import psycopg2
+from sql_queries import *
+from create_tables import connect_DWH_db
+from time_dim import DAY_MS
+
+# Dimensions with at most this many rows are copied to every node (diststyle all)
+DIST_ALL_MAX_ROWS = 1000000
+# A song_id distkey is rejected when the most played song holds more than this share of the plays
+MAX_DIST_SKEW = 0.05
+# Text columns with at most this many distinct values get a byte dictionary
+BYTEDICT_MAX_DISTINCT = 255
+# Room left for growth: code widths are scaled by VARCHAR_HEADROOM, integer ranges by INT_HEADROOM.
+# Incremental runs keep the advised DDL, so only fixed-width codes (ids, level) are narrowed; free
+# text never gets less than DEFAULT_VARCHAR and integers never less than int.
+VARCHAR_HEADROOM = 1.25
+INT_HEADROOM = 10
+VARCHAR_MAX = 65535
+DEFAULT_VARCHAR = 256
+# Width of an ISO 8601 start_time text, YYYY-MM-DDTHH:MI:SS.ffffff
+START_TIME_TEXT_WIDTH = 26
+
+# Star schema columns in the order of the hard-coded DDL:
+#   (column, kind, profiled source 'events.<stat>' / 'songs.<stat>', constraint)
+#   kind 'code' is a short identifier or code narrowed to its profiled width, 'text' free text
+STAR_SCHEMA = {
+    'songplay': [('songplay_id', 'identity',   None,                    'PRIMARY KEY'),
+                 ('start_time',  'start_time', None,                    'NOT NULL'),
+                 ('time_key',    'int',        None,                    'NOT NULL'),
+                 ('user_id',     'int',        'events.userid',         'NOT NULL'),
+                 ('level',       'code',       'events.level',          None),
+                 ('song_id',     'code',       'songs.song_id',         'NOT NULL'),
+                 ('artist_id',   'code',       'songs.artist_id',       'NOT NULL'),
+                 ('session_id',  'int',        'events.sessionid',      'NOT NULL'),
+                 ('location',    'text',       'events.location',       None),
+                 ('user_agent',  'text',       'events.useragent',      None)],
+    'users':    [('user_id',     'int',        'events.userid',         'PRIMARY KEY'),
+                 ('first_name',  'text',       'events.firstname',      None),
+                 ('last_name',   'text',       'events.lastname',       None),
+                 ('gender',      'text',       'events.gender',         None),
+                 ('level',       'code',       'events.level',          None)],
+    'songs':    [('song_id',     'code',       'songs.song_id',         'PRIMARY KEY'),
+                 ('title',       'text',       'songs.title',           'NOT NULL'),
+                 ('artist_id',   'code',       'songs.artist_id',       'NOT NULL'),
+                 ('year',        'int',        'songs.year',            'NOT NULL'),
+                 ('duration',    'float',      None,                    None)],
+    'artists':  [('artist_id',   'code',       'songs.artist_id',       'PRIMARY KEY'),
+                 ('name',        'text',       'songs.artist_name',     'NOT NULL'),
+                 ('location',    'text',       'songs.artist_location', None),
+                 ('lattitude',   'float',      None,                    None),
+                 ('longitude',   'float',      None,                    None)],
+    'time':     [('time_key',    'int',        None,                    'PRIMARY KEY'),
+                 ('start_time',  'start_time', None,                    'NOT NULL'),
+                 ('hour',        'smallint',   None,                    'NOT NULL'),
+                 ('day',         'smallint',   None,                    'NOT NULL'),
+                 ('week',        'smallint',   None,                    'NOT NULL'),
+                 ('month',       'smallint',   None,                    'NOT NULL'),
+                 ('year',        'smallint',   None,                    'NOT NULL'),
+                 ('weekday',     'smallint',   None,                    None)],
+}
+
+# Join key of each dimension with songplay, also its sort key
+DIMENSION_KEYS = {'users': 'user_id', 'songs': 'song_id', 'artists': 'artist_id', 'time': 'time_key'}
+
+CURRENT_DDL = dict(zip(['songplay', 'users', 'songs', 'artists', 'time'], create_table_queries))
+
+
+def fetch_profile(cur, query):
+    cur.execute(query)
+    row = cur.fetchone()
+    return {desc[0]: value for desc, value in zip(cur.description, row)}
+
+
+def profile_staging(cur):
+    """
+    Description:
+        Profile the loaded staging tables: row counts, cardinality, byte widths,
+        value ranges and the skew of the played songs.
+
+    Arguments:
+        cur - cursor of the database connection
+
+    Returns:
+        dict with the 'events' and 'songs' statistics and 'song_skew',
+        or None when the staging tables are missing or empty
+    """
+    try:
+        events = fetch_profile(cur, staging_events_profile)
+        songs = fetch_profile(cur, staging_songs_profile)
+        cur.execute(staging_events_song_skew)
+        top, plays = cur.fetchone()
+    except psycopg2.Error as e:
+        print('Staging tables could not be profiled: {}'.format(e))
+        return None
+
+    if not events['row_count'] or not songs['row_count']:
+        return None
+
+    return {'events': events, 'songs': songs, 'song_skew': float(top) / float(plays) if plays else 0.0}
+
+
+def stat(profile, source, name):
+    table, _, column = source.partition('.')
+    return profile[table].get('{}_{}'.format(column, name))
+
+
+def varchar_type(width, min_width=None):
+    if not width:
+        return 'varchar({})'.format(DEFAULT_VARCHAR)
+    if width == min_width:
+        # fixed width identifiers, e.g. the 18 character song / artist ids
+        return 'varchar({})'.format(width)
+    return 'varchar({})'.format(min(VARCHAR_MAX, 2 ** math.ceil(math.log2(width * VARCHAR_HEADROOM))))
+
+
+def text_type(width):
+    """
+    Description:
+        Free text (names, locations, user agents) keeps DEFAULT_VARCHAR, widened only
+        when longer values were seen.
+    """
+    if not width or width * VARCHAR_HEADROOM <= DEFAULT_VARCHAR:
+        return 'varchar({})'.format(DEFAULT_VARCHAR)
+    return varchar_type(width)
+
+
+def int_type(low, high):
+    if low is None or high is None:
+        return 'int'
+    low, high = int(low) * INT_HEADROOM, int(high) * INT_HEADROOM
+    if -2 ** 31 <= low and high < 2 ** 31:
+        return 'int'
+    return 'bigint'
+
+
+def column_type(kind, source, profile, start_time_type):
+    if kind == 'identity':
+        return 'BIGINT IDENTITY(0,1)'
+    if kind == 'start_time':
+        return 'timestamp' if start_time_type == 'timestamp' else 'varchar({})'.format(START_TIME_TEXT_WIDTH)
+    if kind == 'code':
+        return varchar_type(stat(profile, source, 'width'), stat(profile, source, 'min_width'))
+    if kind == 'text':
+        return text_type(stat(profile, source, 'width'))
+    if kind == 'int' and source:
+        return int_type(stat(profile, source, 'min'), stat(profile, source, 'max'))
+    return kind
+
+
+def column_encoding(kind, data_type, source, profile, sort_column):
+    """
+    Description:
+        Compression of one column: the leading sort key column stays raw so range
+        restricted scans stay cheap, AZ64 for integers and timestamps, a byte
+        dictionary for low cardinality text, zstd for everything else.
+    """
+    if sort_column:
+        return 'raw'
+    if kind in ('identity', 'int', 'smallint') or data_type == 'timestamp':
+        return 'az64'
+    if kind in ('code', 'text') and (stat(profile, source, 'distinct') or BYTEDICT_MAX_DISTINCT + 1) <= BYTEDICT_MAX_DISTINCT:
+        return 'bytedict'
+    return 'zstd'
+
+
+def table_rows(profile):
+    events, songs = profile['events'], profile['songs']
+    return {'songplay': events['next_song_rows'] or 0, 'users': events['userid_distinct'],
+            'songs': songs['song_id_distinct'], 'artists': songs['artist_id_distinct'],
+            'time': calendar_periods(events['ts_min'], events['ts_max'])}
+
+
+def calendar_periods(min_ts, max_ts):
+    if min_ts is None:
+        return 0
+    return (int(max_ts) // DAY_MS - int(min_ts) // DAY_MS + 1) * (DAY_MS // TIME_GRAIN_MS)
+
+
+def distribution(profile):
+    """
+    Description:
+        Distribution style per star schema table.  Small dimensions are copied to
+        every node.  songplay is distributed on the join key of its largest remaining
+        dimension, which gets the same distkey, so that join is co-located.  A song_id
+        key is only used when the play counts are not skewed.
+
+    Returns:
+        dict of table -> table attributes
+    """
+    rows = table_rows(profile)
+    styles = {}
+    candidates = []
+    for table, key in DIMENSION_KEYS.items():
+        if rows[table] <= DIST_ALL_MAX_ROWS:
+            styles[table] = 'diststyle all sortkey ({})'.format(key)
+            continue
+        styles[table] = 'diststyle key distkey ({0}) sortkey ({0})'.format(key)
+        if table != 'songs' or profile['song_skew'] <= MAX_DIST_SKEW:
+            candidates.append((rows[table], key))
+
+    if candidates:
+        styles['songplay'] = 'diststyle key distkey ({}) sortkey (start_time)'.format(max(candidates)[1])
+    else:
+        styles['songplay'] = 'diststyle even sortkey (start_time)'
+    return styles
+
+
+def render_table(table, columns, attributes):
+    definitions = ['      {:<12} {}'.format(name, ' '.join(part for part in parts if part))
+                   for name, *parts in columns]
+    return '\n    CREATE TABLE {} (\n{}\n    ) {};\n'.format(table, ',\n'.join(definitions), attributes)
+
+
+def advise(profile, start_time_type='timestamp'):
+    """
+    Description:
+        Generate the star schema DDL from a staging profile: narrowed types, a
+        start_time column of start_time_type, distribution and sort keys and
+        column encodings.
+
+    Arguments:
+        profile - output of profile_staging
+        start_time_type - 'timestamp' or 'text' (see START_TIME_TYPE in sql_queries.py)
+
+    Returns:
+        dict of table -> CREATE TABLE statement, in the order of create_table_queries
+    """
+    styles = distribution(profile)
+    ddl = {}
+    for table, spec in STAR_SCHEMA.items():
+        sort_column = styles[table].rsplit('sortkey (', 1)[1].rstrip(')')
+        columns = []
+        for name, kind, source, constraint in spec:
+            data_type = column_type(kind, source, profile, start_time_type)
+            encoding = column_encoding(kind, data_type, source, profile, name == sort_column)
+            columns.append((name, data_type, 'ENCODE ' + encoding, constraint))
+        ddl[table] = render_table(table, columns, styles[table])
+    return ddl
+
+
+def split_columns(ddl):
+    """
+    Returns:
+        text before the column list, the column definitions, text after the column list
+    """
+    open_at = ddl.index('(')
+    columns, depth, start = [], 0, open_at + 1
+    for i in range(open_at, len(ddl)):
+        depth += {'(': 1, ')': -1}.get(ddl[i], 0)
+        if (ddl[i] == ',' and depth == 1) or depth == 0:
+            columns.append(ddl[start:i].strip())
+            start = i + 1
+        if depth == 0:
+            return ddl[:open_at], columns, ddl[i + 1:]
+    raise ValueError('Unbalanced column list in {}'.format(ddl))
+
+
+def ddl_lines(ddl):
+    """
+    Description:
+        Normalized CREATE TABLE: lower case, single spaces, one column per line,
+        so hard-coded and generated DDL diff column by column.
+    """
+    head, columns, tail = split_columns(' '.join(ddl.split()).lower())
+    return ([head.strip() + ' ('] + ['    {},'.format(c) for c in columns[:-1]] + ['    ' + columns[-1]]
+            + [(') ' + tail.strip()).replace(' ;', ';')])
+
+
+def diff_ddl(advised, current=CURRENT_DDL):
+    """
+    Returns:
+        unified diff of the hard-coded DDL in sql_queries.py against the advised DDL
+    """
+    lines = []
+    for table, ddl in advised.items():
+        lines.extend(difflib.unified_diff(ddl_lines(current[table]), ddl_lines(ddl),
+                                          'sql_queries.py:{}'.format(table), 'advised:{}'.format(table),
+                                          lineterm=''))
+    return '\n'.join(lines)
+
+
+def write_ddl(path, advised, profile):
+    rows = table_rows(profile)
+    with open(path, 'w') as f:
+        f.write('-- Star schema DDL generated by ddl_advisor.py from the loaded staging data\n')
+        f.write('-- estimated rows: {}\n'.format(', '.join('{} {}'.format(t, rows[t]) for t in advised)))
+        for ddl in advised.values():
+            f.write(ddl.strip('\n') + '\n\n')
+
+
+def advised_table_queries(cur, start_time_type=START_TIME_TYPE):
+    """
+    Description:
+        Optional step before create_tables: profile the staging tables of the
+        previous load and return the advised DDL, printing its diff against the
+        hard-coded DDL.
+
+    Returns:
+        list of CREATE TABLE statements in the order of create_table_queries,
+        or None when there is no staging data to profile
+    """
+    profile = profile_staging(cur)
+    if profile is None:
+        print('No staging data to profile, using the DDL in sql_queries.py')
+        return None
+
+    advised = advise(profile, start_time_type)
+    print(diff_ddl(advised) or 'Advised DDL matches sql_queries.py')
+    return list(advised.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Advise star schema DDL from the loaded staging data')
+    parser.add_argument('--config', default='dwh-sp.cfg', help='DWH config file')
+    parser.add_argument('--output', default='advised_ddl.sql', help='file receiving the generated DDL')
+    parser.add_argument('--start-time-type', choices=['timestamp', 'text'], default='timestamp',
+                        help='type of start_time in songplay and time')
+    args = parser.parse_args()
+
+    cur, conn = connect_DWH_db(args.config)
+    try:
+        profile = profile_staging(cur)
+    finally:
+        cur.close()
+        conn.close()
+    if profile is None:
+        print('No staging data to profile, load the staging tables first')
+        return
+
+    advised = advise(profile, args.start_time_type)
+    write_ddl(args.output, advised, profile)
+    print(diff_ddl(advised) or 'Advised DDL matches sql_queries.py')
+    print('Advised DDL written to {}'.format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import re
+
+# Redshift-only physical design clauses that PostgreSQL does not accept
+REDSHIFT_ONLY = [
+    re.compile(r'\s+diststyle\s+\w+', re.IGNORECASE),
+    re.compile(r'\s+distkey\b(\s*\(\s*\w+\s*\))?', re.IGNORECASE),
+    re.compile(r'\s+(compound\s+|interleaved\s+)?sortkey\s*\([^)]*\)', re.IGNORECASE),
+    re.compile(r'\s+sortkey\b', re.IGNORECASE),
+    re.compile(r'\s+encode\s+\w+', re.IGNORECASE),
+]
+
+IDENTITY = re.compile(r'IDENTITY\s*\(\s*(-?\d+)\s*,\s*(\d+)\s*\)', re.IGNORECASE)
+
+
+def to_postgres(query):
+    """
+    Description:
+        Translate the Redshift DDL in sql_queries.py to PostgreSQL, so the pipeline can
+        run against a local PostgreSQL stand-in.  Queries other than DDL pass through.
+
+    Arguments:
+        query - SQL statement
+
+    Returns:
+        translated SQL statement
+    """
+    for pattern in REDSHIFT_ONLY:
+        query = pattern.sub('', query)
+
+    return IDENTITY.sub(lambda m: 'GENERATED BY DEFAULT AS IDENTITY (START WITH {0} MINVALUE {0} INCREMENT BY {1})'
+                        .format(m.group(1), m.group(2)), query)
+
+
+# DuckDB (backends.py): Redshift functions and DDL without a DuckDB equivalent
+EPOCH_MS = re.compile(r"TIMESTAMP\s+'epoch'\s*\+\s*([\w.]+)::numeric\s*/\s*1000\.0\s*\*\s*INTERVAL\s+'1 second'",
+                      re.IGNORECASE)
+TO_CHAR = re.compile(r"to_char\((.*?),\s*'([^']*)'\)", re.IGNORECASE | re.DOTALL)
+TO_CHAR_TOKENS = re.compile(r'"[^"]*"|YYYY|HH24|MM|DD|MI|SS|US')
+STRFTIME = {'YYYY': '%Y', 'HH24': '%H', 'MM': '%m', 'DD': '%d', 'MI': '%M', 'SS': '%S', 'US': '%f'}
+CREATE_LIKE = re.compile(r'CREATE\s+TEMP\s+TABLE\s+(\w+)\s*\(\s*LIKE\s+(\w+)\s*\)', re.IGNORECASE)
+CREATE_TABLE = re.compile(r'CREATE\s+TABLE\s+(IF\s+NOT\s+EXISTS\s+)?(\w+)', re.IGNORECASE)
+IDENTITY_COLUMN = re.compile(r'(\w+)(\s+\w+\s+)IDENTITY\s*\(\s*(-?\d+)\s*,\s*(\d+)\s*\)', re.IGNORECASE)
+DUCKDB_REPLACE = [
+    (re.compile(r'\bfloat\b', re.IGNORECASE), 'double'),
+    (re.compile(r'\s+PRIMARY\s+KEY\b', re.IGNORECASE), ''),
+    (re.compile(r'\bgetdate\(\)', re.IGNORECASE), 'now()'),
+    (re.compile(r'\bOCTET_LENGTH\(', re.IGNORECASE), 'strlen('),
+]
+
+
+def strftime_format(to_char_format):
+    return TO_CHAR_TOKENS.sub(lambda m: m.group(0)[1:-1] if m.group(0).startswith('"') else STRFTIME[m.group(0)],
+                              to_char_format)
+
+
+def to_duckdb(query):
+    """
+    Description:
+        Translate the Redshift SQL in sql_queries.py to DuckDB: physical design clauses are
+        dropped, IDENTITY columns draw from a sequence, epoch / to_char arithmetic becomes
+        epoch_ms / strftime, float is 8 bytes as on Redshift, and primary keys, which
+        Redshift does not enforce, are left out.
+
+    Arguments:
+        query - SQL statement
+
+    Returns:
+        translated SQL statement, possibly several separated by semicolons
+    """
+    for pattern in REDSHIFT_ONLY:
+        query = pattern.sub('', query)
+    for pattern, replacement in DUCKDB_REPLACE:
+        query = pattern.sub(replacement, query)
+
+    query = EPOCH_MS.sub(r'epoch_ms(CAST(\1 AS BIGINT))', query)
+    query = TO_CHAR.sub(lambda m: "strftime({}, '{}')".format(m.group(1), strftime_format(m.group(2))), query)
+    query = CREATE_LIKE.sub(r'CREATE TEMP TABLE \1 AS SELECT * FROM \2 LIMIT 0', query)
+
+    table = CREATE_TABLE.search(query)
+    identity = IDENTITY_COLUMN.search(query)
+    if table and identity:
+        sequence = '{}_{}_seq'.format(table.group(2), identity.group(1))
+        create = 'CREATE SEQUENCE IF NOT EXISTS' if table.group(1) else 'CREATE OR REPLACE SEQUENCE'
+        # DuckDB checks START against MINVALUE as the clauses are parsed, so this order matters
+        query = '{} {} INCREMENT {} MINVALUE {} START {};\n{}'.format(
+            create, sequence, identity.group(4), identity.group(3), identity.group(3),
+            IDENTITY_COLUMN.sub(r"\1\2DEFAULT nextval('{}')".format(sequence), query))
+    return query
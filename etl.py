@@ -1,122 +1,648 @@
+import argparse
+import os
 import configparser
-import psycopg2
 from sql_queries import *
 from create_tables import *
+from bulk_writer import BulkWriter, BULK_METHODS, DEFAULT_BATCH_SIZE
+from time_dim import start_times, time_keys, calendar, calendar_range, missing_ranges
+from song_catalog import catalog_from_staging
 import pandas as pd
 import boto3
 import json
 import datetime as dt
+from functools import partial
+from scheduler import Stage, run_stages
+from instrumentation import instrumented, configure, add_stage_hook, profile_to
+from s3_manifest import split_s3_url, list_objects, slice_count, balance, upload_manifests, run_copies
+from ddl_advisor import advised_table_queries
+from preflight import preflight, read_jsonpaths
+from unit_of_work import unit_of_work, atomic, supports_savepoints
+from checkpoint import Checkpoint, DEFAULT_CHECKPOINT_FILE, fingerprint, function_inputs
+from backends import load_json_staging
+from staging_windows import (WINDOW_GRAINS, DEFAULT_CONCURRENCY, DEFAULT_RETRIES, WindowLoadError, parse_date,
+                             date_windows, window_prefix, window_label, run_windows, report as report_windows)
+
+# 'sql'    - each target table is filled by one INSERT ... SELECT inside the warehouse
+# 'client' - rows are pulled to the client and inserted one by one (fallback)
+# 'stream' - as 'client', but the songplay fact is streamed through a server-side cursor
+TRANSFORM_MODES = ('sql', 'client', 'stream')
+STREAM_CHUNK_SIZE = 10000
 
 #-------------------------------------------------------------------
-def load_staging_tables(cur, conn):
-    for query in copy_table_queries:
-        print(query)
-        cur.execute(query)
+@instrumented('staging')
+def load_staging_tables(cur, conn, config=None, windows=None, connection=None):
+    """
+     Description: COPY the staging tables from the S3 prefixes.  With windows, the event
+                  logs are loaded window by window over a date range (load_event_windows).
+
+     Arguments:  cur - cursor of the database connection
+                 conn - connection to the target database
+                 config - ConfigParser of the DWH config file, needed with windows
+                 windows - dict of load_event_windows arguments (first, last, grain, ...), or None
+                 connection - context manager factory yielding (cur, conn), one per window
+
+     Returns:  None
+    """
+    if windows is None:
+        for query in copy_table_queries:
+            cur.execute(query)
+            conn.commit()
+    else:
+        cur.execute(staging_songs_copy)
         conn.commit()
+        load_event_windows(cur, conn, config, connection=connection, **windows)
+    build_match_keys(cur, conn)
+
+
+#-------------------------------------------------------------------
+def load_event_windows (cur, conn, config, first, last, grain='day', concurrency=DEFAULT_CONCURRENCY,
+                        retries=DEFAULT_RETRIES, time_budget=None, connection=None, s3=None):
+    """
+     Description: COPY the event logs of the date range first..last into staging_events,
+                  split into day or month windows of the date structured LOG_DATA prefix
+                  (staging_windows.py).  Up to concurrency windows load at the same time,
+                  each on its own connection and in one transaction with its record in
+                  etl_staged_files, so a failed window is retried from scratch.  Files
+                  already loaded are not loaded again.  Prints rows and duration per window.
+
+     Arguments:  cur - cursor of the database connection
+                 conn - connection to the target database
+                 config - ConfigParser of the DWH config file
+                 first, last - datetime.date range, inclusive
+                 grain - 'day' or 'month' windows
+                 concurrency - windows loading at the same time (1 without connection)
+                 retries - extra attempts per failing window
+                 time_budget - seconds after which no further window is started; the skipped
+                               windows are left to a later run
+                 connection - context manager factory yielding (cur, conn), one per window
+                 s3 - boto3 S3 client
+
+     Returns:  dict of window -> result, see staging_windows.run_windows
+    """
+    s3 = s3 or s3_client(config)
+    url, copy_key, _ = source_urls(config)['staging_events']
+    bucket, prefix = split_s3_url(url)
+    windows = {window_label(w, grain): w for w in date_windows(first, last, grain)}
+
+    cur.execute(etl_loaded_files_select, ('staging_events',))
+    loaded = set(r[0] for r in cur.fetchall())
+
+    def copy(window_cur, window_conn, copies, keys):
+        rows = 0
+        with unit_of_work(window_conn):
+            for sql in copies:
+                window_cur.execute(sql)
+                window_cur.execute(last_copy_count)
+                rows += window_cur.fetchone()[0]
+            record_staged_files(window_cur, 'staging_events', keys)
+        return rows
+
+    def load(label):
+        window_url = "'s3://{}/{}'".format(bucket, window_prefix(prefix, windows[label], grain))
+        keys = [key for key, _ in list_objects(s3, window_url)]
+        new = [key for key in keys if key not in loaded]
+        if not new:
+            return 0
+        if len(new) == len(keys):
+            copies = [copy_key.format(window_url)]
+        else:
+            copies = [copy_key.format("'s3://{}/{}'".format(bucket, key)) for key in new]
+
+        if connection is None:
+            return copy(cur, conn, copies, new)
+        with connection() as (window_cur, window_conn):
+            return copy(window_cur, window_conn, copies, new)
+
+    results = run_windows(list(windows), load, concurrency if connection is not None else 1, retries, time_budget)
+    report_windows(results)
+
+    skipped = [label for label, r in results.items() if r['status'] == 'skipped']
+    if skipped:
+        print('Time budget used up, windows {} are left to the next run'.format(', '.join(skipped)))
+    failed = [label for label, r in results.items() if r['status'] == 'failed']
+    if failed:
+        raise WindowLoadError('Windows {} failed after {} retries'.format(', '.join(failed), retries))
+    return results
+
+
+#-------------------------------------------------------------------
+@instrumented('match_keys')
+def build_match_keys (cur, conn):
+    """
+     Description: Populate the song match keys after staging is loaded: staging_events.match_key
+                  for the new events and staging_song_match rebuilt from staging_songs.
+                  Inside a unit of work the table is emptied with DELETE, as TRUNCATE would
+                  commit the transaction on Redshift.
+    """
+    run_queries(cur, conn, match_key_queries if conn.autocommit else match_key_queries_in_transaction)
+
+
+#-------------------------------------------------------------------
+def s3_client (config):
+    """
+     Description: S3 client using the credentials of the DWH config
+    """
+    return boto3.client('s3',
+                        region_name="us-west-2",
+                        aws_access_key_id=config.get('AWS', 'KEY'),
+                        aws_secret_access_key=config.get('AWS', 'SECRET')
+                        )
+
+
+#-------------------------------------------------------------------
+def record_loaded_files (cur, source, keys):
+    """
+     Description: Remember the S3 keys ingested for a staging source in etl_loaded_files
+    """
+    loaded_at = dt.datetime.utcnow()
+    with BulkWriter(cur, etl_loaded_files_insert) as writer:
+        writer.write_many((source, key, loaded_at) for key in keys)
+
+
+#-------------------------------------------------------------------
+def reset_staged_files (cur, source='staging_events'):
+    """
+     Description: Forget the keys staged by an earlier run that did not finish; they are
+                  not in etl_loaded_files, so this run stages them again.
+    """
+    cur.execute(etl_staged_files_table_create)
+    cur.execute(etl_staged_files_delete, (source,))
+
+
+#-------------------------------------------------------------------
+def clear_staging_tables (cur):
+    """
+     Description: Empty the staging tables before the COPYs of a full run.  DELETE, as
+                  TRUNCATE would commit the transaction of the stage on Redshift.
+    """
+    for q in clear_staging_table_queries:
+        cur.execute(q)
+
+
+#-------------------------------------------------------------------
+def record_staged_files (cur, source, keys):
+    """
+     Description: Remember the S3 keys staged by this run in etl_staged_files; they move to
+                  etl_loaded_files with the watermark (update_watermark), once every table
+                  is loaded.
+    """
+    staged_at = dt.datetime.utcnow()
+    with BulkWriter(cur, etl_staged_files_insert) as writer:
+        writer.write_many((source, key, staged_at) for key in keys)
+
+
+#-------------------------------------------------------------------
+def record_keys (cur, source, keys):
+    """
+     Description: Record the keys of a staging source: event logs as staged, songs as loaded
+                  (see CONTROL TABLES in sql_queries.py).
+    """
+    if source == 'staging_events':
+        record_staged_files(cur, source, keys)
+    else:
+        record_loaded_files(cur, source, keys)
+
+
+#-------------------------------------------------------------------
+def source_urls (config):
+    """
+     Description: staging table -> (s3:// prefix, single-object COPY template, manifest COPY template)
+    """
+    return {'staging_events': (config.get('S3', 'LOG_DATA'), staging_events_copy_key, staging_events_copy_manifest),
+            'staging_songs':  (config.get('S3', 'SONG_DATA'), staging_songs_copy_key, staging_songs_copy_manifest)}
+
+
+#-------------------------------------------------------------------
+def copy_with_manifests (cur, config, s3, objects, connection=None, conn=None, record=None):
+    """
+     Description: COPY source objects through generated manifests.  The objects of each
+                  staging table are grouped into size-balanced manifests sized for the
+                  slice count of the cluster (DWH_NUM_NODES / DWH_NODE_TYPE), written
+                  under [S3] MANIFEST_PREFIX, and the COPYs of the two staging tables
+                  run concurrently, each on its own connection.
+
+     Arguments:  cur - cursor of the database connection
+                 config - ConfigParser of the DWH config file
+                 s3 - boto3 S3 client
+                 objects - dict of staging table -> list of (key, size)
+                 connection - context manager factory yielding (cur, conn) for the
+                              concurrent COPYs; without it the COPYs run in turn on cur
+                 conn - connection of cur, needed with record
+                 record - optional callable (cur, staging table, keys) recording the keys
+                          of each manifest in one transaction with its COPY (record_keys)
+
+     Returns:  dict of staging table -> seconds
+    """
+    slices = slice_count(config)
+    manifest_url = config.get('S3', 'MANIFEST_PREFIX')
+    urls = source_urls(config)
+
+    copies, manifest_keys = {}, {}
+    for source, source_objects in objects.items():
+        if not source_objects:
+            continue
+        bucket, _ = split_s3_url(urls[source][0])
+        manifests = balance(source_objects, slices)
+        print('{}: {} files in {} manifests for {} slices'.format(source, len(source_objects), len(manifests), slices))
+        copies[source] = [urls[source][2].format(url) for url in
+                          upload_manifests(s3, bucket, manifests, manifest_url, source)]
+        manifest_keys.update((sql, [key for key, _ in manifest]) for sql, manifest in zip(copies[source], manifests))
+
+    def copy(copy_cur, copy_conn, table, sql):
+        if record is None:
+            copy_cur.execute(sql)
+            return
+        with unit_of_work(copy_conn):
+            copy_cur.execute(sql)
+            record(copy_cur, table, manifest_keys[sql])
+
+    def execute(table, sql):
+        if connection is None:
+            copy(cur, conn, table, sql)
+            return
+        with connection() as (copy_cur, copy_conn):
+            copy(copy_cur, copy_conn, table, sql)
+
+    durations = run_copies(copies, execute, concurrent=connection is not None)
+    for source, seconds in durations.items():
+        print('{}: COPY done in {:.2f}s'.format(source, seconds))
+    return durations
+
+
+#-------------------------------------------------------------------
+@instrumented('preflight')
+def run_preflight (cur, conn, config, connection=None, error_budget=0, incremental=False):
+    """
+     Description: Pre-flight validation of the source data before the real COPY
+                  (preflight.py): a sample of the objects to be loaded is checked locally
+                  against the staging columns and jsonpaths, then the NOLOAD checks run
+                  concurrently.  Incremental runs only sample the new objects and skip the
+                  NOLOAD checks, which would scan the whole prefixes.
+
+     Arguments:  cur - cursor of the database connection
+                 conn - connection to the target database
+                 config - ConfigParser of the DWH config file
+                 connection - context manager factory for the concurrent NOLOAD checks
+                 error_budget - bad records tolerated per staging table
+                 incremental - incremental run
+
+     Returns:  preflight report, raises preflight.PreflightError over the error budget
+    """
+    s3 = s3_client(config)
+    sources = {source: url for source, (url, _, _) in source_urls(config).items()}
+
+    objects = {}
+    for source, url in sources.items():
+        loaded = set()
+        if incremental:
+            cur.execute(etl_loaded_files_select, (source,))
+            loaded = set(r[0] for r in cur.fetchall())
+        objects[source] = [o for o in list_objects(s3, url) if o[0] not in loaded]
+
+    return preflight(s3, sources, objects, read_jsonpaths(s3, config.get('S3', 'LOG_JSONPATH')),
+                     cur, connection, error_budget, noload=not incremental)
+
+
+#-------------------------------------------------------------------
+@instrumented('staging_full')
+def load_staging_tables_full (cur, conn, config, connection=None, windows=None):
+    """
+     Description: COPY the whole S3 prefixes into staging and record every source key,
+                  so later incremental runs only pick up new files (record_keys).  The
+                  staging tables and keys are emptied first, so a resumed step starts over.  With
+                  [S3] MANIFEST_PREFIX configured the COPYs go through balanced manifests.
+                  With windows only the event logs of a date range are loaded, window by
+                  window (load_event_windows).
+
+     Arguments:  cur - cursor of the database connection
+                 conn - connection to the target database
+                 config - ConfigParser of the DWH config file
+                 connection - see copy_with_manifests
+                 windows - see load_staging_tables
+
+     Returns:  None
+    """
+    s3 = s3_client(config)
+    clear_staging_tables(cur)
+    reset_staged_files(cur)
+    listed = {source: list_objects(s3, url) for source, (url, _, _) in source_urls(config).items()
+              if windows is None or source != 'staging_events'}
+    for source in listed:
+        cur.execute(etl_loaded_files_delete, (source,))
+
+    if windows is not None:
+        load_staging_tables(cur, conn, config, dict(windows, s3=s3), connection)
+    elif config.has_option('S3', 'MANIFEST_PREFIX'):
+        copy_with_manifests(cur, config, s3, listed, connection)
+        build_match_keys(cur, conn)
+    else:
+        load_staging_tables(cur, conn)
+
+    for source, objects in listed.items():
+        record_keys(cur, source, sorted(key for key, _ in objects))
+    conn.commit()
+
+
+#-------------------------------------------------------------------
+@instrumented('staging_local')
+def load_staging_tables_local (cur, conn, data_dir):
+    """
+     Description: Load song_data / log_data JSON below data_dir into empty staging tables
+                  with the DuckDB JSON reader, the staging step of the embedded DuckDB backend.
+
+     Arguments:  cur - cursor of the database connection
+                 conn - connection to the target database
+                 data_dir - directory holding song_data/ and log_data/
+
+     Returns:  None
+    """
+    clear_staging_tables(cur)
+    rows = load_json_staging(cur, os.path.join(data_dir, 'song_data'), os.path.join(data_dir, 'log_data'))
+    for table, count in rows.items():
+        print('{}: {} rows'.format(table, count))
+    build_match_keys(cur, conn)
+
+
+#-------------------------------------------------------------------
+@instrumented('staging_incremental')
+def load_staging_tables_incremental (cur, conn, config, connection=None, windows=None):
+    """
+     Description: Stage only the S3 objects not yet recorded in etl_loaded_files.
+                  staging_events is truncated first, staging_songs keeps the catalog
+                  of earlier runs so new events can still match old songs.  The event
+                  logs of an earlier run that failed before its watermark are staged
+                  again (record_keys).  The keys of the new files are recorded in one
+                  transaction with their COPY, so a resumed step does not load a file
+                  twice.  With windows,
+                  the new event logs are only taken from a date range, window by window
+                  (load_event_windows).
+
+     Arguments:  cur - cursor of the database connection
+                 conn - connection to the target database
+                 config - ConfigParser of the DWH config file
+                 connection - see copy_with_manifests
+                 windows - see load_staging_tables
+
+     Returns:  dict of staging table -> number of new files loaded
+    """
+    s3 = s3_client(config)
+    # TRUNCATE would commit the transaction of an atomic stage on Redshift
+    cur.execute(staging_events_truncate if conn.autocommit else staging_events_delete)
+    reset_staged_files(cur)
+
+    new_objects = {}
+    for source, (url, _, _) in source_urls(config).items():
+        if windows is not None and source == 'staging_events':
+            continue
+        cur.execute(etl_loaded_files_select, (source,))
+        loaded = set(r[0] for r in cur.fetchall())
+        new_objects[source] = sorted(o for o in list_objects(s3, url) if o[0] not in loaded)
+        print('{}: {} new files ({} already loaded)'.format(source, len(new_objects[source]), len(loaded)))
+
+    if config.has_option('S3', 'MANIFEST_PREFIX'):
+        copy_with_manifests(cur, config, s3, new_objects, connection, conn, record=record_keys)
+    else:
+        for source, objects in new_objects.items():
+            url, copy_key, _ = source_urls(config)[source]
+            bucket, _ = split_s3_url(url)
+            with unit_of_work(conn):
+                for key, _ in objects:
+                    cur.execute(copy_key.format("'s3://{}/{}'".format(bucket, key)))
+                record_keys(cur, source, [key for key, _ in objects])
+
+    if windows is not None:
+        load_event_windows(cur, conn, config, s3=s3, connection=connection, **windows)
+
+    build_match_keys(cur, conn)
+    return {source: len(objects) for source, objects in new_objects.items()}
+
+
+#-------------------------------------------------------------------
+@instrumented('validate')
+def validate_staging (cur, conn):
+    """
+     Description: Check the staged rows against the rules of sql_queries.py (DATA VALIDATION)
+                  set-based, one INSERT ... SELECT and one DELETE per staging table.  Rows
+                  breaking a rule move to quarantine_<staging table> with a reason code, so
+                  the loaders only get clean rows.  The song match keys are rebuilt when
+                  songs were quarantined.
+
+     Arguments:  cur - cursor of the database connection
+                 conn - connection to the target database
+
+     Returns:  dict of staging table -> {reason code: rows quarantined}
+    """
+    for q in create_quarantine_table_queries:
+        cur.execute(q)
+
+    now = dt.datetime.utcnow()
+    params = {'run_at': now, 'max_ts': int((now + dt.timedelta(days=1)).timestamp() * 1000), 'max_year': now.year + 1}
+    quarantined = {}
+    with unit_of_work(conn):
+        for table, (quarantine, reject) in quarantine_queries_by_table.items():
+            cur.execute(quarantine, params)
+            if cur.rowcount:
+                cur.execute(reject, params)
+            cur.execute(quarantine_reasons_select.format(table), (now,))
+            quarantined[table] = dict(cur.fetchall())
+
+    for table, reasons in quarantined.items():
+        print('{}: {} rows quarantined {}'.format(table, sum(reasons.values()), reasons or ''))
+    if quarantined['staging_songs']:
+        build_match_keys(cur, conn)
+    return quarantined
+
+
+#-------------------------------------------------------------------
+@instrumented('watermark')
+def update_watermark (cur, conn, source='staging_events'):
+    """
+     Description: Advance the high-water mark (max ts loaded) in etl_watermark and move
+                  the event log keys staged by this run to etl_loaded_files, in one
+                  transaction.  Runs last, so a run failing earlier leaves its keys to
+                  be staged again.
+
+     Returns:  the new max_ts
+    """
+    cur.execute(etl_staged_files_table_create)
+    with unit_of_work(conn):
+        cur.execute(etl_watermark_select, (source,))
+        row = cur.fetchone()
+        previous = row[0] if row else None
+
+        cur.execute(staging_events_max_ts)
+        loaded = cur.fetchone()[0]
+
+        known = [int(v) for v in (previous, loaded) if v is not None]
+        max_ts = max(known) if known else None
+        now = dt.datetime.utcnow()
+        cur.execute(etl_staged_files_promote, (now, source))
+        cur.execute(etl_staged_files_delete, (source,))
+        cur.execute(etl_watermark_delete, (source,))
+        cur.execute(etl_watermark_insert, (source, max_ts, now))
+    return max_ts
+
+
+#-------------------------------------------------------------------
+def upsert_dimension (cur, conn, stage_create, upsert, stage_batch):
+    """
+     Description: Upsert one dimension table in a single transaction: create its temp
+                  stage table, fill it with the deduplicated batch through stage_batch(),
+                  then apply the upsert queries (sql_queries.py, DIMENSION UPSERTS), which
+                  only touch the keys that are new or changed.
+
+     Arguments:  cur - cursor of the database connection
+                 conn - connection to the target database
+                 stage_create - CREATE TEMP TABLE of the stage table
+                 upsert - queries applying the stage table to the target
+                 stage_batch - callable filling the stage table
+
+     Returns:  number of keys inserted or replaced
+
+    """
+    with unit_of_work(conn):
+        cur.execute(stage_create)
+        stage_batch()
+        changed = 0
+        for q in upsert:
+            cur.execute(q)
+            if q.startswith('INSERT'):
+                changed = cur.rowcount
+        return changed
 
 
 #-------------------------------------------------------------------
-def insert_songs_table (cur, conn):
+@instrumented('songs')
+def insert_songs_table (cur, conn, mode='sql', incremental=False, **bulk_options):
     """
-     Description: Populate songs dimention Table  in Sparkify database 
+     Description: Upsert songs dimention Table  in Sparkify database 
                   Data are query from staging based on queries defined in sql_queries.py
-                  Some minimal data quality check is done at insertion
+                  One row per song_id, only new or changed songs are written
 
      Arguments:  cur - cursor of the database connection
                  conn - connection to the target database
+                 mode - 'sql' (batch deduplicated in the warehouse) or 'client'
+                 incremental - unused, full and incremental runs upsert the same way
+                 bulk_options - batch_size / method passed to BulkWriter in 'client' mode
 
      Returns:  None
 
     """   
-    songs_df = pd.read_sql_query(songs_select, conn)
-
-    for i, r in songs_df.iterrows():
-        try:
-            cur.execute(songs_table_insert, (r.song_id, r.title, r.artist_id, r.year, r.duration))
-        except psycopg2.Error as e:
-            print('insert_users_data error:\n')
-            print(e)
+    def stage_batch():
+        if mode == 'sql':
+            cur.execute(songs_stage_transform)
+            return
+        songs_df = pd.read_sql_query(songs_select, conn)
+        # same order as songs_batch_select, the last row wins
+        songs_df = (songs_df.sort_values(['year', 'duration', 'title', 'artist_id'], ascending=[True, True, False, False],
+                                         na_position='last')
+                            .drop_duplicates('song_id', keep='last'))
+        with BulkWriter(cur, songs_stage_insert, **bulk_options) as writer:
+            writer.write_many(songs_df[['song_id', 'title', 'artist_id', 'year', 'duration']].itertuples(index=False, name=None))
+
+    print('songs upserted: {}'.format(upsert_dimension(cur, conn, songs_stage_create, songs_upsert, stage_batch)))
     
 #-------------------------------------------------------------------                
-def insert_artists_table (cur, conn):
+@instrumented('artists')
+def insert_artists_table (cur, conn, mode='sql', incremental=False, **bulk_options):
     """
-     Description: Populate artists dimention Table  in Sparkify database 
+     Description: Upsert artists dimention Table  in Sparkify database 
                   Data are query from staging based on queries defined in sql_queries.py
-                  Some minimal data quality check is done at insertion
+                  One row per artist_id, only new or changed artists are written
 
      Arguments:  cur - cursor of the database connection
                  conn - connection to the target database
+                 mode - 'sql' (batch deduplicated in the warehouse) or 'client'
+                 incremental - unused, full and incremental runs upsert the same way
+                 bulk_options - batch_size / method passed to BulkWriter in 'client' mode
 
      Returns:  None
 
     """   
-    artists_df = pd.read_sql_query (artists_select, conn)
-           
-    for i, r in artists_df.iterrows():
-        try:
-            cur.execute(artists_table_insert, (r.artist_id, r.artist_name, r.artist_location, r.artist_latitude, r.artist_longitude))
-        except psycopg2.Error as e:
-            print('insert_artists_data error:\n')
-            print(e)
+    def stage_batch():
+        if mode == 'sql':
+            cur.execute(artists_stage_transform)
+            return
+        artists_df = pd.read_sql_query (artists_select, conn)
+        # most complete row wins, in the order of artists_batch_select, the last row wins
+        artists_df = (artists_df.assign(located=artists_df.artist_latitude.notna(),
+                                        has_location=artists_df.artist_location.fillna('') != '')
+                                .sort_values(['located', 'has_location', 'artist_name', 'artist_location',
+                                              'artist_latitude', 'artist_longitude', 'song_id'],
+                                             ascending=[True, True, False, False, False, False, False], na_position='first')
+                                .drop_duplicates('artist_id', keep='last'))
+        with BulkWriter(cur, artists_stage_insert, **bulk_options) as writer:
+            writer.write_many(artists_df[['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']].itertuples(index=False, name=None))
+
+    print('artists upserted: {}'.format(upsert_dimension(cur, conn, artists_stage_create, artists_upsert, stage_batch)))
                 
     
 #-------------------------------------------------------------------               
-def insert_users_table (cur, conn):
+@instrumented('users')
+def insert_users_table (cur, conn, mode='sql', incremental=False, **bulk_options):
     """
-     Description: Populate users dimention Table  in Sparkify database 
+     Description: Upsert users dimention Table  in Sparkify database 
                   Data are query from staging based on queries defined in sql_queries.py
-                  Some minimal data quality check is done at insertion
+                  One row per user_id, the latest event (by ts) wins, so level changes
+                  replace the user row instead of adding one
 
      Arguments:  cur - cursor of the database connection
                  conn - connection to the target database
+                 mode - 'sql' (batch deduplicated in the warehouse) or 'client'
+                 incremental - unused, full and incremental runs upsert the same way
+                 bulk_options - batch_size / method passed to BulkWriter in 'client' mode
 
      Returns:  None
 
     """   
-    cur.execute('SELECT DISTINCT userid, firstName, lastName, gender, level  from staging_events')
-    users_list = cur.fetchall()
+    def stage_batch():
+        if mode == 'sql':
+            cur.execute(users_stage_transform)
+            return
+        cur.execute('SELECT userid, firstName, lastName, gender, level, ts, itemInSession  from staging_events'
+                    '  WHERE userid IS NOT NULL')
+        users_df = pd.DataFrame(cur.fetchall(), columns=['userid', 'firstName', 'lastName', 'gender', 'level', 'ts', 'itemInSession'])
+        users_df = users_df.sort_values(['ts', 'itemInSession']).drop_duplicates('userid', keep='last')
+        with BulkWriter(cur, users_stage_insert, **bulk_options) as writer:
+            writer.write_many(users_df[['userid', 'firstName', 'lastName', 'gender', 'level']].itertuples(index=False, name=None))
 
-    for r in users_list:
-        if isinstance (r[0], int):
-            try:
-                cur.execute(users_table_insert, (r[0], r[1], r[2], r[3], r[4]))
-            except psycopg2.Error as e:
-                print('insert_users_data error:\n')
-                print(e)
+    print('users upserted: {}'.format(upsert_dimension(cur, conn, users_stage_create, users_upsert, stage_batch)))
 
     
 #-------------------------------------------------------------------
-def insert_time_table (cur, conn):
+@instrumented('time')
+def insert_time_table (cur, conn, mode='sql', incremental=False, **bulk_options):
     """
-     Description: Populate time dimention Table  in Sparkify database 
-                  Data are query from staging based on queries defined in sql_queries.py
-                  Some minimal data quality check is done at insertion
+     Description: Extend the calendar time dimention Table in Sparkify database 
+                  The calendar covers whole days at TIME_GRAIN (sql_queries.py) over the
+                  date range seen so far.  Only the periods of the staged events that are
+                  not in the table yet are generated, in one transaction, so each run adds
+                  at most a few days of rows instead of one row per distinct event timestamp.
 
      Arguments:  cur - cursor of the database connection
                  conn - connection to the target database
+                 mode, incremental - unused, the calendar is generated the same way in every mode
+                 bulk_options - batch_size / method passed to BulkWriter
 
-     Returns:  None
+     Returns:  number of periods added
 
     """   
-    
-    cur.execute('SELECT DISTINCT ts  from staging_events')
-    ts_list = cur.fetchall()
-
-    for r in ts_list:
-        ts = int(r[0])
-        dts = dt.datetime.fromtimestamp(ts/1000.0)
-        start_time = dts.isoformat()
-        week_of_year = dts.isocalendar()[1]
-        #  start_time, hour, day, week, month, year, weekday
-        try:
-            cur.execute(time_table_insert, (start_time, dts.hour, dts.day, week_of_year, dts.month, dts.year, dts.weekday()))
-        except psycopg2.Error as e:
-            print('insert_users_data error:\n')
-            print(e)
+    cur.execute(staging_events_ts_range)
+    min_ts, max_ts = cur.fetchone()
+    if min_ts is None:
+        return 0
+
+    cur.execute(time_key_range)
+    ranges = missing_ranges(calendar_range(min_ts, max_ts, TIME_GRAIN_MS), cur.fetchone())
+
+    with unit_of_work(conn), BulkWriter(cur, time_table_insert, **bulk_options) as writer:
+        for first_key, last_key in ranges:
+            writer.write_many(calendar(first_key, last_key, TIME_GRAIN_MS).itertuples(index=False, name=None))
+    return writer.row_count
 
     
 #-------------------------------------------------------------------
-def insert_dimension_tables (cur, conn):
+def insert_dimension_tables (cur, conn, mode='sql', incremental=False, **bulk_options):
     """
     Description: Populate Dimention Tables in Sparkify database 
                 Data are query from staging based on queries defined in sql_queries.py
@@ -124,76 +650,401 @@ def insert_dimension_tables (cur, conn):
 
     Arguments:  cur - cursor of the database connection
                 conn - connection to the target database
+                mode - 'sql' (INSERT ... SELECT in the warehouse) or 'client'
+                incremental - incremental run; the dimensions are upserted either way
+                bulk_options - batch_size / method passed to BulkWriter in 'client' mode
 
     Returns:  None
 
     """   
     print("insert_artists_table")
-    insert_artists_table (cur, conn)
+    insert_artists_table (cur, conn, mode, incremental, **bulk_options)
 
     print("insert_users_table")
-    insert_users_table (cur, conn)
+    insert_users_table (cur, conn, mode, incremental, **bulk_options)
 
     print("insert_time_table")
-    insert_time_table (cur, conn)
+    insert_time_table (cur, conn, mode, incremental, **bulk_options)
 
     print("insert_songs_table")
-    insert_songs_table (cur, conn)
+    insert_songs_table (cur, conn, mode, incremental, **bulk_options)
+
+#-------------------------------------------------------------------
+def read_chunks (conn, query, chunk_size=STREAM_CHUNK_SIZE, name='etl_stream'):
+    """
+     Description: Read a query through a named (server-side) cursor in fixed size chunks.
+                  The connection must be in a transaction (not autocommit).
+
+     Arguments:  conn - connection to the target database
+                 query - SELECT statement
+                 chunk_size - rows per chunk
+
+     Returns:  generator of lists of rows
+    """
+    with conn.cursor(name=name) as stream_cur:
+        stream_cur.itersize = chunk_size
+        stream_cur.execute(query)
+        while True:
+            rows = stream_cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+
+#-------------------------------------------------------------------
+def songplay_rows (chunks):
+    """
+     Description: Transform chunks of songplay_select_next_song rows into
+                  songplay_table_insert rows, one vectorized start_time / time_key per chunk.
+    """
+    for rows in chunks:
+        ts = [r[0] for r in rows]
+        for r, start_time, time_key in zip(rows, start_times(ts), time_keys(ts, TIME_GRAIN_MS)):
+            yield (start_time, time_key, r[1], r[2], r[3], r[4], r[5], r[6], str(r[7]))
+
+
+#-------------------------------------------------------------------
+def catalog_songplay_rows (chunks, catalog):
+    """
+     Description: Resolve chunks of staging_events_next_song rows against the song
+                  catalog cache and yield songplay_table_insert rows for the matches.
+    """
+    for rows in chunks:
+        matches = [(r, catalog.lookup(r[3], r[4])) for r in rows]
+        matches = [(r, m) for r, m in matches if m is not None]
+        ts = [r[0] for r, _ in matches]
+        for (r, (song_id, artist_id)), start_time, time_key in zip(matches, start_times(ts), time_keys(ts, TIME_GRAIN_MS)):
+            yield (start_time, time_key, r[1], r[2], song_id, artist_id, r[5], r[6], str(r[7]))
+
+
+#-------------------------------------------------------------------
+def insert_songplay_stream (cur, conn, chunk_size=STREAM_CHUNK_SIZE, catalog=None, **bulk_options):
+    """
+     Description: Bounded-memory songplay load.  The NextSong filter runs in SQL and the
+                  join result is read through a server-side cursor chunk by chunk, then
+                  piped through songplay_rows into the BulkWriter.  Peak memory is one
+                  chunk plus one writer batch, independent of the event log size.
+
+     Arguments:  cur - cursor of the database connection
+                 conn - connection to the target database
+                 chunk_size - rows fetched per round trip
+                 catalog - optional song_catalog.SongCatalog; when given, only staging_events
+                           is read and songs are resolved from the catalog instead of the join
+                 bulk_options - batch_size / method passed to BulkWriter
+
+     Returns:  None
+    """
+    with unit_of_work(conn) as uow:
+        if catalog is None:
+            rows = songplay_rows(read_chunks(uow, songplay_select_next_song, chunk_size, 'songplay_stream'))
+        else:
+            rows = catalog_songplay_rows(read_chunks(uow, staging_events_next_song, chunk_size, 'songplay_stream'), catalog)
+
+        with BulkWriter(cur, songplay_table_insert, **bulk_options) as writer:
+            writer.write_many(rows)
 
 #-------------------------------------------------------------------
-def insert_songplay_table (cur, conn):
+@instrumented('songplay')
+def insert_songplay_table (cur, conn, mode='sql', incremental=False, song_catalog=None, **bulk_options):
     """
      Description: Populate Dimention Tables in Sparkify database 
                   Data are query from staging based on queries defined in sql_queries.py
                   Some minimal data quality check is done at insertion
     Arguments:  cur - cursor of the database connection
                 conn - connection to the target database
+                mode - 'sql' (INSERT ... SELECT in the warehouse), 'client' or 'stream'
+                incremental - staging_events only holds the newly staged files; full runs
+                              empty songplay first, so a resumed step does not add the plays twice
+                song_catalog - cache directory of the song catalog used in 'stream' mode, or None for the join
+                bulk_options - batch_size / method passed to BulkWriter in 'client' mode
     Returns:  None
     """
-    
-    column_name = ('songplay_id', 'start_time', 'user_id', 'level', 'song_id', 'artist_id', 'session_id', 'location', 'user_agent')
+    if not incremental:
+        cur.execute(songplay_table_delete)
+    if mode == 'sql':
+        cur.execute(songplay_table_incremental if incremental else songplay_table_transform)
+        return
+    if mode == 'stream':
+        catalog = catalog_from_staging(cur, song_catalog) if song_catalog else None
+        insert_songplay_stream(cur, conn, catalog=catalog, **bulk_options)
+        return
 
     df=pd.read_sql_query(songplay_select, conn)
     df=df[df.page == 'NextSong']
     
-    for i, r in df.iterrows():
-        dts = dt.datetime.fromtimestamp(r.ts/1000.0)
-        start_time = dts.isoformat()
-        try:
-            #print((start_time, r.userid, r.level, r.song_id, r.artist_id, r.sessionid, r.location, r.useragent) )
-            cur.execute(songplay_table_insert, (start_time, r.userid, r.level, r.song_id, r.artist_id, r.sessionid, r.location, str(r.useragent) ) )
-        except psycopg2.Error as e:
-            print('insert_users_data error:\n')
-            print(e) 
+    df = df.assign(start_time=start_times(df.ts), time_key=time_keys(df.ts, TIME_GRAIN_MS))
+
+    def songplay_rows():
+        for r in df.itertuples(index=False):
+            yield (r.start_time, r.time_key, r.userid, r.level, r.song_id, r.artist_id, r.sessionid, r.location, str(r.useragent))
+
+    with BulkWriter(cur, songplay_table_insert, **bulk_options) as writer:
+        writer.write_many(songplay_rows())
+
+#-------------------------------------------------------------------
+@instrumented('aggregates')
+def refresh_aggregates (cur, conn):
+    """
+     Description: Refresh the aggregate tables (sql_queries.py, AGGREGATE TABLES) for the
+                  days that received new facts in this run, in one transaction, so
+                  analysts never see a day half refreshed.
+
+     Arguments:  cur - cursor of the database connection
+                 conn - connection to the target database
+
+     Returns:  None
+    """
+    for q in create_aggregate_table_queries:
+        cur.execute(q)
+
+    with unit_of_work(conn):
+        for q in aggregate_refresh_queries:
+            cur.execute(q)
+
+#-------------------------------------------------------------------
+def load_stages (staging, mode='sql', incremental=False, song_catalog=None, preflight=None, atomic_stages=False,
+                 **bulk_options):
+    """
+    Description: Dependency graph of the load.  Every table only needs the staging
+                 tables, so the four dimensions and the songplay fact run concurrently
+                 once staging is loaded and validated.  The aggregate tables are refreshed from the
+                 loaded tables, and the high-water mark is moved last.
+
+    Arguments:  staging - stage function loading the staging tables
+                mode, incremental, bulk_options - as for insert_dimension_tables
+                song_catalog - as for insert_songplay_table
+                preflight - optional stage function validating the sources before staging
+                atomic_stages - run every stage as one unit of work (unit_of_work.py), committed
+                                at its end or not at all
+
+    Returns:  list of scheduler.Stage
+    """
+    def table_stage(name, func):
+        return Stage(name, partial(func, mode=mode, incremental=incremental, **bulk_options), deps=['validate'])
+
+    tables = [table_stage('artists', insert_artists_table),
+              table_stage('users', insert_users_table),
+              table_stage('time', insert_time_table),
+              table_stage('songs', insert_songs_table),
+              Stage('songplay', partial(insert_songplay_table, mode=mode, incremental=incremental,
+                                        song_catalog=song_catalog, **bulk_options), deps=['validate'])]
+
+    validate = Stage('validate', validate_staging, deps=['staging'])
+
+    aggregates = Stage('aggregates', refresh_aggregates, deps=[t.name for t in tables])
+
+    watermark = Stage('watermark', lambda cur, conn: print('High-water mark ts: {}'.format(update_watermark(cur, conn))),
+                      deps=[t.name for t in tables] + ['aggregates'])
+
+    if preflight is None:
+        stages = [Stage('staging', staging), validate] + tables + [aggregates, watermark]
+    else:
+        stages = ([Stage('preflight', preflight), Stage('staging', staging, deps=['preflight']), validate]
+                  + tables + [aggregates, watermark])
+
+    if atomic_stages:
+        for stage in stages:
+            stage.func = atomic(stage.func)
+    return stages
 
 #-------------------------------------------------------------------   
-def main():
+def main(mode='sql', batch_size=DEFAULT_BATCH_SIZE, bulk_method='values', full_refresh=False,
+         config_file='dwh-sp.cfg', max_workers=4, song_catalog=None, metrics_file=None,
+         profile_stage=None, advise_ddl=False, preflight_budget=None, atomic_stages=False,
+         resume=False, checkpoint_file=DEFAULT_CHECKPOINT_FILE, windows=None, local_data=None,
+         statement_retries=0):
+    """
+    Description: Run the ETL load for Sparkify DWH.  By default the run is incremental:
+                 only S3 objects not yet recorded in etl_loaded_files are staged and
+                 transformed.  The first run, or full_refresh=True, drops and rebuilds
+                 every table from the whole S3 prefixes.
+
+    Arguments:  mode - one of TRANSFORM_MODES: 'sql' (INSERT ... SELECT in the warehouse), 'client' or 'stream'
+                batch_size - rows per batch for the client side bulk writer
+                bulk_method - 'values' (multi-row INSERT) or 'copy' (COPY FROM STDIN, PostgreSQL only)
+                full_refresh - drop and reload everything instead of an incremental run
+                config_file - DWH config file
+                max_workers - maximum number of load stages running concurrently
+                song_catalog - song catalog cache directory for 'stream' mode, None to use the join
+                metrics_file - JSON lines file receiving per-statement and per-stage metrics
+                profile_stage - name of a stage to run under cProfile (stats in <stage>.prof)
+                advise_ddl - on full rebuilds, create the star schema from DDL advised by
+                             profiling the staging data of the previous load (ddl_advisor.py)
+                preflight_budget - validate the sources before staging and abort when a staging
+                                   table has more bad records than this, None to skip
+                atomic_stages - unit-of-work mode: the rebuild and every stage run as one
+                                transaction instead of committing statement by statement.  On
+                                PostgreSQL, client side batches that fail are bisected under
+                                savepoints and only the offending rows are rejected
+                resume - continue the unfinished run recorded in checkpoint_file: the table
+                         rebuild and the stages completed with the same input fingerprints
+                         (checkpoint.py) are skipped, the others run again
+                checkpoint_file - local JSON file recording the completed steps of the run
+                windows - load the event logs of a date range only, in concurrent day or month
+                          windows: dict of load_event_windows arguments (first, last, grain,
+                          concurrency, retries, time_budget), None for the whole LOG_DATA prefix.
+                          With atomic_stages the staging COPYs and windows run in turn in the
+                          staging transaction
+                local_data - with BACKEND = duckdb, directory holding the song_data/ and log_data/
+                             JSON to stage; every run is a full rebuild
+                statement_retries - retries of a statement failing with an OperationalError on an
+                                    autocommit connection, recorded per statement in the metrics
+
+    Returns:  None
+    """
+    if mode not in TRANSFORM_MODES:
+        raise ValueError('Unknown transform mode {}, expected one of {}'.format(mode, TRANSFORM_MODES))
+    bulk_options = {'batch_size': batch_size, 'method': bulk_method}
+
+    configure(metrics_file, statement_retries)
+    if profile_stage:
+        add_stage_hook(profile_stage, profile_to('{}.prof'.format(profile_stage)))
+
+    backend, config = DWH_backend(config_file)
+    if backend == 'duckdb':
+        if local_data is None:
+            raise ValueError('BACKEND = duckdb stages local JSON, pass the data directory (--local-data)')
+        if windows is not None or preflight_budget is not None:
+            raise ValueError('Date windows and preflight checks read S3, they need BACKEND = redshift')
+        # staging is not tracked per file locally, so every run rebuilds everything
+        full_refresh = True
 
     print('\n\n ETL load for Sparkify DWH: \n\n 1.    Connect to Sparkify DWH:\n')
     print(dt.datetime.now())
-    cur, conn = connect_DWH_db ('dwh-sp.cfg')
+    cur, conn = connect_DWH_db (config_file)
 
-    print('\n\n 2.    Create Tables:\n')
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
-    
-    print('\n\n 3.    Load Staging Tables:\n')
-    print(dt.datetime.now())
-    load_staging_tables(cur, conn)
-    
-    print('\n\n 4.    Load Dimensional Tables:\n')
-    print(dt.datetime.now())
-    insert_dimension_tables (cur, conn)
-    
-    print('\n\n 5.    Load Fact Table songplay:\n')
+    checkpoint = Checkpoint(checkpoint_file)
+    if resume and checkpoint.resumable():
+        # the rebuild may already have created the control tables, keep the plan of the run
+        incremental = checkpoint.run['incremental']
+        print('Resuming the {} run started {}'.format('incremental' if incremental else 'full', checkpoint.run['started']))
+    else:
+        if resume:
+            print('No unfinished run in {}, starting a new run'.format(checkpoint_file))
+        cur.execute(control_tables_exist)
+        incremental = not full_refresh and cur.fetchone()[0] == len(create_control_table_queries)
+        checkpoint.start(incremental=incremental, mode=mode)
+
+    settings = {section: {k: v for k, v in config.items(section) if 'password' not in k}
+                for section in ('S3', 'DWH') if config.has_section(section)}
+    run_inputs = fingerprint(incremental, settings)
+
+    if incremental and mode != 'sql':
+        raise ValueError("Incremental runs require mode='sql', use full_refresh for mode={}".format(mode))
+
+    window_connections = windows.get('concurrency', DEFAULT_CONCURRENCY) + 1 if windows else 0
+    pool = get_DWH_pool(config_file, minconn=1, maxconn=max(2, max_workers, window_connections))
+
+    # in unit-of-work mode the staging COPYs and date windows run in turn in the transaction
+    # of the staging step; on connections of their own they would commit apart from it and
+    # wait on its locks
+    staging_connection = None if atomic_stages else pool.connection
+
+    if incremental:
+        print('\n\n 2.    Incremental run, keeping existing tables\n')
+        staging = partial(load_staging_tables_incremental, config=config, connection=staging_connection, windows=windows)
+    else:
+        print('\n\n 2.    Create Tables:\n')
+
+        def rebuild():
+            table_queries = advised_table_queries(cur) if advise_ddl else None
+            if atomic_stages:
+                with unit_of_work(conn) as uow:
+                    drop_tables(cur, uow)
+                    create_tables(cur, uow, table_queries)
+            else:
+                drop_tables(cur, conn)
+                create_tables(cur, conn, table_queries)
+
+        checkpoint.step('create', fingerprint(run_inputs, advise_ddl, function_inputs(drop_tables),
+                                              function_inputs(create_tables)), rebuild)
+        if backend == 'duckdb':
+            staging = partial(load_staging_tables_local, data_dir=local_data)
+        else:
+            staging = partial(load_staging_tables_full, config=config, connection=staging_connection, windows=windows)
+
+    if atomic_stages:
+        bulk_options['isolate_errors'] = supports_savepoints(cur)
+    cur.close()
+    conn.close()
+
+    checks = None
+    if preflight_budget is not None:
+        checks = partial(run_preflight, config=config, connection=pool.connection,
+                         error_budget=preflight_budget, incremental=incremental)
+
+    print('\n\n 3.    Load Staging, Dimensional and Fact Tables:\n')
     print(dt.datetime.now())
-    insert_songplay_table (cur, conn)
+    stages = load_stages(staging, mode, incremental, song_catalog, checks, atomic_stages, **bulk_options)
+    try:
+        run_stages(checkpoint.wrap_stages(stages, run_inputs), pool.acquire, max_workers, release=pool.release)
+    except Exception:
+        print('\nThe completed steps are recorded in {}, continue the run with --resume'.format(checkpoint_file))
+        raise
+    finally:
+        pool.closeall()
+    checkpoint.complete()
     
     print('\n\n ETL Load Process Completed.\n')
-    cur.close()
-    conn.close()
     print(dt.datetime.now())
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='ETL load for Sparkify DWH')
+    parser.add_argument('--mode', choices=TRANSFORM_MODES, default='sql',
+                        help="'sql' runs the transforms inside the warehouse, 'client' is the client side fallback, "
+                             "'stream' also streams the songplay fact through a server-side cursor")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='rows per batch for the client side bulk writer')
+    parser.add_argument('--bulk-method', choices=BULK_METHODS, default='values',
+                        help="'values' (multi-row INSERT) or 'copy' (COPY FROM STDIN, PostgreSQL only)")
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='drop all tables and reload the whole S3 prefixes instead of an incremental run')
+    parser.add_argument('--config', default='dwh-sp.cfg', help='DWH config file')
+    parser.add_argument('--max-workers', type=int, default=4,
+                        help='maximum number of load stages running concurrently')
+    parser.add_argument('--song-catalog', metavar='DIR',
+                        help="in 'stream' mode resolve songs from an on-disk song catalog cache instead of the join")
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='append per-statement and per-stage metrics as JSON lines to FILE')
+    parser.add_argument('--profile-stage', metavar='STAGE',
+                        help='run one stage (e.g. songplay) under cProfile, stats written to STAGE.prof')
+    parser.add_argument('--advise-ddl', action='store_true',
+                        help='on full rebuilds, create the star schema from DDL advised by profiling the previous staging load')
+    parser.add_argument('--preflight', type=int, metavar='ERROR_BUDGET', nargs='?', const=0,
+                        help='validate the sources (sampled locally, NOLOAD checks) before staging, '
+                             'abort when a staging table has more bad records than ERROR_BUDGET (default 0)')
+    parser.add_argument('--unit-of-work', action='store_true',
+                        help='run the rebuild and every stage as one transaction, committed at its end or not at all')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the last unfinished run, skipping the steps it completed with unchanged inputs')
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT_FILE, metavar='FILE',
+                        help='local JSON file recording the completed steps of a run')
+    parser.add_argument('--from-date', type=parse_date, metavar='YYYY-MM-DD',
+                        help='only load the event logs from this date on, window by window')
+    parser.add_argument('--to-date', type=parse_date, metavar='YYYY-MM-DD',
+                        help='last date of the event logs loaded with --from-date (default: --from-date)')
+    parser.add_argument('--window', choices=WINDOW_GRAINS, default='day', help='size of the load windows')
+    parser.add_argument('--window-concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='windows loading at the same time')
+    parser.add_argument('--window-retries', type=int, default=DEFAULT_RETRIES,
+                        help='extra attempts per failing window')
+    parser.add_argument('--time-budget', type=float, metavar='SECONDS',
+                        help='start no further window after SECONDS, the rest is left to the next run')
+    parser.add_argument('--local-data', metavar='DIR',
+                        help='with BACKEND = duckdb, directory holding the song_data/ and log_data/ JSON to load')
+    parser.add_argument('--statement-retries', type=int, default=0, metavar='N',
+                        help='retry a statement failing with a transient OperationalError up to N times')
+    args = parser.parse_args()
+
+    windows = None
+    if args.from_date:
+        windows = {'first': args.from_date, 'last': args.to_date or args.from_date, 'grain': args.window,
+                   'concurrency': args.window_concurrency, 'retries': args.window_retries,
+                   'time_budget': args.time_budget}
+    main(mode=args.mode, batch_size=args.batch_size, bulk_method=args.bulk_method,
+         full_refresh=args.full_refresh, config_file=args.config, max_workers=args.max_workers,
+         song_catalog=args.song_catalog, metrics_file=args.metrics, profile_stage=args.profile_stage,
+         advise_ddl=args.advise_ddl, preflight_budget=args.preflight, atomic_stages=args.unit_of_work,
+         resume=args.resume, checkpoint_file=args.checkpoint, windows=windows,
+         local_data=args.local_data, statement_retries=args.statement_retries)
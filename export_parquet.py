@@ -0,0 +1,221 @@
+import os
+import glob
+import shutil
+import argparse
+import itertools
+import datetime as dt
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sql_queries import (export_table_select, songplay_export_select, songplay_max_time_key, EXPORT_WATERMARK_SOURCE,
+                         TIME_KEYS_PER_DAY, etl_watermark_select, etl_watermark_delete, etl_watermark_insert)
+from create_tables import connect_DWH_db
+from unit_of_work import unit_of_work
+
+STAR_TABLES = ('songplay', 'users', 'songs', 'artists', 'time')
+DEFAULT_OUTPUT = 'export'
+EXPORT_CHUNK_SIZE = 100000
+PART_FILE = 'part-0.parquet'
+PARTITION = 'start_date={:%Y-%m-%d}'
+EPOCH = dt.date(1970, 1, 1)
+# Column of songplay_export_select holding the time_key
+TIME_KEY_COLUMN = 2
+
+# PostgreSQL / Redshift type OIDs (cursor.description) -> Arrow types; others are exported as strings
+ARROW_TYPES = {16: pa.bool_(), 20: pa.int64(), 21: pa.int16(), 23: pa.int32(), 700: pa.float32(),
+               701: pa.float64(), 1700: pa.float64(), 1082: pa.date32(), 1114: pa.timestamp('us'),
+               1184: pa.timestamp('us', tz='UTC')}
+
+
+def arrow_schema(description):
+    return pa.schema([(column.name, ARROW_TYPES.get(column.type_code, pa.string())) for column in description])
+
+
+def to_arrow(rows, schema):
+    """
+    Description:
+        One chunk of rows as an Arrow table of schema; numeric values become floats and
+        unknown types strings, NULL stays null.
+    """
+    columns = []
+    for i, field in enumerate(schema):
+        values = [r[i] for r in rows]
+        if pa.types.is_floating(field.type):
+            values = [None if v is None else float(v) for v in values]
+        elif pa.types.is_string(field.type):
+            values = [None if v is None else str(v) for v in values]
+        columns.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def stream(conn, query, chunk_size=EXPORT_CHUNK_SIZE, name='export_stream'):
+    """
+    Description:
+        Read a query through a named (server-side) cursor in chunks, as etl.read_chunks,
+        with the Arrow schema of its columns.  The connection must be in a transaction.
+
+    Returns:
+        generator of (schema, list of rows)
+    """
+    with conn.cursor(name=name) as cur:
+        cur.itersize = chunk_size
+        cur.execute(query)
+        schema = None
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            if schema is None:
+                schema = arrow_schema(cur.description)
+            yield schema, rows
+
+
+def replace_files(directory, tmp_path=None):
+    """
+    Description:
+        Replace the Parquet files of directory with tmp_path (none when tmp_path is None).
+    """
+    for old in glob.glob(os.path.join(directory, '*.parquet')):
+        os.remove(old)
+    if tmp_path is not None:
+        os.replace(tmp_path, os.path.join(directory, PART_FILE))
+
+
+def export_table(conn, table, output=DEFAULT_OUTPUT, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Description:
+        Export a whole table to output/<table>/part-0.parquet, one row group per chunk.
+
+    Returns:
+        rows exported
+    """
+    directory = os.path.join(output, table)
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, PART_FILE + '.tmp')
+
+    writer = None
+    rows = 0
+    for schema, chunk in stream(conn, export_table_select.format(table), chunk_size, 'export_' + table):
+        if writer is None:
+            writer = pq.ParquetWriter(tmp_path, schema)
+        writer.write_table(to_arrow(chunk, schema))
+        rows += len(chunk)
+
+    if writer is not None:
+        writer.close()
+    replace_files(directory, tmp_path if writer is not None else None)
+    return rows
+
+
+def export_songplay(cur, conn, output=DEFAULT_OUTPUT, chunk_size=EXPORT_CHUNK_SIZE, incremental=False):
+    """
+    Description:
+        Export songplay partitioned by start_time date, output/songplay/start_date=YYYY-MM-DD/.
+        Rows are read in time_key order, so one partition file is open at a time and
+        moved in place when its day is complete.  An incremental export starts at the
+        day of the export watermark and rewrites the partitions from there on; a full
+        export also removes the partitions of days no longer in the table.  The
+        watermark is advanced in the reading transaction.
+
+    Arguments:
+        cur - cursor of the database connection
+        conn - connection to the target database, in a transaction
+        output - export root directory
+        chunk_size - rows per fetch, the bound of the client memory
+        incremental - only export the days from the export watermark on
+
+    Returns:
+        rows exported, partitions written
+    """
+    since = 0
+    if incremental:
+        cur.execute(etl_watermark_select, (EXPORT_WATERMARK_SOURCE,))
+        row = cur.fetchone()
+        if row and row[0] is not None:
+            since = int(row[0]) // TIME_KEYS_PER_DAY * TIME_KEYS_PER_DAY
+
+    cur.execute(songplay_max_time_key)
+    max_key = cur.fetchone()[0]
+
+    root = os.path.join(output, 'songplay')
+    os.makedirs(root, exist_ok=True)
+    written = set()
+    state = {'writer': None, 'partition': None, 'directory': None, 'tmp_path': None}
+
+    def finish_partition():
+        if state['writer'] is not None:
+            state['writer'].close()
+            replace_files(state['directory'], state['tmp_path'])
+            state['writer'] = None
+
+    rows = 0
+    if max_key is not None:
+        for schema, chunk in stream(conn, songplay_export_select.format(since), chunk_size, 'export_songplay'):
+            for day_key, day_rows in itertools.groupby(chunk, key=lambda r: r[TIME_KEY_COLUMN] // TIME_KEYS_PER_DAY):
+                partition = PARTITION.format(EPOCH + dt.timedelta(days=day_key))
+                if partition != state['partition']:
+                    finish_partition()
+                    directory = os.path.join(root, partition)
+                    os.makedirs(directory, exist_ok=True)
+                    state.update(partition=partition, directory=directory,
+                                 tmp_path=os.path.join(directory, PART_FILE + '.tmp'))
+                    state['writer'] = pq.ParquetWriter(state['tmp_path'], schema)
+                    written.add(partition)
+                day_rows = list(day_rows)
+                state['writer'].write_table(to_arrow(day_rows, schema))
+                rows += len(day_rows)
+        finish_partition()
+
+    if not incremental:
+        for directory in glob.glob(os.path.join(root, 'start_date=*')):
+            if os.path.basename(directory) not in written:
+                shutil.rmtree(directory)
+
+    if max_key is not None:
+        cur.execute(etl_watermark_delete, (EXPORT_WATERMARK_SOURCE,))
+        cur.execute(etl_watermark_insert, (EXPORT_WATERMARK_SOURCE, max_key, dt.datetime.utcnow()))
+    return rows, len(written)
+
+
+def export_star_schema(cur, conn, output=DEFAULT_OUTPUT, tables=STAR_TABLES, chunk_size=EXPORT_CHUNK_SIZE,
+                       incremental=False):
+    """
+    Description:
+        Export the star schema tables to Parquet under output, in one read transaction so
+        the tables are a consistent snapshot.  The dimensions are always exported whole.
+
+    Returns:
+        dict of table -> rows exported
+    """
+    exported = {}
+    with unit_of_work(conn) as uow:
+        for table in tables:
+            if table == 'songplay':
+                rows, partitions = export_songplay(cur, uow, output, chunk_size, incremental)
+                print('songplay: {} rows in {} date partitions'.format(rows, partitions))
+            else:
+                rows = export_table(uow, table, output, chunk_size)
+                print('{}: {} rows'.format(table, rows))
+            exported[table] = rows
+    return exported
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the Sparkify star schema to Parquet')
+    parser.add_argument('--config', default='dwh-sp.cfg', help='DWH config file')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='export root directory')
+    parser.add_argument('--tables', nargs='+', choices=STAR_TABLES, default=list(STAR_TABLES))
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help='rows per fetch')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only rewrite the songplay partitions from the day of the last export on')
+    args = parser.parse_args()
+
+    cur, conn = connect_DWH_db(args.config)
+    try:
+        export_star_schema(cur, conn, args.output, args.tables, args.chunk_size, args.incremental)
+    finally:
+        cur.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
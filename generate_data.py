@@ -0,0 +1,166 @@
+import os
+import json
+import random
+import string
+import argparse
+import datetime as dt
+
+# Shapes follow the Sparkify sources: one song object per song_data file,
+# one event per line in log_data/YYYY/MM/YYYY-MM-DD-events.json
+PAGES = ['Home', 'Logout', 'Login', 'Settings', 'Help', 'About', 'Upgrade', 'Downgrade']
+NEXT_SONG_SHARE = 0.8
+UNKNOWN_SONG_SHARE = 0.05
+WORDS = ['love', 'night', 'blue', 'heart', 'dance', 'fire', 'rain', 'road', 'dream', 'light',
+         'home', 'time', 'gold', 'river', 'summer', 'shadow', 'city', 'star', 'wild', 'song']
+FIRST_NAMES = ['Kaylee', 'Lily', 'Jacob', 'Tegan', 'Chloe', 'Ryan', 'Aleena', 'Jayden', 'Sara', 'Kate']
+LAST_NAMES = ['Summers', 'Koch', 'Klein', 'Levine', 'Cuevas', 'Smith', 'Kirby', 'Bell', 'Johnson', 'Harrell']
+LOCATIONS = ['San Jose-Sunnyvale-Santa Clara, CA', 'Chicago-Naperville-Elgin, IL-IN-WI',
+             'Atlanta-Sandy Springs-Roswell, GA', 'Portland-South Portland, ME', 'Lansing-East Lansing, MI']
+# jsonpaths order, the same as local_ingest.EVENT_FIELDS
+LOG_FIELDS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length', 'level',
+              'location', 'method', 'page', 'registration', 'sessionId', 'song', 'status', 'ts',
+              'userAgent', 'userId']
+USER_AGENT = '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"'
+
+
+def random_id(rng, prefix):
+    return prefix + ''.join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(16))
+
+
+def generate_songs(n_songs, rng):
+    """
+    Description:
+        Song metadata records shaped like the song_data JSON objects.
+    """
+    artists = [(random_id(rng, 'AR'), '{} {}'.format(rng.choice(WORDS).title(), rng.choice(WORDS).title()))
+               for _ in range(max(1, n_songs // 4))]
+    songs = []
+    for i in range(n_songs):
+        artist_id, artist_name = rng.choice(artists)
+        located = rng.random() < 0.5
+        songs.append({
+            'num_songs': 1,
+            'artist_id': artist_id,
+            'artist_latitude': round(rng.uniform(-60, 60), 5) if located else None,
+            'artist_longitude': round(rng.uniform(-150, 150), 5) if located else None,
+            'artist_location': rng.choice(LOCATIONS) if located else '',
+            'artist_name': artist_name,
+            'song_id': random_id(rng, 'SO'),
+            'title': '{} {} {}'.format(rng.choice(WORDS).title(), rng.choice(WORDS), i),
+            'duration': round(rng.uniform(60, 500), 5),
+            'year': rng.choice([0] + list(range(1960, 2019))),
+        })
+    return songs
+
+
+def write_songs(songs, out_dir, songs_per_file=1):
+    """
+    Description:
+        Write song_data/<A>/<B>/<C>/TR....json files, songs_per_file objects per file.
+    """
+    for start in range(0, len(songs), songs_per_file):
+        batch = songs[start:start + songs_per_file]
+        song_id = batch[0]['song_id']
+        folder = os.path.join(out_dir, 'song_data', song_id[2], song_id[3], song_id[4])
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, 'TR{}.json'.format(song_id[2:])), 'w') as f:
+            for song in batch:
+                f.write(json.dumps(song) + '\n')
+
+
+def generate_users(n_users, rng):
+    return [{'userId': str(i + 1),
+             'firstName': rng.choice(FIRST_NAMES),
+             'lastName': rng.choice(LAST_NAMES),
+             'gender': rng.choice(['F', 'M']),
+             'level': rng.choice(['free', 'paid']),
+             'location': rng.choice(LOCATIONS),
+             'registration': float(rng.randint(1540000000000, 1541000000000))}
+            for i in range(n_users)]
+
+
+def generate_day(day, n_events, songs, users, rng):
+    """
+    Description:
+        Events of one day, ordered by ts, shaped like the log_data records.
+    """
+    day_start = int(dt.datetime(day.year, day.month, day.day, tzinfo=dt.timezone.utc).timestamp() * 1000)
+    offsets = sorted(rng.randrange(0, 86400000) for _ in range(n_events))
+    events = []
+    for i, offset in enumerate(offsets):
+        user = rng.choice(users)
+        if rng.random() < 0.01:
+            user['level'] = 'paid' if user['level'] == 'free' else 'free'
+
+        event = {'artist': None, 'auth': 'Logged In', 'firstName': user['firstName'], 'gender': user['gender'],
+                 'itemInSession': i % 100, 'lastName': user['lastName'], 'length': None, 'level': user['level'],
+                 'location': user['location'], 'method': 'GET', 'page': rng.choice(PAGES),
+                 'registration': user['registration'], 'sessionId': int(user['userId']) * 31 % 1000 + day.day,
+                 'song': None, 'status': 200, 'ts': day_start + offset, 'userAgent': USER_AGENT,
+                 'userId': user['userId']}
+
+        if rng.random() < NEXT_SONG_SHARE:
+            song = songs[min(int(rng.paretovariate(1.2)) - 1, len(songs) - 1)] if rng.random() < 0.5 else rng.choice(songs)
+            event.update(page='NextSong', method='PUT', artist=song['artist_name'], song=song['title'],
+                         length=round(song['duration'] + rng.uniform(-0.4, 0.4), 5))
+            if rng.random() < UNKNOWN_SONG_SHARE:
+                event['song'] = song['title'] + ' (Live)'
+        elif event['page'] in ('Home', 'Login') and rng.random() < 0.3:
+            event.update(auth='Logged Out', userId='', firstName=None, lastName=None, gender=None,
+                         registration=None, level='free')
+        events.append(event)
+    return events
+
+
+def generate(out_dir, n_events, n_songs=None, n_users=None, days=30, start=dt.date(2018, 11, 1),
+             songs_per_file=1, seed=0):
+    """
+    Description:
+        Generate a synthetic Sparkify source tree at out_dir: song_data/, log_data/ and
+        log_json_path.json.
+
+    Arguments:
+        out_dir - target directory
+        n_events - number of log events (10k to 10M)
+        n_songs - catalog size, default n_events / 20
+        n_users - number of users, default n_events / 1000
+        days - number of daily log files
+        start - date of the first log file
+        songs_per_file - song objects per song_data file
+        seed - random seed, the same arguments always produce the same files
+
+    Returns:
+        dict with the generated row counts
+    """
+    rng = random.Random(seed)
+    songs = generate_songs(n_songs or max(100, n_events // 20), rng)
+    users = generate_users(n_users or max(10, n_events // 1000), rng)
+    write_songs(songs, out_dir, songs_per_file)
+
+    per_day = [n_events // days + (1 if d < n_events % days else 0) for d in range(days)]
+    for d, n in enumerate(per_day):
+        day = start + dt.timedelta(days=d)
+        folder = os.path.join(out_dir, 'log_data', '{:%Y}'.format(day), '{:%m}'.format(day))
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, '{:%Y-%m-%d}-events.json'.format(day)), 'w') as f:
+            for event in generate_day(day, n, songs, users, rng):
+                f.write(json.dumps(event) + '\n')
+
+    with open(os.path.join(out_dir, 'log_json_path.json'), 'w') as f:
+        json.dump({'jsonpaths': ["$['{}']".format(field) for field in LOG_FIELDS]}, f, indent=2)
+
+    return {'songs': len(songs), 'users': len(users), 'events': n_events}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate synthetic Sparkify song and event-log JSON')
+    parser.add_argument('out_dir')
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--songs', type=int)
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--songs-per-file', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(generate(args.out_dir, args.events, args.songs, args.users, args.days,
+                   songs_per_file=args.songs_per_file, seed=args.seed))
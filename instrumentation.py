@@ -0,0 +1,216 @@
+import re
+import json
+import time
+import cProfile
+import threading
+import functools
+import datetime as dt
+from contextlib import contextmanager, ExitStack
+import psycopg2
+
+# Statements whose rowcount is counted as rows written by a stage
+WRITE_STATEMENT = re.compile(r'^\s*(INSERT|UPDATE|DELETE|COPY|MERGE)\b', re.IGNORECASE)
+
+
+class Metrics:
+    """
+    Description:
+        Collects per-statement and per-stage records and appends them as JSON lines
+        to a metrics file, so load performance can be charted over time.
+
+    Arguments:
+        path - JSON lines file, or None to keep the records in memory only
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.records = []
+        self.lock = threading.Lock()
+        self.statement_retries = 0
+
+    def emit(self, record):
+        record = dict(record, at=dt.datetime.utcnow().isoformat())
+        with self.lock:
+            self.records.append(record)
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record, default=str) + '\n')
+
+
+metrics = Metrics()
+
+# Context managers entered around a stage: stage name -> list of factories(stage name)
+stage_hooks = {}
+
+_local = threading.local()
+
+
+def configure(path=None, statement_retries=0):
+    """
+    Description:
+        Send metrics to a JSON lines file, and retry statements failing with an
+        OperationalError up to statement_retries times (autocommit connections only).
+    """
+    metrics.path = path
+    metrics.statement_retries = statement_retries
+
+
+def current_stage():
+    stack = getattr(_local, 'stages', None)
+    return stack[-1]['name'] if stack else None
+
+
+def add_stage_hook(name, hook):
+    """
+    Description:
+        Attach a context manager factory, called with the stage name, around every run
+        of one stage, e.g. add_stage_hook('songplay', profile_to('songplay.prof')).
+    """
+    stage_hooks.setdefault(name, []).append(hook)
+
+
+def profile_to(path):
+    """
+    Description:
+        Stage hook running the stage under cProfile and dumping the stats to path.
+    """
+    @contextmanager
+    def hook(name):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+            print('profile of stage {} written to {}'.format(name, path))
+    return hook
+
+
+def statement_text(query):
+    if isinstance(query, bytes):
+        query = query[:2000].decode('utf-8', 'replace')
+    return ' '.join(str(query).split())[:200]
+
+
+class InstrumentedCursor:
+    """
+    Description:
+        Cursor wrapper timing every execute / copy_expert with its rows affected and
+        retries, attributed to the current stage.  Everything else is delegated.
+    """
+
+    def __init__(self, cur):
+        self.cur = cur
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+    def __iter__(self):
+        return iter(self.cur)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cur.close()
+        return False
+
+    def timed(self, query, call, retry=True):
+        retries = 0
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            while True:
+                try:
+                    return call()
+                except psycopg2.OperationalError:
+                    if not retry or retries >= metrics.statement_retries or not self.cur.connection.autocommit:
+                        raise
+                    retries += 1
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            rows = self.cur.rowcount
+            text = statement_text(query)
+            stack = getattr(_local, 'stages', None)
+            if stack and rows > 0 and WRITE_STATEMENT.match(text):
+                stack[-1]['rows'] += rows
+            if stack:
+                stack[-1]['statements'] += 1
+            metrics.emit({'type': 'statement', 'stage': current_stage(), 'statement': text,
+                          'seconds': round(time.perf_counter() - start, 6), 'rows': rows,
+                          'retries': retries, 'status': status})
+
+    def execute(self, query, vars=None):
+        return self.timed(query, lambda: self.cur.execute(query, vars))
+
+    def executemany(self, query, vars_list):
+        return self.timed(query, lambda: self.cur.executemany(query, vars_list))
+
+    def copy_expert(self, sql, file, size=8192):
+        """
+        Description:
+            A retried COPY FROM STDIN reads file again from where the first attempt
+            started.  A file that cannot seek back is not retried, its rows would be lost.
+        """
+        position = file_position(file)
+        if position is None:
+            return self.timed(sql, lambda: self.cur.copy_expert(sql, file, size), retry=False)
+
+        def copy():
+            file.seek(position)
+            return self.cur.copy_expert(sql, file, size)
+        return self.timed(sql, copy)
+
+
+def file_position(file):
+    """
+    Returns:
+        current position of a seekable file object, else None
+    """
+    try:
+        return file.tell() if file.seekable() else None
+    except (AttributeError, OSError):
+        return None
+
+
+def instrument_cursor(cur):
+    return cur if isinstance(cur, InstrumentedCursor) else InstrumentedCursor(cur)
+
+
+def instrumented(name):
+    """
+    Description:
+        Decorator for stage functions taking (cur, conn, ...).  The cursor is wrapped in
+        an InstrumentedCursor, and a stage record with wall time, rows written and
+        throughput is emitted when the function returns.  Hooks registered with
+        add_stage_hook(name, ...) run around the call.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(cur, conn, *args, **kwargs):
+            stack = _local.__dict__.setdefault('stages', [])
+            stack.append({'name': name, 'rows': 0, 'statements': 0})
+            start = time.perf_counter()
+            status = 'ok'
+            try:
+                with ExitStack() as hooks:
+                    for hook in stage_hooks.get(name, []):
+                        hooks.enter_context(hook(name))
+                    return func(instrument_cursor(cur), conn, *args, **kwargs)
+            except Exception:
+                status = 'error'
+                raise
+            finally:
+                stage = stack.pop()
+                seconds = time.perf_counter() - start
+                if stack:
+                    stack[-1]['rows'] += stage['rows']
+                metrics.emit({'type': 'stage', 'stage': name, 'seconds': round(seconds, 6),
+                              'rows': stage['rows'], 'statements': stage['statements'],
+                              'rows_per_sec': round(stage['rows'] / seconds, 1) if seconds > 0 else None,
+                              'status': status})
+        return wrapper
+    return decorate
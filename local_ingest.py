@@ -0,0 +1,216 @@
+import os
+import io
+import json
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import psycopg2
+from bulk_writer import BulkWriter, parse_insert, csv_field
+from sql_queries import staging_events_insert, staging_songs_insert
+
+try:
+    import orjson
+except ImportError:
+    # optional, several times faster than json for the log files
+    orjson = None
+
+loads = orjson.loads if orjson is not None else json.loads
+
+# Source bytes parsed by one worker task; each task returns its rows as one CSV payload
+SHARD_BYTES = 8 * 1024 * 1024
+
+# JSON field per staging column, in the order of staging_events_insert
+# (the same mapping as the jsonpaths file used by staging_events_copy)
+EVENT_FIELDS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length',
+                'level', 'location', 'method', 'page', 'registration', 'sessionId', 'song',
+                'status', 'ts', 'userAgent', 'userId']
+
+# JSON field per staging column, in the order of staging_songs_insert ('auto' maps by name)
+SONG_FIELDS = ['num_songs', 'artist_id', 'artist_latitude', 'artist_longitude', 'artist_location',
+               'artist_name', 'song_id', 'title', 'duration', 'year']
+
+# Numeric columns: an empty string in the source is loaded as NULL, like COPY does
+NUMERIC_FIELDS = {'itemInSession', 'length', 'registration', 'sessionId', 'status', 'ts', 'userId',
+                  'num_songs', 'artist_latitude', 'artist_longitude', 'duration', 'year'}
+
+
+def json_files(root):
+    """
+    Description:
+        All .json files below root, sorted so loads are repeatable.
+    """
+    paths = []
+    for dirpath, _, filenames in os.walk(root):
+        paths.extend(os.path.join(dirpath, f) for f in filenames if f.endswith('.json'))
+    return sorted(paths)
+
+
+def iter_records(path):
+    """
+    Description:
+        JSON records of one source file; song files hold one object, log files one per line.
+    """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield loads(line)
+
+
+def to_row(record, fields):
+    row = []
+    for field in fields:
+        value = record.get(field)
+        if value == '' and field in NUMERIC_FIELDS:
+            value = None
+        row.append(value)
+    return tuple(row)
+
+
+def load_files(cur, paths, insert_sql, fields, **bulk_options):
+    """
+    Description:
+        Parse the source files and bulk-load their records into one staging table.
+
+    Returns:
+        number of rows loaded
+    """
+    with BulkWriter(cur, insert_sql, **bulk_options) as writer:
+        for path in paths:
+            writer.write_many(to_row(r, fields) for r in iter_records(path))
+    return writer.row_count
+
+
+def shard_files(paths, shard_bytes=SHARD_BYTES):
+    """
+    Description:
+        Group consecutive files into shards of about shard_bytes, keeping the file order.
+    """
+    shards, shard, size = [], [], 0
+    for path in paths:
+        shard.append(path)
+        size += os.path.getsize(path)
+        if size >= shard_bytes:
+            shards.append(shard)
+            shard, size = [], 0
+    if shard:
+        shards.append(shard)
+    return shards
+
+
+def parse_shard(task):
+    """
+    Description:
+        Worker task: parse the files of one shard into COPY ... CSV rows.
+
+    Arguments:
+        task - (list of paths, JSON field per staging column)
+
+    Returns:
+        CSV payload (bytes), number of rows
+    """
+    paths, fields = task
+    buf = io.StringIO()
+    count = 0
+    for path in paths:
+        for record in iter_records(path):
+            buf.write(','.join(csv_field(v) for v in to_row(record, fields)))
+            buf.write('\n')
+            count += 1
+    return buf.getvalue().encode('utf-8'), count
+
+
+def bounded_map(pool, func, items, window):
+    """
+    Description:
+        pool.map keeping at most window tasks in flight, so parsed shards wait in
+        memory only while the COPY is behind.  Results come back in order.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def copy_files(cur, pool, workers, paths, insert_sql, fields, shard_bytes=SHARD_BYTES):
+    """
+    Description:
+        Parse the source files on the process pool and stream every shard into one
+        staging table with COPY ... FROM STDIN while the next shards are parsed.
+
+    Returns:
+        number of rows loaded
+    """
+    table, columns = parse_insert(insert_sql)
+    copy_sql = 'COPY {} ({}) FROM STDIN WITH CSV'.format(table, ', '.join(columns))
+
+    started = time.perf_counter()
+    rows = 0
+    tasks = [(shard, fields) for shard in shard_files(paths, shard_bytes)]
+    for payload, count in bounded_map(pool, parse_shard, tasks, 2 * workers):
+        if count:
+            cur.copy_expert(copy_sql, io.BytesIO(payload))
+            rows += count
+
+    elapsed = time.perf_counter() - started
+    print('{}: {} rows from {} files in {} shards, {} workers, {:.2f}s ({:.0f} rows/sec)'.format(
+        table, rows, len(paths), len(tasks), workers, elapsed, rows / elapsed if elapsed > 0 else 0.0))
+    return rows
+
+
+def load_local_staging(cur, conn, song_dir, log_dir, workers=None, **bulk_options):
+    """
+    Description:
+        Load local song_data and log_data JSON files into staging_songs / staging_events,
+        the local equivalent of the S3 COPYs in load_staging_tables.  With the 'copy'
+        method the files are sharded across a pool of worker processes, parsed there
+        (orjson when installed) and streamed in with COPY ... FROM STDIN; the 'values'
+        method loads them in this process through BulkWriter.
+
+    Arguments:
+        cur - cursor of the database connection
+        conn - connection to the target database
+        song_dir - root of the song_data files
+        log_dir - root of the log_data files
+        workers - parsing processes for the 'copy' method, default one per core
+        bulk_options - batch_size / method passed to BulkWriter ('copy' on PostgreSQL)
+
+    Returns:
+        dict of staging table -> rows loaded
+    """
+    if bulk_options.get('method') != 'copy':
+        rows = {'staging_songs': load_files(cur, json_files(song_dir), staging_songs_insert, SONG_FIELDS, **bulk_options),
+                'staging_events': load_files(cur, json_files(log_dir), staging_events_insert, EVENT_FIELDS, **bulk_options)}
+        conn.commit()
+        return rows
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        rows = {'staging_songs': copy_files(cur, pool, workers, json_files(song_dir), staging_songs_insert, SONG_FIELDS),
+                'staging_events': copy_files(cur, pool, workers, json_files(log_dir), staging_events_insert, EVENT_FIELDS)}
+    conn.commit()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load local song_data / log_data JSON into the staging tables')
+    parser.add_argument('song_dir')
+    parser.add_argument('log_dir')
+    parser.add_argument('--dsn', default=os.environ.get('SPARKIFY_BENCH_DSN', 'dbname=sparkify_bench'),
+                        help='PostgreSQL connection string (env SPARKIFY_BENCH_DSN)')
+    parser.add_argument('--workers', type=int, help='parsing processes, default one per core')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    try:
+        print(load_local_staging(conn.cursor(), conn, args.song_dir, args.log_dir, args.workers, method='copy'))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+import re
+import json
+import random
+import psycopg2
+from s3_manifest import split_s3_url, run_copies
+from sql_queries import (staging_events_table_create, staging_songs_table_create, staging_events_columns,
+                         noload_check_queries, copy_maxerror, server_time_select, stl_load_errors_select)
+
+# Source objects parsed locally per staging table
+PREFLIGHT_SAMPLE = 20
+# Problems printed per file
+MAX_REPORTED = 5
+# Redshift stores text as varchar(256)
+TEXT_WIDTH = 256
+INT_TYPES = {'int', 'integer', 'int4', 'smallint', 'int2', 'bigint', 'int8'}
+INT_RANGE = {'smallint': 2 ** 15, 'int2': 2 ** 15, 'bigint': 2 ** 63, 'int8': 2 ** 63}
+NUMERIC_TYPES = {'float', 'float4', 'float8', 'real', 'double', 'numeric', 'decimal'}
+
+COLUMN = re.compile(r'^\s*(\w+)\s+(\w+)(?:\((\d+)\))?', re.MULTILINE)
+JSONPATH = re.compile(r"""^\$(?:\[['"](.+)['"]\]|\.(\w+))$""")
+
+
+class PreflightError(Exception):
+    """
+    Description:
+        Raised when the source data exceeds the error budget before the COPY.
+    """
+
+
+def staging_columns(ddl):
+    """
+    Description:
+        Column name -> (type, width) of a staging CREATE TABLE.  text is sized like
+        Redshift stores it (varchar(256)).
+    """
+    columns = {}
+    for name, data_type, width in COLUMN.findall(ddl[ddl.index('(') + 1:]):
+        data_type = data_type.lower()
+        columns[name.lower()] = (data_type, int(width) if width else TEXT_WIDTH if data_type == 'text' else None)
+    return columns
+
+
+def jsonpath_fields(jsonpaths):
+    """
+    Description:
+        JSON field of every path in a jsonpaths document, e.g. $['artist'] -> artist.
+    """
+    fields = []
+    for path in jsonpaths['jsonpaths']:
+        match = JSONPATH.match(path)
+        if match is None:
+            raise PreflightError('Unsupported jsonpath {}'.format(path))
+        fields.append(match.group(1) or match.group(2))
+    return fields
+
+
+def column_mappings(jsonpaths):
+    """
+    Description:
+        (column, JSON field, type, width) per staging table, as the COPYs map them:
+        staging_events through the jsonpaths file, staging_songs with 'auto' by name.
+    """
+    columns = [c.strip().lower() for c in staging_events_columns.split(',')]
+    fields = jsonpath_fields(jsonpaths)
+    if len(fields) != len(columns):
+        raise PreflightError('jsonpaths has {} paths for the {} staging_events columns'.format(len(fields), len(columns)))
+
+    events = staging_columns(staging_events_table_create)
+    songs = staging_columns(staging_songs_table_create)
+    return {'staging_events': [(c, f) + events[c] for c, f in zip(columns, fields)],
+            'staging_songs': [(c, c) + songs[c] for c in songs]}
+
+
+def check_value(value, data_type, width):
+    """
+    Returns:
+        what COPY would reject in value for a column of data_type, or None
+    """
+    if value is None or value == '':
+        return None
+    if data_type in INT_TYPES:
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return 'not a number: {!r}'.format(value)
+        limit = INT_RANGE.get(data_type, 2 ** 31)
+        if isinstance(value, bool) or number != int(number) or not -limit <= number < limit:
+            return 'not a {}: {!r}'.format(data_type, value)
+    elif data_type in NUMERIC_TYPES:
+        try:
+            float(value)
+        except (TypeError, ValueError):
+            return 'not a number: {!r}'.format(value)
+    elif width is not None:
+        text = value if isinstance(value, str) else json.dumps(value)
+        if len(text.encode('utf-8')) > width:
+            return 'longer than {} bytes'.format(width)
+    return None
+
+
+def iter_documents(text):
+    """
+    Description:
+        JSON documents in a source file, one per line or spanning lines, as COPY JSON
+        reads them.  Yields (line number, document, error); after invalid JSON the
+        parser resumes at the next line.
+    """
+    decoder = json.JSONDecoder()
+    pos = 0
+    while True:
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+        if pos >= len(text):
+            return
+        line = text.count('\n', 0, pos) + 1
+        try:
+            document, pos = decoder.raw_decode(text, pos)
+            yield line, document, None
+        except ValueError as e:
+            yield line, None, 'invalid JSON: {}'.format(e.args[0].split(':')[0])
+            newline = text.find('\n', pos)
+            pos = len(text) if newline < 0 else newline + 1
+
+
+def validate_text(text, mapping):
+    """
+    Returns:
+        list of (line number, problem) of one source file
+    """
+    problems = []
+    for line, document, error in iter_documents(text):
+        if error:
+            problems.append((line, error))
+            continue
+        if not isinstance(document, dict):
+            problems.append((line, 'not a JSON object'))
+            continue
+        for column, field, data_type, width in mapping:
+            problem = check_value(document.get(field), data_type, width)
+            if problem:
+                problems.append((line, '{}: {}'.format(column, problem)))
+    return problems
+
+
+def sample_objects(objects, sample=PREFLIGHT_SAMPLE, rng=random):
+    keys = [key for key, _ in objects]
+    return keys if len(keys) <= sample else rng.sample(keys, sample)
+
+
+def validate_sample(s3, bucket, keys, mapping):
+    """
+    Description:
+        Download and validate sampled source objects.
+
+    Returns:
+        dict of bad key -> list of (line number, problem)
+    """
+    bad = {}
+    for key in keys:
+        text = s3.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8', 'replace')
+        problems = validate_text(text, mapping)
+        if problems:
+            bad[key] = problems
+    return bad
+
+
+def read_jsonpaths(s3, url):
+    bucket, key = split_s3_url(url)
+    return json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+
+
+def run_noload_checks(checks, cur=None, connection=None, error_budget=0):
+    """
+    Description:
+        Run the COPY ... NOLOAD checks with MAXERROR error_budget, concurrently when a
+        connection factory is given, and read back the rows each one rejected.
+
+    Arguments:
+        checks - dict of staging table -> NOLOAD COPY
+        cur - cursor used when connection is None
+        connection - context manager factory yielding (cur, conn), one per check
+        error_budget - rejected rows tolerated per staging table
+
+    Returns:
+        dict of staging table -> (error or None, list of (file, line, column, reason))
+    """
+    results = {}
+
+    def check(check_cur, table, sql):
+        check_cur.execute(server_time_select)
+        started = check_cur.fetchone()[0]
+        error = None
+        try:
+            check_cur.execute(sql.rstrip() + '\n' + copy_maxerror.format(error_budget))
+        except psycopg2.Error as e:
+            error = str(e).strip()
+        check_cur.execute(stl_load_errors_select, (started,))
+        results[table] = (error, check_cur.fetchall())
+
+    def execute(table, sql):
+        if connection is None:
+            check(cur, table, sql)
+            return
+        with connection() as (check_cur, check_conn):
+            check(check_cur, table, sql)
+
+    run_copies({table: [sql] for table, sql in checks.items()}, execute, concurrent=connection is not None)
+    return results
+
+
+def report(table, bad_files, load_errors):
+    for key, problems in sorted(bad_files.items()):
+        print('{}: bad file {} ({} problems)'.format(table, key, len(problems)))
+        for line, problem in problems[:MAX_REPORTED]:
+            print('    line {}: {}'.format(line, problem))
+    for filename, line, column, reason in load_errors[:MAX_REPORTED * 4]:
+        print('{}: NOLOAD rejected {} line {} column {}: {}'.format(table, filename, line, column, reason))
+
+
+def preflight(s3, sources, objects, jsonpaths, cur=None, connection=None, error_budget=0, noload=True,
+              sample=PREFLIGHT_SAMPLE, rng=random):
+    """
+    Description:
+        Validate the source data before the real COPY.  A sample of the source objects
+        is parsed locally against the staging columns and the jsonpaths mapping; when
+        that stays within the error budget, the NOLOAD checks run concurrently over the
+        whole S3 prefixes.  Bad files are reported either way.
+
+    Arguments:
+        s3 - boto3 S3 client
+        sources - dict of staging table -> s3:// prefix
+        objects - dict of staging table -> list of (key, size) to be loaded
+        jsonpaths - parsed jsonpaths document of staging_events
+        cur, connection - see run_noload_checks
+        error_budget - bad records tolerated per staging table
+        noload - also run the NOLOAD checks
+        sample - source objects validated locally per staging table
+
+    Returns:
+        dict of staging table -> {'sampled', 'bad_files', 'load_errors'}
+
+    Raises:
+        PreflightError when a staging table exceeds the error budget
+    """
+    mappings = column_mappings(jsonpaths)
+    results = {}
+    over_budget = []
+
+    for table, url in sources.items():
+        bucket, _ = split_s3_url(url)
+        keys = sample_objects(objects.get(table, []), sample, rng)
+        bad_files = validate_sample(s3, bucket, keys, mappings[table])
+        results[table] = {'sampled': len(keys), 'bad_files': bad_files, 'load_errors': []}
+        report(table, bad_files, [])
+        print('{}: {} of {} sampled files bad'.format(table, len(bad_files), len(keys)))
+        if sum(len(p) for p in bad_files.values()) > error_budget:
+            over_budget.append(table)
+
+    if over_budget:
+        raise PreflightError('Sampled source files of {} exceed the error budget of {}'.format(
+            ', '.join(over_budget), error_budget))
+
+    if noload:
+        checks = {table: noload_check_queries[table] for table in sources}
+        for table, (error, load_errors) in run_noload_checks(checks, cur, connection, error_budget).items():
+            results[table]['load_errors'] = load_errors
+            report(table, {}, load_errors)
+            print('{}: NOLOAD check {} rejected rows'.format(table, len(load_errors)))
+            if error is not None or len(load_errors) > error_budget:
+                over_budget.append(table)
+
+    if over_budget:
+        raise PreflightError('NOLOAD checks of {} exceed the error budget of {}'.format(
+            ', '.join(over_budget), error_budget))
+
+    return results
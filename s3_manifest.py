@@ -0,0 +1,142 @@
+import json
+import math
+import time
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+
+# Slices per node by node type; COPY loads one file per slice at a time
+SLICES_PER_NODE = {
+    'dc1.large': 2, 'dc1.8xlarge': 32,
+    'dc2.large': 2, 'dc2.8xlarge': 16,
+    'ds2.xlarge': 2, 'ds2.8xlarge': 16,
+    'ra3.xlplus': 2, 'ra3.4xlarge': 4, 'ra3.16xlarge': 16,
+}
+DEFAULT_SLICES_PER_NODE = 2
+
+
+def split_s3_url(url):
+    """
+    Description:
+        Split a (possibly quoted) s3://bucket/prefix url from the config.
+
+    Returns:
+        bucket, prefix
+    """
+    path = url.strip().strip("'\"")[len('s3://'):]
+    bucket, _, prefix = path.partition('/')
+    return bucket, prefix
+
+
+def slice_count(config):
+    """
+    Description:
+        Number of slices of the cluster from DWH_NUM_NODES and DWH_NODE_TYPE.
+    """
+    nodes = config.getint('DWH', 'DWH_NUM_NODES', fallback=1)
+    node_type = config.get('DWH', 'DWH_NODE_TYPE', fallback='').strip().lower()
+    return max(1, nodes) * SLICES_PER_NODE.get(node_type, DEFAULT_SLICES_PER_NODE)
+
+
+def list_objects(s3, url):
+    """
+    Description:
+        All objects under an s3:// prefix.
+
+    Returns:
+        list of (key, size)
+    """
+    bucket, prefix = split_s3_url(url)
+    objects = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        objects.extend((o['Key'], o['Size']) for o in page.get('Contents', []) if not o['Key'].endswith('/'))
+    return objects
+
+
+def balance(objects, slices, max_rounds=None):
+    """
+    Description:
+        Group objects into COPY manifests for a cluster with slices slices.  COPY loads
+        one file per slice at a time, so the files are taken largest first in rounds of
+        slices files of similar size, and every manifest holds whole rounds, a multiple of
+        the slice count, except the one that gets the last, partial round.  By default
+        all files go to one manifest, one COPY loading on every slice.  With max_rounds
+        the rounds are dealt to several manifests in snake order (1..n, n..1, ...), so
+        the manifests are of similar total size.
+
+    Arguments:
+        objects - list of (key, size)
+        slices - slice count of the cluster
+        max_rounds - rounds of files in one manifest, None for a single manifest
+
+    Returns:
+        list of manifests, each a list of (key, size)
+    """
+    if not objects:
+        return []
+
+    ordered = sorted(objects, key=lambda o: (-o[1], o[0]))
+    rounds = [ordered[i:i + slices] for i in range(0, len(ordered), slices)]
+    groups = 1 if max_rounds is None else math.ceil(len(rounds) / max_rounds)
+    manifests = [[] for _ in range(groups)]
+    for i, files in enumerate(rounds):
+        rnd, pos = divmod(i, groups)
+        manifests[pos if rnd % 2 == 0 else groups - 1 - pos].extend(files)
+    return manifests
+
+
+def manifest_document(bucket, objects):
+    return {'entries': [{'url': 's3://{}/{}'.format(bucket, key), 'mandatory': True,
+                         'meta': {'content_length': size}} for key, size in objects]}
+
+
+def upload_manifests(s3, bucket, manifests, manifest_url, name):
+    """
+    Description:
+        Write manifests as JSON objects under manifest_url.
+
+    Arguments:
+        s3 - boto3 S3 client
+        bucket - bucket of the source objects
+        manifests - output of balance()
+        manifest_url - s3://bucket/prefix where the manifests are written
+        name - manifest file name prefix, e.g. the staging table
+
+    Returns:
+        list of quoted s3:// urls of the manifests, ready for COPY ... MANIFEST
+    """
+    target_bucket, prefix = split_s3_url(manifest_url)
+    run = dt.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+    urls = []
+    for i, objects in enumerate(manifests):
+        key = '{}/{}-{}-{:03d}.manifest'.format(prefix.rstrip('/'), name, run, i).lstrip('/')
+        s3.put_object(Bucket=target_bucket, Key=key, Body=json.dumps(manifest_document(bucket, objects)).encode('utf-8'))
+        urls.append("'s3://{}/{}'".format(target_bucket, key))
+    return urls
+
+
+def run_copies(copies, execute, concurrent=True):
+    """
+    Description:
+        Issue the COPY statements of several staging tables, one thread per table
+        when concurrent, the statements of one table in order.
+
+    Arguments:
+        copies - dict of table -> list of COPY statements
+        execute - callable (table, sql) running one COPY, e.g. on its own connection
+        concurrent - run the tables at the same time
+
+    Returns:
+        dict of table -> seconds
+    """
+    def run_table(table):
+        start = time.perf_counter()
+        for sql in copies[table]:
+            execute(table, sql)
+        return time.perf_counter() - start
+
+    if not concurrent or len(copies) < 2:
+        return {table: run_table(table) for table in copies}
+
+    with ThreadPoolExecutor(max_workers=len(copies)) as pool:
+        futures = {table: pool.submit(run_table, table) for table in copies}
+        return {table: future.result() for table, future in futures.items()}
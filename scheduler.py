@@ -0,0 +1,167 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Stage:
+    """
+    Description:
+        One unit of work in the load DAG.
+
+    Arguments:
+        name - unique stage name
+        func - callable taking (cur, conn)
+        deps - names of the stages that must finish before this one starts
+    """
+
+    def __init__(self, name, func, deps=()):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.started = None
+        self.finished = None
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+
+def check_graph(stages):
+    """
+    Description:
+        Validate stage names and dependencies, and reject cycles.
+    """
+    by_name = {}
+    for stage in stages:
+        if stage.name in by_name:
+            raise ValueError('Duplicate stage {}'.format(stage.name))
+        by_name[stage.name] = stage
+
+    for stage in stages:
+        for dep in stage.deps:
+            if dep not in by_name:
+                raise ValueError('Stage {} depends on unknown stage {}'.format(stage.name, dep))
+
+    visiting, done = set(), set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError('Dependency cycle through stage {}'.format(name))
+        visiting.add(name)
+        for dep in by_name[name].deps:
+            visit(dep)
+        visiting.discard(name)
+        done.add(name)
+
+    for name in by_name:
+        visit(name)
+
+    return by_name
+
+
+def close_connection(cur, conn):
+    cur.close()
+    conn.close()
+
+
+def run_stage(stage, connect, release=close_connection):
+    """
+    Description:
+        Run one stage on its own connection.
+    """
+    cur, conn = connect()
+    try:
+        stage.started = time.perf_counter()
+        stage.func(cur, conn)
+        stage.finished = time.perf_counter()
+    finally:
+        release(cur, conn)
+    return stage
+
+
+def critical_path(stages):
+    """
+    Description:
+        Longest chain of dependent stages by duration.
+
+    Returns:
+        path  - list of stage names, first to last
+        total - sum of the durations along the path in seconds
+    """
+    by_name = {s.name: s for s in stages}
+    memo = {}
+
+    def longest(name):
+        if name not in memo:
+            stage = by_name[name]
+            best = max((longest(d) for d in stage.deps), key=lambda x: x[1], default=([], 0.0))
+            memo[name] = (best[0] + [name], best[1] + stage.duration)
+        return memo[name]
+
+    return max((longest(s.name) for s in stages), key=lambda x: x[1], default=([], 0.0))
+
+
+def run_stages(stages, connect, max_workers=4, release=close_connection):
+    """
+    Description:
+        Run the stages of a dependency graph, starting every stage as soon as its
+        dependencies are done.  Independent stages run concurrently on a thread pool,
+        each with its own connection.  Prints per-stage durations and the critical
+        path at the end of the run.
+
+    Arguments:
+        stages      - list of Stage
+        connect     - callable returning a new (cur, conn) pair
+        max_workers - maximum number of stages running at the same time
+        release     - callable (cur, conn) returning a connection, closes it by default
+
+    Returns:
+        dict of stage name -> duration in seconds
+    """
+    by_name = check_graph(stages)
+    pending = dict(by_name)
+    done = set()
+    running = {}
+    failure = None
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            if failure is None:
+                for name, stage in list(pending.items()):
+                    if all(d in done for d in stage.deps):
+                        print('start stage {}'.format(name))
+                        running[pool.submit(run_stage, stage, connect, release)] = name
+                        del pending[name]
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    done.add(name)
+                    print('done  stage {} ({:.2f}s)'.format(name, by_name[name].duration))
+                except Exception as e:
+                    print('Error: stage {} failed'.format(name))
+                    print(e)
+                    if failure is None:
+                        failure = e
+
+    if failure is not None:
+        raise failure
+
+    elapsed = time.perf_counter() - started
+    path, total = critical_path(stages)
+
+    print('\nStage durations:')
+    for stage in stages:
+        print('    {:<16} {:8.2f}s'.format(stage.name, stage.duration))
+    print('Critical path: {} ({:.2f}s of {:.2f}s wall time)'.format(' -> '.join(path), total, elapsed))
+
+    return {s.name: s.duration for s in stages}
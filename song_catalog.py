@@ -0,0 +1,189 @@
+import os
+import csv
+import json
+import hashlib
+import numpy as np
+from sql_queries import staging_songs_catalog_select, staging_songs_fingerprint
+
+# Bump when the on-disk layout changes; caches with another version are rebuilt.
+FORMAT_VERSION = 1
+DEFAULT_CACHE_DIR = '.song_catalog'
+DURATION_TOLERANCE = 1.0
+
+ARRAYS = ('hashes', 'durations', 'song_ids', 'artist_ids')
+
+
+def title_hash(title):
+    """
+    Description:
+        Stable 64-bit hash of a song title (exact text, same as the title join).
+    """
+    return int.from_bytes(hashlib.blake2b(title.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def file_fingerprint(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return 'sha1:' + digest.hexdigest()
+
+
+def staging_fingerprint(cur):
+    cur.execute(staging_songs_fingerprint)
+    return 'staging:' + ':'.join(str(v) for v in cur.fetchone())
+
+
+class SongCatalog:
+    """
+    Description:
+        Compact song catalog for resolving (title, length) events to songs.  Rows are
+        kept in parallel arrays sorted by (title hash, duration), so a lookup is a
+        hash probe (searchsorted) plus a bisect on the durations of that title.
+        Arrays are memory-mapped from the cache directory.
+
+    Arguments:
+        hashes, durations, song_ids, artist_ids - parallel numpy arrays
+    """
+
+    def __init__(self, hashes, durations, song_ids, artist_ids):
+        self.hashes = hashes
+        self.durations = durations
+        self.song_ids = song_ids
+        self.artist_ids = artist_ids
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Description:
+            Build from (artist_id, song_id, title, duration, year) rows, the shape of
+            songs.csv and staging_songs_catalog_select.
+        """
+        rows = [r for r in rows if r[2] is not None and r[3] not in (None, '')]
+        hashes = np.array([title_hash(r[2]) for r in rows], dtype='uint64')
+        durations = np.array([float(r[3]) for r in rows], dtype='float64')
+        song_ids = np.array([r[1] or '' for r in rows], dtype='S')
+        artist_ids = np.array([r[0] or '' for r in rows], dtype='S')
+
+        order = np.lexsort((durations, hashes))
+        return cls(hashes[order], durations[order], song_ids[order], artist_ids[order])
+
+    def lookup(self, title, length):
+        """
+        Description:
+            Song whose title equals title and whose duration is within
+            DURATION_TOLERANCE of length; the closest one if several match.
+
+        Returns:
+            (song_id, artist_id) or None
+        """
+        if title is None or length is None:
+            return None
+
+        h = np.uint64(title_hash(title))
+        lo = int(np.searchsorted(self.hashes, h, side='left'))
+        hi = int(np.searchsorted(self.hashes, h, side='right'))
+        if lo == hi:
+            return None
+
+        length = float(length)
+        i = lo + int(np.searchsorted(self.durations[lo:hi], length))
+        best = None
+        for j in (i - 1, i):
+            if lo <= j < hi:
+                delta = abs(self.durations[j] - length)
+                if delta < DURATION_TOLERANCE and (best is None or delta < best[0]):
+                    best = (delta, j)
+        if best is None:
+            return None
+
+        j = best[1]
+        return self.song_ids[j].decode('utf-8'), self.artist_ids[j].decode('utf-8')
+
+    def save(self, cache_dir, source, fingerprint):
+        """
+        Description:
+            Write the arrays as .npy files and a manifest with the format version and
+            source fingerprint used for invalidation.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(cache_dir, name + '.npy'), getattr(self, name))
+
+        manifest = {'format_version': FORMAT_VERSION, 'source': source,
+                    'fingerprint': fingerprint, 'rows': len(self)}
+        with open(os.path.join(cache_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    @classmethod
+    def open(cls, cache_dir, fingerprint=None):
+        """
+        Description:
+            Memory-map a saved catalog.
+
+        Returns:
+            SongCatalog, or None if there is no cache, it has another format version,
+            or its fingerprint differs from the given one.
+        """
+        try:
+            with open(os.path.join(cache_dir, 'manifest.json')) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if manifest.get('format_version') != FORMAT_VERSION:
+            return None
+        if fingerprint is not None and manifest.get('fingerprint') != fingerprint:
+            return None
+
+        # an empty .npy file cannot be memory-mapped
+        mmap_mode = 'r' if manifest.get('rows') else None
+        try:
+            arrays = [np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode=mmap_mode) for name in ARRAYS]
+        except (OSError, ValueError):
+            return None
+        return cls(*arrays)
+
+
+def catalog_from_csv(path='songs.csv', cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Description:
+        Song catalog built from a songs.csv snapshot
+        (artist_id, song_id, title, duration, year without header), cached on disk.
+
+    Returns:
+        SongCatalog
+    """
+    fingerprint = file_fingerprint(path)
+    catalog = SongCatalog.open(cache_dir, fingerprint)
+    if catalog is None:
+        print('Building song catalog from {}'.format(path))
+        with open(path, newline='', encoding='utf-8') as f:
+            SongCatalog.from_rows(csv.reader(f)).save(cache_dir, path, fingerprint)
+        catalog = SongCatalog.open(cache_dir, fingerprint)
+    return catalog
+
+
+def catalog_from_staging(cur, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Description:
+        Song catalog built from staging_songs, cached on disk and rebuilt only when
+        the staging_songs fingerprint changes.
+
+    Arguments:
+        cur - cursor of the database connection
+
+    Returns:
+        SongCatalog
+    """
+    fingerprint = staging_fingerprint(cur)
+    catalog = SongCatalog.open(cache_dir, fingerprint)
+    if catalog is None:
+        print('Building song catalog from staging_songs')
+        cur.execute(staging_songs_catalog_select)
+        SongCatalog.from_rows(cur.fetchall()).save(cache_dir, 'staging_songs', fingerprint)
+        catalog = SongCatalog.open(cache_dir, fingerprint)
+    return catalog
@@ -4,16 +4,38 @@ import configparser
 # CONFIG
 config = configparser.ConfigParser()
 config.read('dwh.cfg')
+# Without dwh.cfg (local PostgreSQL runs, benchmarks) the S3 COPY statements are
+# rendered with empty sources, and the [DWH] settings below keep their defaults.
+
+# start_time of songplay / time: 'text' (ISO 8601) or 'timestamp', see ddl_advisor.py
+START_TIME_TYPE = config.get('DWH', 'START_TIME_TYPE', fallback='text').strip().lower()
+
+# Grain of the calendar time dimension.  songplay.time_key = floor(ts / grain in ms);
+# changing the grain of a loaded warehouse requires a full refresh.
+TIME_GRAINS = {'minute': 60 * 1000, 'hour': 60 * 60 * 1000, 'day': 24 * 60 * 60 * 1000}
+TIME_GRAIN = config.get('DWH', 'TIME_GRAIN', fallback='hour').strip().lower()
+TIME_GRAIN_MS = TIME_GRAINS[TIME_GRAIN]
 
 # DROP TABLES
 
 staging_events_table_drop = "DROP TABLE IF EXISTS staging_events"
 staging_songs_table_drop = "DROP TABLE IF EXISTS staging_songs"
+staging_song_match_table_drop = "DROP TABLE IF EXISTS staging_song_match"
 songplay_table_drop = "DROP TABLE IF EXISTS songplay"
 users_table_drop = "DROP TABLE IF EXISTS users"
 songs_table_drop = "DROP TABLE IF EXISTS songs"
 artists_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+etl_watermark_table_drop = "DROP TABLE IF EXISTS etl_watermark"
+etl_loaded_files_table_drop = "DROP TABLE IF EXISTS etl_loaded_files"
+etl_staged_files_table_drop = "DROP TABLE IF EXISTS etl_staged_files"
+agg_daily_plays_table_drop = "DROP TABLE IF EXISTS agg_daily_plays"
+agg_daily_song_plays_table_drop = "DROP TABLE IF EXISTS agg_daily_song_plays"
+agg_daily_artist_plays_table_drop = "DROP TABLE IF EXISTS agg_daily_artist_plays"
+agg_daily_level_plays_table_drop = "DROP TABLE IF EXISTS agg_daily_level_plays"
+agg_hourly_plays_table_drop = "DROP TABLE IF EXISTS agg_hourly_plays"
+quarantine_staging_events_table_drop = "DROP TABLE IF EXISTS quarantine_staging_events"
+quarantine_staging_songs_table_drop = "DROP TABLE IF EXISTS quarantine_staging_songs"
 
 # CREATE TABLES
 
@@ -36,7 +58,8 @@ staging_events_table_create = ("""
       status            int,  
       ts                numeric,
       userAgent         text,                             
-      userid            int
+      userid            int,
+      match_key         varchar(48)
 	);
 """)
 
@@ -55,10 +78,28 @@ staging_songs_table_create = ("""
 	);
 """)
 
+#   staging_songs expanded to one row per neighbouring duration bucket, so that
+#   events can be matched to songs with an equi-join on match_key (see SONG MATCHING)
+staging_song_match_table_create = ("""
+    CREATE TABLE staging_song_match (
+      match_key         varchar(48)   distkey,
+      song_id           text,
+      title             text,
+      duration          float,
+      year              int,
+      artist_id         varchar(18),
+      artist_name       text,
+      artist_location   text,
+      artist_latitude   float,
+      artist_longitude  float
+    ) sortkey (match_key);
+""")
+
 songplay_table_create = ("""
 	CREATE TABLE songplay (
 	  songplay_id BIGINT IDENTITY(0,1) PRIMARY KEY, 
-	  start_time  text   NOT NULL, 
+	  start_time  {}   NOT NULL, 
+	  time_key    int    NOT NULL, 
 	  user_id     int    NOT NULL, 
 	  level       text, 
 	  song_id     text   NOT NULL, 
@@ -67,7 +108,7 @@ songplay_table_create = ("""
       location    text, 
       user_agent  text
     );
-""")
+""").format(START_TIME_TYPE)
 
 users_table_create = ("""
 	CREATE TABLE users (
@@ -99,29 +140,121 @@ artists_table_create = ("""
     ) diststyle all;   
 """)
 
+#   Calendar time dimension: one row per TIME_GRAIN period over whole days, start_time
+#   is the start of the period.  songplay references it through time_key.
 time_table_create = ("""
 	CREATE TABLE time (
-	   start_time  text PRIMARY KEY, 
+	   time_key    int  PRIMARY KEY, 
+	   start_time  {}   NOT NULL, 
        hour        int  NOT NULL,
        day         int  NOT NULL, 
        week        int  NOT NULL, 
        month       int  NOT NULL, 
        year        int  NOT NULL, 
        weekday     int
-    );     
+    ) diststyle all sortkey (time_key);     
+""").format(START_TIME_TYPE)
+
+# CONTROL TABLES
+#   High-water marks and the set of S3 keys already ingested, used by incremental runs.
+#   Event log keys are first kept in etl_staged_files by the staging step and only move to
+#   etl_loaded_files with the watermark, after the tables are loaded, so the events of a
+#   failed run are staged again by the next one.  staging_songs keeps the songs of earlier
+#   runs, so song keys are recorded as loaded in the transaction of their COPY.
+
+etl_watermark_table_create = ("""
+    CREATE TABLE IF NOT EXISTS etl_watermark (
+       source      varchar(32) PRIMARY KEY,
+       max_ts      bigint,
+       updated_at  timestamp
+    );
+""")
+
+etl_loaded_files_table_create = ("""
+    CREATE TABLE IF NOT EXISTS etl_loaded_files (
+       source      varchar(32)   NOT NULL,
+       s3_key      varchar(1024) NOT NULL,
+       loaded_at   timestamp
+    );
+""")
+
+etl_staged_files_table_create = ("""
+    CREATE TABLE IF NOT EXISTS etl_staged_files (
+       source      varchar(32)   NOT NULL,
+       s3_key      varchar(1024) NOT NULL,
+       staged_at   timestamp
+    );
+""")
+
+control_tables_exist = ("""
+    SELECT COUNT(*) FROM information_schema.tables
+        WHERE table_name IN ('etl_watermark', 'etl_loaded_files', 'etl_staged_files')
+""")
+
+etl_loaded_files_select = ("""
+    SELECT s3_key FROM etl_loaded_files WHERE source = %s
 """)
 
+etl_loaded_files_insert = ("""
+    INSERT INTO etl_loaded_files (source, s3_key, loaded_at) VALUES (%s, %s, %s)
+""")
+
+etl_loaded_files_delete = ("""
+    DELETE FROM etl_loaded_files WHERE source = %s
+""")
+
+etl_staged_files_insert = ("""
+    INSERT INTO etl_staged_files (source, s3_key, staged_at) VALUES (%s, %s, %s)
+""")
+
+etl_staged_files_delete = ("""
+    DELETE FROM etl_staged_files WHERE source = %s
+""")
+
+etl_staged_files_promote = ("""
+    INSERT INTO etl_loaded_files (source, s3_key, loaded_at)
+        SELECT source, s3_key, %s FROM etl_staged_files WHERE source = %s
+""")
+
+etl_watermark_select = ("""
+    SELECT max_ts FROM etl_watermark WHERE source = %s
+""")
+
+etl_watermark_delete = ("""
+    DELETE FROM etl_watermark WHERE source = %s
+""")
+
+etl_watermark_insert = ("""
+    INSERT INTO etl_watermark (source, max_ts, updated_at) VALUES (%s, %s, %s)
+""")
+
+staging_events_max_ts = ("""
+    SELECT MAX(ts) FROM staging_events
+""")
+
+staging_events_truncate = "TRUNCATE staging_events"
+
+#   A full run empties the staging tables before its COPYs, so a resumed staging step
+#   does not load the files twice
+staging_events_delete = "DELETE FROM staging_events"
+staging_songs_delete = "DELETE FROM staging_songs"
+
 
 # STAGING TABLES
+#   staging_events.match_key is not in the source files, so the event COPYs name their columns.
+
+staging_events_columns = ("artist, auth, firstName, gender, itemInSession, lastName, length, level, location, "
+                          "method, page, registration, sessionid, song, status, ts, userAgent, userid")
 
 staging_events_copy = ("""        
-    COPY     staging_events   
+    COPY     staging_events ({})
     FROM     {}               
     IAM_ROLE {}               
     JSON     {}               
-""").format(config['S3']['LOG_DATA'],
-            config['IAM_ROLE']['ARN'],
-            config['S3']['LOG_JSONPATH']
+""").format(staging_events_columns,
+            config.get('S3', 'LOG_DATA', fallback="''"),
+            config.get('IAM_ROLE', 'ARN', fallback="''"),
+            config.get('S3', 'LOG_JSONPATH', fallback="''")
             )
 
 staging_songs_copy = ("""    
@@ -129,17 +262,18 @@ staging_songs_copy = ("""
      FROM     {}             
      IAM_ROLE {}             
      JSON     'auto'
-""").format(config['S3']['SONG_DATA'], config['IAM_ROLE']['ARN'])
+""").format(config.get('S3', 'SONG_DATA', fallback="''"), config.get('IAM_ROLE', 'ARN', fallback="''"))
 
 staging_events_data_check = ("""        
-    COPY     staging_events   
+    COPY     staging_events ({})
     FROM     {}               
     IAM_ROLE {}               
     JSON     {}   
     NOLOAD
-""").format(config['S3']['LOG_DATA'],
-            config['IAM_ROLE']['ARN'],
-            config['S3']['LOG_JSONPATH']
+""").format(staging_events_columns,
+            config.get('S3', 'LOG_DATA', fallback="''"),
+            config.get('IAM_ROLE', 'ARN', fallback="''"),
+            config.get('S3', 'LOG_JSONPATH', fallback="''")
             )
 
 staging_songs_data_check = ("""    
@@ -148,13 +282,117 @@ staging_songs_data_check = ("""
      IAM_ROLE {}             
      JSON     'auto'
      NOLOAD
-""").format(config['S3']['SONG_DATA'], config['IAM_ROLE']['ARN'])
+""").format(config.get('S3', 'SONG_DATA', fallback="''"), config.get('IAM_ROLE', 'ARN', fallback="''"))
+
+#   Pre-flight (preflight.py): the NOLOAD checks run with MAXERROR set to the error budget,
+#   the rejected rows of the session are read back from stl_load_errors.
+
+copy_maxerror = """    MAXERROR {}
+"""
+
+server_time_select = "SELECT getdate()"
+
+stl_load_errors_select = ("""
+    SELECT TRIM(filename), line_number, TRIM(colname), TRIM(err_reason)
+        FROM stl_load_errors
+        WHERE session = pg_backend_pid() AND starttime >= %s
+        ORDER BY filename, line_number
+""")
+
+noload_check_queries = {'staging_events': staging_events_data_check, 'staging_songs': staging_songs_data_check}
+
+#   Single-object COPYs used by incremental runs; format with the quoted s3:// url.
+#   A key prefix works as well, e.g. the date windows of staging_windows.py.
+
+staging_events_copy_key = ("""
+    COPY     staging_events ({})
+    FROM     {{}}
+    IAM_ROLE {}
+    JSON     {}
+""").format(staging_events_columns, config.get('IAM_ROLE', 'ARN', fallback="''"), config.get('S3', 'LOG_JSONPATH', fallback="''"))
+
+staging_songs_copy_key = ("""
+     COPY     staging_songs
+     FROM     {{}}
+     IAM_ROLE {}
+     JSON     'auto'
+""").format(config.get('IAM_ROLE', 'ARN', fallback="''"))
+
+#   Rows loaded by the last COPY of the session (Redshift)
+last_copy_count = "SELECT pg_last_copy_count()"
+
+#   Client side staging loads (local_ingest.py), same column order as the COPYs.
+
+staging_events_insert = ("""
+    INSERT INTO staging_events ({}) VALUES ({})
+""").format(staging_events_columns, ', '.join(['%s'] * len(staging_events_columns.split(','))))
+
+staging_songs_insert = ("""
+    INSERT INTO staging_songs (num_songs, artist_id, artist_latitude, artist_longitude, artist_location,
+                               artist_name, song_id, title, duration, year)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+""")
+
+#   COPYs through generated manifests (s3_manifest.py); format with the quoted manifest url.
+
+staging_events_copy_manifest = ("""
+    COPY     staging_events ({})
+    FROM     {{}}
+    IAM_ROLE {}
+    JSON     {}
+    MANIFEST
+""").format(staging_events_columns, config.get('IAM_ROLE', 'ARN', fallback="''"),
+            config.get('S3', 'LOG_JSONPATH', fallback="''"))
+
+staging_songs_copy_manifest = ("""
+     COPY     staging_songs
+     FROM     {{}}
+     IAM_ROLE {}
+     JSON     'auto'
+     MANIFEST
+""").format(config.get('IAM_ROLE', 'ARN', fallback="''"))
+
+# SONG MATCHING
+#   Events match a song when title == song and abs(duration - length) < 1.0.  The match key
+#   is md5(title) plus a 1 second duration bucket.  Two values less than 1 second apart
+#   fall into the same or adjacent buckets, so each song is keyed into its own bucket and
+#   both neighbours.  The equi-join on match_key (hash join, co-located by distkey) finds
+#   every candidate, and the residual title / duration predicate keeps today's semantics.
+#   Normalizing the title or adding the artist name would change which events match, so
+#   the key uses the exact title only.
+
+song_match_key = "md5({}) || ':' || CAST(CAST(floor({}) AS int) + {} AS varchar)"
+
+staging_events_match_key_update = ("""
+    UPDATE staging_events
+        SET match_key = {}
+        WHERE match_key IS NULL
+""").format(song_match_key.format('song', 'length', 0))
+
+staging_song_match_truncate = "TRUNCATE staging_song_match"
+staging_song_match_delete = "DELETE FROM staging_song_match"
+
+staging_song_match_insert = ("""
+    INSERT INTO staging_song_match (match_key, song_id, title, duration, year, artist_id,
+                                    artist_name, artist_location, artist_latitude, artist_longitude)
+    SELECT {}, ss.song_id, ss.title, ss.duration, ss.year, ss.artist_id,
+           ss.artist_name, ss.artist_location, ss.artist_latitude, ss.artist_longitude
+        FROM staging_songs ss
+        CROSS JOIN (SELECT -1 AS bucket_offset UNION ALL SELECT 0 UNION ALL SELECT 1) b
+        WHERE ss.title IS NOT NULL AND ss.duration IS NOT NULL
+""").format(song_match_key.format('ss.title', 'ss.duration', 'b.bucket_offset'))
+
+#   staging_events se joined to the matching songs as ss; append further predicates with AND
+song_match_join = """staging_events se
+        JOIN staging_song_match ss ON se.match_key = ss.match_key
+        WHERE se.song = ss.title
+          AND abs(ss.duration - se.length) <1.0"""
 
 # FINAL TABLES
 
 songplay_table_insert = ("""
-	INSERT INTO songplay (start_time, user_id, level, song_id, artist_id, 
-                           session_id, location, user_agent) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)   
+	INSERT INTO songplay (start_time, time_key, user_id, level, song_id, artist_id, 
+                           session_id, location, user_agent) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)   
 """)
 
 users_table_insert = ("""
@@ -171,35 +409,488 @@ artists_table_insert = ("""
 """)
 
 time_table_insert = ("""
-	INSERT INTO time (start_time, hour, day, week, month, year, weekday) VALUES (%s, %s, %s, %s, %s, %s, %s)  
+	INSERT INTO time (time_key, start_time, hour, day, week, month, year, weekday) 
+         VALUES (%s, %s, %s, %s, %s, %s, %s, %s)  
+""")
+
+time_key_range = ("""
+    SELECT MIN(time_key), MAX(time_key) FROM time
+""")
+
+staging_events_ts_range = ("""
+    SELECT MIN(ts), MAX(ts) FROM staging_events
 """)
 
 artists_select = ("""
-        SELECT DISTINCT artist_id, artist_latitude, artist_longitude, artist_location, artist_name 
-            FROM staging_songs ss 
-            JOIN staging_events se   ON ss.title = se.song 
-	        WHERE abs(ss.duration - se.length) <1.0
-       """)
+        SELECT DISTINCT artist_id, artist_latitude, artist_longitude, artist_location, artist_name, song_id
+            FROM {}
+       """).format(song_match_join)
 songs_select = ("""
         SELECT DISTINCT artist_id, song_id, title, duration, year 
-            FROM staging_songs ss 
-            JOIN staging_events se   ON ss.title = se.song 
-	        WHERE abs(ss.duration - se.length) <1.0
-        """)
+            FROM {}
+        """).format(song_match_join)
 songplay_select = ("""
     SELECT se.ts, se.userid, se.level, ss.song_id, ss.artist_id, se.page, se.sessionid, se.location, se.useragent
-	FROM staging_events se 
-    JOIN staging_songs ss ON se.song = ss.title  
-	WHERE abs(ss.duration - se.length) <1.0
+	FROM {}
+""").format(song_match_join)
+
+#   Streaming fact load: page filter pushed into SQL, read through a server-side cursor
+songplay_select_next_song = ("""
+    SELECT se.ts, se.userid, se.level, ss.song_id, ss.artist_id, se.sessionid, se.location, se.useragent
+	FROM {}
+	  AND se.page = 'NextSong'
+""").format(song_match_join)
+
+#   Song catalog cache (song_catalog.py)
+staging_songs_catalog_select = ("""
+    SELECT artist_id, song_id, title, duration, year FROM staging_songs
+""")
+
+staging_songs_fingerprint = ("""
+    SELECT COUNT(*), COUNT(DISTINCT song_id), SUM(duration) FROM staging_songs
+""")
+
+staging_events_next_song = ("""
+    SELECT ts, userid, level, song, length, sessionid, location, useragent
+        FROM staging_events
+        WHERE page = 'NextSong'
+""")
+
+# PHYSICAL DESIGN PROFILE
+#   Cardinality, byte widths and value ranges of the loaded staging data (ddl_advisor.py).
+#   Widths are OCTET_LENGTH, as varchar(n) is sized in bytes on Redshift.
+
+staging_events_profile = ("""
+    SELECT COUNT(*)                                           AS row_count,
+           SUM(CASE WHEN page = 'NextSong' THEN 1 ELSE 0 END) AS next_song_rows,
+           MIN(ts)                                            AS ts_min,
+           MAX(ts)                                            AS ts_max,
+           COUNT(DISTINCT userid)                             AS userid_distinct,
+           MIN(userid)                                        AS userid_min,
+           MAX(userid)                                        AS userid_max,
+           COUNT(DISTINCT sessionid)                          AS sessionid_distinct,
+           MIN(sessionid)                                     AS sessionid_min,
+           MAX(sessionid)                                     AS sessionid_max,
+           COUNT(DISTINCT firstName)                          AS firstname_distinct,
+           MAX(OCTET_LENGTH(firstName))                       AS firstname_width,
+           COUNT(DISTINCT lastName)                           AS lastname_distinct,
+           MAX(OCTET_LENGTH(lastName))                        AS lastname_width,
+           COUNT(DISTINCT gender)                             AS gender_distinct,
+           MAX(OCTET_LENGTH(gender))                          AS gender_width,
+           COUNT(DISTINCT level)                              AS level_distinct,
+           MAX(OCTET_LENGTH(level))                           AS level_width,
+           COUNT(DISTINCT location)                           AS location_distinct,
+           MAX(OCTET_LENGTH(location))                        AS location_width,
+           COUNT(DISTINCT useragent)                          AS useragent_distinct,
+           MAX(OCTET_LENGTH(useragent))                       AS useragent_width
+        FROM staging_events
+""")
+
+staging_songs_profile = ("""
+    SELECT COUNT(*)                                           AS row_count,
+           COUNT(DISTINCT song_id)                            AS song_id_distinct,
+           MIN(OCTET_LENGTH(song_id))                         AS song_id_min_width,
+           MAX(OCTET_LENGTH(song_id))                         AS song_id_width,
+           COUNT(DISTINCT title)                              AS title_distinct,
+           MAX(OCTET_LENGTH(title))                           AS title_width,
+           COUNT(DISTINCT artist_id)                          AS artist_id_distinct,
+           MIN(OCTET_LENGTH(artist_id))                       AS artist_id_min_width,
+           MAX(OCTET_LENGTH(artist_id))                       AS artist_id_width,
+           COUNT(DISTINCT artist_name)                        AS artist_name_distinct,
+           MAX(OCTET_LENGTH(artist_name))                     AS artist_name_width,
+           COUNT(DISTINCT artist_location)                    AS artist_location_distinct,
+           MAX(OCTET_LENGTH(artist_location))                 AS artist_location_width,
+           MIN(year)                                          AS year_min,
+           MAX(year)                                          AS year_max
+        FROM staging_songs
+""")
+
+#   Share of the plays held by the most played song title: skew of a song_id distkey on songplay
+staging_events_song_skew = ("""
+    SELECT MAX(plays), SUM(plays)
+        FROM (SELECT COUNT(*) AS plays FROM staging_events
+                WHERE page = 'NextSong' AND song IS NOT NULL
+                GROUP BY song) t
+""")
+
+# SET-BASED TRANSFORMS
+#   Server side INSERT ... SELECT from the staging tables; used by etl.py in 'sql' mode.
+#   start_time is derived from the epoch-ms ts in the warehouse (UTC).  It is stored as
+#   ISO 8601 text, or as a timestamp with START_TIME_TYPE = timestamp in the [DWH] section
+#   (the type recommended by ddl_advisor.py).  The time dimension is not derived here: it
+#   is a calendar generated by etl.insert_time_table (time_dim.calendar).
+
+ts_to_timestamp = "(TIMESTAMP 'epoch' + {}::numeric / 1000.0 * INTERVAL '1 second')"
+ts_to_start_time = "to_char({}, 'YYYY-MM-DD\"T\"HH24:MI:SS.US')" if START_TIME_TYPE == 'text' else "{}"
+ts_to_time_key = "CAST(FLOOR({{}} / {}) AS int)".format(TIME_GRAIN_MS)
+
+songplay_table_transform = ("""
+    INSERT INTO songplay (start_time, time_key, user_id, level, song_id, artist_id,
+                          session_id, location, user_agent)
+    SELECT {start_time}, {time_key}, se.userid, se.level, ss.song_id, ss.artist_id,
+           se.sessionid, se.location, se.useragent
+        FROM {join}
+          AND se.page = 'NextSong'
+""").format(start_time=ts_to_start_time.format(ts_to_timestamp.format('se.ts')),
+            time_key=ts_to_time_key.format('se.ts'),
+            join=song_match_join)
+
+#   staging_events only holds the new files of an incremental run.  The event logs of a run
+#   that failed after its fact stage are staged again by the next run (see CONTROL TABLES),
+#   so plays already in songplay are skipped.
+songplay_table_incremental = songplay_table_transform.rstrip() + ("""
+          AND NOT EXISTS (SELECT 1 FROM songplay sp
+                            WHERE sp.time_key = {time_key} AND sp.user_id = se.userid
+                              AND sp.session_id = se.sessionid AND sp.start_time = {start_time})
+""").format(start_time=ts_to_start_time.format(ts_to_timestamp.format('se.ts')),
+            time_key=ts_to_time_key.format('se.ts'))
+
+#   Full runs rebuild the fact, a resumed songplay step starts again from an empty table
+songplay_table_delete = "DELETE FROM songplay"
+
+# DIMENSION UPSERTS
+#   users, songs and artists are upserted instead of appended, so each key has one row.
+#   A run stages its batch, deduplicated latest-wins, in a temp table <table>_stage, drops
+#   the staged rows equal to the target, then replaces the remaining (changed or new) keys
+#   with a delete+insert.  etl.upsert_dimension runs the steps in one transaction.
+#   Latest wins: users by ts; staging_songs has no load time, so songs / artists keep
+#   the most complete row.  The orders are total, with explicit NULL placement, so every
+#   run and every backend picks the same row, and the 'client' mode sorts the same way.
+#   Ties are broken on the remaining columns and finally on song_id.
+
+users_batch_select = ("""
+    SELECT userid, firstName, lastName, gender, level
+        FROM (SELECT userid, firstName, lastName, gender, level,
+                     ROW_NUMBER() OVER (PARTITION BY userid ORDER BY ts DESC, itemInSession DESC) AS latest
+                FROM staging_events
+                WHERE userid IS NOT NULL) e
+        WHERE latest = 1
+""")
+
+songs_batch_select = ("""
+    SELECT song_id, title, artist_id, year, duration
+        FROM (SELECT ss.song_id, ss.title, ss.artist_id, ss.year, ss.duration,
+                     ROW_NUMBER() OVER (PARTITION BY ss.song_id
+                                        ORDER BY ss.year DESC NULLS FIRST, ss.duration DESC NULLS FIRST,
+                                                 ss.title NULLS FIRST, ss.artist_id NULLS FIRST) AS latest
+                FROM {}) m
+        WHERE latest = 1
+""").format(song_match_join)
+
+artists_batch_select = ("""
+    SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+        FROM (SELECT ss.artist_id, ss.artist_name, ss.artist_location, ss.artist_latitude, ss.artist_longitude,
+                     ROW_NUMBER() OVER (PARTITION BY ss.artist_id
+                                        ORDER BY CASE WHEN ss.artist_latitude IS NULL THEN 1 ELSE 0 END,
+                                                 CASE WHEN ss.artist_location IS NULL OR ss.artist_location = '' THEN 1 ELSE 0 END,
+                                                 ss.artist_name NULLS LAST, ss.artist_location NULLS LAST,
+                                                 ss.artist_latitude NULLS LAST, ss.artist_longitude NULLS LAST,
+                                                 ss.song_id NULLS LAST) AS latest
+                FROM {}) m
+        WHERE latest = 1
+""").format(song_match_join)
+
+
+def upsert_queries(table, key, columns, batch_select):
+    """
+    Returns:
+        stage create, stage INSERT ... SELECT of batch_select, stage INSERT ... VALUES
+        (client side batches), list of queries applying the stage to the target table
+    """
+    stage = table + '_stage'
+    column_list = ', '.join(columns)
+    unchanged = '\n          AND '.join('({1}.{0} = {2}.{0} OR ({1}.{0} IS NULL AND {2}.{0} IS NULL))'
+                                        .format(c, stage, table) for c in columns)
+    return ("CREATE TEMP TABLE {} (LIKE {})".format(stage, table),
+            "INSERT INTO {} ({}) {}".format(stage, column_list, batch_select.strip()),
+            "INSERT INTO {} ({}) VALUES ({})".format(stage, column_list, ', '.join(['%s'] * len(columns))),
+            ["DELETE FROM {} USING {}\n        WHERE {}".format(stage, table, unchanged),
+             "DELETE FROM {0} USING {1} WHERE {0}.{2} = {1}.{2}".format(table, stage, key),
+             "INSERT INTO {0} ({2}) SELECT {2} FROM {1}".format(table, stage, column_list),
+             "DROP TABLE {}".format(stage)])
+
+users_stage_create, users_stage_transform, users_stage_insert, users_upsert = upsert_queries(
+    'users', 'user_id', ['user_id', 'first_name', 'last_name', 'gender', 'level'], users_batch_select)
+songs_stage_create, songs_stage_transform, songs_stage_insert, songs_upsert = upsert_queries(
+    'songs', 'song_id', ['song_id', 'title', 'artist_id', 'year', 'duration'], songs_batch_select)
+artists_stage_create, artists_stage_transform, artists_stage_insert, artists_upsert = upsert_queries(
+    'artists', 'artist_id', ['artist_id', 'name', 'location', 'lattitude', 'longitude'], artists_batch_select)
+
+# AGGREGATE TABLES
+#   Summary tables for the recurring analyst queries, partitioned by play_date (UTC day).
+#   etl.refresh_aggregates recomputes only the days that received new facts: the days of
+#   the NextSong events in staging_events, which holds only the new files of an
+#   incremental run.  Titles and names are those of songs / artists when the day was
+#   refreshed.  With TIME_GRAIN = day, agg_hourly_plays has hour 0 only.
+#   Tables are created IF NOT EXISTS so incremental runs against older warehouses add
+#   them; days before that need a --full-refresh to be backfilled.
+
+TIME_KEYS_PER_DAY = 24 * 60 * 60 * 1000 // TIME_GRAIN_MS
+
+agg_daily_plays_table_create = ("""
+    CREATE TABLE IF NOT EXISTS agg_daily_plays (
+       play_date   date    NOT NULL,
+       plays       bigint  NOT NULL,
+       users       int     NOT NULL,
+       sessions    int     NOT NULL
+    ) diststyle all sortkey (play_date);
+""")
+
+agg_daily_song_plays_table_create = ("""
+    CREATE TABLE IF NOT EXISTS agg_daily_song_plays (
+       play_date   date    NOT NULL,
+       song_id     text    distkey NOT NULL,
+       title       text,
+       artist_id   text,
+       artist_name text,
+       plays       bigint  NOT NULL
+    ) sortkey (play_date);
+""")
+
+agg_daily_artist_plays_table_create = ("""
+    CREATE TABLE IF NOT EXISTS agg_daily_artist_plays (
+       play_date   date    NOT NULL,
+       artist_id   text    distkey NOT NULL,
+       artist_name text,
+       plays       bigint  NOT NULL,
+       users       int     NOT NULL
+    ) sortkey (play_date);
+""")
+
+agg_daily_level_plays_table_create = ("""
+    CREATE TABLE IF NOT EXISTS agg_daily_level_plays (
+       play_date   date    NOT NULL,
+       level       text,
+       plays       bigint  NOT NULL,
+       users       int     NOT NULL
+    ) diststyle all sortkey (play_date);
+""")
+
+agg_hourly_plays_table_create = ("""
+    CREATE TABLE IF NOT EXISTS agg_hourly_plays (
+       play_date   date    NOT NULL,
+       hour        int     NOT NULL,
+       plays       bigint  NOT NULL,
+       users       int     NOT NULL
+    ) diststyle all sortkey (play_date, hour);
+""")
+
+#   Days (since the epoch) of the new facts; play_date = DATE '1970-01-01' + day_key
+agg_touched_days_create = ("""
+    CREATE TEMP TABLE agg_touched_days AS
+    SELECT DISTINCT CAST(FLOOR(ts / {}) AS int) AS day_key
+        FROM staging_events
+        WHERE page = 'NextSong' AND ts IS NOT NULL
+""").format(24 * 60 * 60 * 1000)
+
+agg_touched_days_drop = "DROP TABLE agg_touched_days"
+
+agg_play_date = "DATE '1970-01-01' + d.day_key"
+
+#   songplay rows of the touched days, a time_key range per day
+agg_touched_songplay = ("""agg_touched_days d
+        JOIN songplay sp ON sp.time_key BETWEEN d.day_key * {0} AND (d.day_key + 1) * {0} - 1""").format(TIME_KEYS_PER_DAY)
+
+agg_daily_plays_insert = ("""
+    INSERT INTO agg_daily_plays (play_date, plays, users, sessions)
+    SELECT {play_date}, COUNT(*), COUNT(DISTINCT sp.user_id),
+           COUNT(DISTINCT CAST(sp.user_id AS varchar) || ':' || CAST(sp.session_id AS varchar))
+        FROM {songplay}
+        GROUP BY d.day_key
+""").format(play_date=agg_play_date, songplay=agg_touched_songplay)
+
+agg_daily_song_plays_insert = ("""
+    INSERT INTO agg_daily_song_plays (play_date, song_id, title, artist_id, artist_name, plays)
+    SELECT {play_date}, sp.song_id, s.title, sp.artist_id, a.name, COUNT(*)
+        FROM {songplay}
+        LEFT JOIN songs s ON s.song_id = sp.song_id
+        LEFT JOIN artists a ON a.artist_id = sp.artist_id
+        GROUP BY d.day_key, sp.song_id, s.title, sp.artist_id, a.name
+""").format(play_date=agg_play_date, songplay=agg_touched_songplay)
+
+agg_daily_artist_plays_insert = ("""
+    INSERT INTO agg_daily_artist_plays (play_date, artist_id, artist_name, plays, users)
+    SELECT {play_date}, sp.artist_id, a.name, COUNT(*), COUNT(DISTINCT sp.user_id)
+        FROM {songplay}
+        LEFT JOIN artists a ON a.artist_id = sp.artist_id
+        GROUP BY d.day_key, sp.artist_id, a.name
+""").format(play_date=agg_play_date, songplay=agg_touched_songplay)
+
+agg_daily_level_plays_insert = ("""
+    INSERT INTO agg_daily_level_plays (play_date, level, plays, users)
+    SELECT {play_date}, sp.level, COUNT(*), COUNT(DISTINCT sp.user_id)
+        FROM {songplay}
+        GROUP BY d.day_key, sp.level
+""").format(play_date=agg_play_date, songplay=agg_touched_songplay)
+
+agg_hourly_plays_insert = ("""
+    INSERT INTO agg_hourly_plays (play_date, hour, plays, users)
+    SELECT {play_date}, t.hour, COUNT(*), COUNT(DISTINCT sp.user_id)
+        FROM {songplay}
+        JOIN time t ON t.time_key = sp.time_key
+        GROUP BY d.day_key, t.hour
+""").format(play_date=agg_play_date, songplay=agg_touched_songplay)
+
+
+def aggregate_refresh(table, insert):
+    return ["DELETE FROM {} WHERE play_date IN (SELECT {} FROM agg_touched_days d)".format(table, agg_play_date),
+            insert]
+
+aggregate_refresh_queries = ([agg_touched_days_create]
+                             + aggregate_refresh('agg_daily_plays', agg_daily_plays_insert)
+                             + aggregate_refresh('agg_daily_song_plays', agg_daily_song_plays_insert)
+                             + aggregate_refresh('agg_daily_artist_plays', agg_daily_artist_plays_insert)
+                             + aggregate_refresh('agg_daily_level_plays', agg_daily_level_plays_insert)
+                             + aggregate_refresh('agg_hourly_plays', agg_hourly_plays_insert)
+                             + [agg_touched_days_drop])
+
+# DATA VALIDATION
+#   etl.validate_staging checks the staged rows set-based before any table is loaded.  Rows
+#   breaking a rule are copied to quarantine_<staging table> with the reason code of the
+#   first rule they break, then deleted from staging, so the loaders only see clean rows.
+#   Rules are (reason code, predicate); a predicate evaluating to NULL passes.  Run with
+#   the parameters run_at (quarantined_at of the run), max_ts and max_year.
+
+# 2000-01-01 UTC in epoch ms, well before the first Sparkify event
+MIN_EVENT_TS = 946684800000
+MAX_SONG_SECONDS = 3 * 60 * 60
+ID_LENGTH = 18
+
+quarantine_staging_events_table_create = ("""
+    CREATE TABLE IF NOT EXISTS quarantine_staging_events (
+       reason         varchar(32)  NOT NULL,
+       quarantined_at timestamp    NOT NULL,
+       artist         text,
+       auth           text,
+       firstName      text,
+       gender         text,
+       itemInSession  int,
+       lastName       text,
+       length         float,
+       level          text,
+       location       text,
+       method         text,
+       page           text,
+       registration   float,
+       sessionid      int,
+       song           text,
+       status         int,
+       ts             numeric,
+       userAgent      text,
+       userid         int
+    ) sortkey (quarantined_at);
 """)
 
+quarantine_staging_songs_table_create = ("""
+    CREATE TABLE IF NOT EXISTS quarantine_staging_songs (
+       reason           varchar(32)  NOT NULL,
+       quarantined_at   timestamp    NOT NULL,
+       num_songs        int,
+       artist_id        varchar(18),
+       artist_latitude  float,
+       artist_longitude float,
+       artist_location  text,
+       artist_name      text,
+       song_id          text,
+       title            text,
+       duration         float,
+       year             int
+    ) sortkey (quarantined_at);
+""")
+
+staging_events_rules = [
+    ('MISSING_TS',      "ts IS NULL"),
+    ('TS_RANGE',        "ts < {} OR ts > %(max_ts)s".format(MIN_EVENT_TS)),
+    ('MISSING_USER',    "page = 'NextSong' AND userid IS NULL"),
+    ('MISSING_SESSION', "page = 'NextSong' AND sessionid IS NULL"),
+    ('MISSING_SONG',    "page = 'NextSong' AND (song IS NULL OR artist IS NULL)"),
+    ('BAD_LENGTH',      "page = 'NextSong' AND (length IS NULL OR length <= 0 OR length > {})".format(MAX_SONG_SECONDS)),
+]
+
+staging_songs_rules = [
+    ('MISSING_ID',      "song_id IS NULL OR artist_id IS NULL"),
+    ('BAD_ID',          "LENGTH(song_id) <> {0} OR SUBSTRING(song_id, 1, 2) <> 'SO' "
+                        "OR LENGTH(artist_id) <> {0} OR SUBSTRING(artist_id, 1, 2) <> 'AR'".format(ID_LENGTH)),
+    ('MISSING_TITLE',   "title IS NULL"),
+    ('BAD_DURATION',    "duration IS NULL OR duration <= 0 OR duration > {}".format(MAX_SONG_SECONDS)),
+    ('BAD_YEAR',        "year < 0 OR year > %(max_year)s"),
+    ('BAD_LOCATION',    "artist_latitude NOT BETWEEN -90 AND 90 OR artist_longitude NOT BETWEEN -180 AND 180"),
+]
+
+
+def quarantine_queries(table, columns, rules):
+    """
+    Returns:
+        INSERT copying the rows of table breaking a rule to quarantine_<table>,
+        DELETE removing them from table
+    """
+    column_list = ', '.join(columns)
+    reason = '\n             '.join("WHEN {} THEN '{}'".format(predicate, code) for code, predicate in rules)
+    return ("""
+    INSERT INTO quarantine_{0} (reason, quarantined_at, {1})
+    SELECT reason, %(run_at)s, {1}
+        FROM (SELECT CASE {2}
+                     END AS reason, {1}
+                FROM {0}) q
+        WHERE reason IS NOT NULL
+""".format(table, column_list, reason),
+            "DELETE FROM {} WHERE {}".format(table, '\n       OR '.join('({})'.format(p) for _, p in rules)))
+
+staging_events_quarantine, staging_events_reject = quarantine_queries(
+    'staging_events', [c.strip() for c in staging_events_columns.split(',')], staging_events_rules)
+staging_songs_quarantine, staging_songs_reject = quarantine_queries(
+    'staging_songs', ['num_songs', 'artist_id', 'artist_latitude', 'artist_longitude', 'artist_location',
+                      'artist_name', 'song_id', 'title', 'duration', 'year'], staging_songs_rules)
+
+quarantine_reasons_select = ("""
+    SELECT reason, COUNT(*) FROM quarantine_{} WHERE quarantined_at = %s GROUP BY reason ORDER BY reason
+""")
+
+# PARQUET EXPORT
+#   export_parquet.py streams the star schema through a server-side cursor.  songplay is
+#   read in time_key order from the first time_key of a day on, so each start_time date
+#   partition is written in one piece; its export watermark (max time_key exported) is
+#   kept in etl_watermark under EXPORT_WATERMARK_SOURCE.
+
+EXPORT_WATERMARK_SOURCE = 'export_songplay'
+
+export_table_select = "SELECT * FROM {}"
+
+songplay_export_select = ("""
+    SELECT songplay_id, start_time, time_key, user_id, level, song_id, artist_id, session_id, location, user_agent
+        FROM songplay
+        WHERE time_key >= {}
+        ORDER BY time_key
+""")
+
+songplay_max_time_key = "SELECT MAX(time_key) FROM songplay"
+
 # QUERY LISTS
 
-create_staging_table_queries = [staging_events_table_create, staging_songs_table_create]
+create_staging_table_queries = [staging_events_table_create, staging_songs_table_create, staging_song_match_table_create]
 create_table_queries = [songplay_table_create, users_table_create,
                            songs_table_create, artists_table_create, time_table_create]
-drop_staging_table_queries = [staging_events_table_drop, staging_songs_table_drop]
+drop_staging_table_queries = [staging_events_table_drop, staging_songs_table_drop, staging_song_match_table_drop]
 drop_table_queries = [songplay_table_drop, users_table_drop, songs_table_drop, artists_table_drop, time_table_drop]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
 insert_table_queries = [songplay_table_insert, users_table_insert,
                         songs_table_insert, artists_table_insert, time_table_insert]
+transform_table_queries = [artists_stage_transform, users_stage_transform,
+                           songs_stage_transform, songplay_table_transform]
+clear_staging_table_queries = [staging_events_delete, staging_songs_delete]
+match_key_queries = [staging_events_match_key_update, staging_song_match_truncate, staging_song_match_insert]
+# in a unit of work: TRUNCATE would commit the open transaction on Redshift
+match_key_queries_in_transaction = [staging_events_match_key_update, staging_song_match_delete,
+                                    staging_song_match_insert]
+create_control_table_queries = [etl_watermark_table_create, etl_loaded_files_table_create, etl_staged_files_table_create]
+drop_control_table_queries = [etl_watermark_table_drop, etl_loaded_files_table_drop, etl_staged_files_table_drop]
+create_aggregate_table_queries = [agg_daily_plays_table_create, agg_daily_song_plays_table_create,
+                                  agg_daily_artist_plays_table_create, agg_daily_level_plays_table_create,
+                                  agg_hourly_plays_table_create]
+drop_aggregate_table_queries = [agg_daily_plays_table_drop, agg_daily_song_plays_table_drop,
+                                agg_daily_artist_plays_table_drop, agg_daily_level_plays_table_drop,
+                                agg_hourly_plays_table_drop]
+create_quarantine_table_queries = [quarantine_staging_events_table_create, quarantine_staging_songs_table_create]
+drop_quarantine_table_queries = [quarantine_staging_events_table_drop, quarantine_staging_songs_table_drop]
+quarantine_queries_by_table = {'staging_events': (staging_events_quarantine, staging_events_reject),
+                               'staging_songs': (staging_songs_quarantine, staging_songs_reject)}
@@ -0,0 +1,113 @@
+import time
+import random
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from backoff import backoff_delays
+
+WINDOW_GRAINS = ('day', 'month')
+# Key layout of the event logs under LOG_DATA, e.g. log_data/2018/11/2018-11-01-events.json
+DAY_LAYOUT = '{0:%Y}/{0:%m}/{0:%Y-%m-%d}'
+MONTH_LAYOUT = '{0:%Y}/{0:%m}/'
+DEFAULT_CONCURRENCY = 4
+DEFAULT_RETRIES = 2
+RETRY_BASE_DELAY = 5
+RETRY_MAX_DELAY = 60
+
+
+class WindowLoadError(Exception):
+    """
+    Description:
+        Raised when a window still fails after its retries.
+    """
+
+
+def parse_date(text):
+    return dt.datetime.strptime(text, '%Y-%m-%d').date()
+
+
+def date_windows(first, last, grain='day'):
+    """
+    Description:
+        Split the date range first..last (inclusive) into day or month windows.
+
+    Returns:
+        list of window start dates; month windows start on the 1st
+    """
+    if grain not in WINDOW_GRAINS:
+        raise ValueError('Unknown window grain {}, expected one of {}'.format(grain, WINDOW_GRAINS))
+    if last < first:
+        raise ValueError('Date range ends ({}) before it starts ({})'.format(last, first))
+
+    windows = []
+    day = first if grain == 'day' else first.replace(day=1)
+    while day <= last:
+        windows.append(day)
+        if grain == 'day':
+            day += dt.timedelta(days=1)
+        else:
+            day = (day + dt.timedelta(days=32)).replace(day=1)
+    return windows
+
+
+def window_prefix(prefix, window, grain='day'):
+    """
+    Description:
+        Key prefix of the event logs of one window under the LOG_DATA prefix.
+    """
+    layout = DAY_LAYOUT if grain == 'day' else MONTH_LAYOUT
+    return '{}/{}'.format(prefix.rstrip('/'), layout.format(window)).lstrip('/')
+
+
+def window_label(window, grain='day'):
+    return window.strftime('%Y-%m-%d' if grain == 'day' else '%Y-%m')
+
+
+def run_windows(windows, load, concurrency=DEFAULT_CONCURRENCY, retries=DEFAULT_RETRIES, time_budget=None,
+                sleep=time.sleep, clock=time.monotonic, rng=random):
+    """
+    Description:
+        Load windows with up to concurrency of them at a time.  A failing window is
+        retried up to retries times with jittered backoff.  With a time budget, windows
+        not started when it runs out are skipped, to be picked up by a later run.
+
+    Arguments:
+        windows - labels of the windows, in load order
+        load - callable(label) loading one window, returning rows loaded
+        concurrency - windows loading at the same time
+        retries - extra attempts per window
+        time_budget - seconds after which no further window is started, None for no limit
+        sleep, clock, rng - injectable for tests
+
+    Returns:
+        dict of label -> {'status': 'ok' | 'failed' | 'skipped', 'rows', 'seconds', 'attempts', 'error'}
+    """
+    started = clock()
+
+    def run(label):
+        if time_budget is not None and clock() - started > time_budget:
+            return {'status': 'skipped', 'rows': 0, 'seconds': 0.0, 'attempts': 0, 'error': None}
+
+        begin = clock()
+        delays = backoff_delays(RETRY_BASE_DELAY, RETRY_MAX_DELAY, rng)
+        for attempt in range(1, retries + 2):
+            try:
+                rows = load(label)
+                return {'status': 'ok', 'rows': rows, 'seconds': clock() - begin, 'attempts': attempt, 'error': None}
+            except Exception as e:
+                error = str(e).strip()
+                print('window {}: attempt {} failed: {}'.format(label, attempt, error.splitlines()[0] if error else e))
+                if attempt <= retries:
+                    sleep(next(delays))
+        return {'status': 'failed', 'rows': 0, 'seconds': clock() - begin, 'attempts': retries + 1, 'error': error}
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = {label: pool.submit(run, label) for label in windows}
+        return {label: future.result() for label, future in futures.items()}
+
+
+def report(results):
+    print('{:<10} {:>8} {:>10} {:>9} {:>8}'.format('window', 'status', 'rows', 'seconds', 'attempts'))
+    for label, r in results.items():
+        print('{:<10} {:>8} {:>10} {:>9.2f} {:>8}'.format(label, r['status'], r['rows'], r['seconds'], r['attempts']))
+    loaded = [r for r in results.values() if r['status'] == 'ok']
+    print('{} of {} windows loaded, {} rows'.format(len(loaded), len(results), sum(r['rows'] for r in loaded)))
@@ -0,0 +1,108 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import generate_data  # noqa: E402
+
+# Small enough to run the whole pipeline in a few seconds, large enough to have
+# duplicate artists, unmatched events and several calendar days
+SAMPLE_EVENTS = 5000
+SAMPLE_DAYS = 5
+
+DUCKDB_CONFIG = """
+[DWH]
+BACKEND = duckdb
+DUCKDB_PATH = {}
+"""
+
+
+@pytest.fixture(scope='session')
+def source_data(tmp_path_factory):
+    """
+    Description:
+        Synthetic song_data / log_data tree shared by the tests of a session.
+    """
+    data_dir = str(tmp_path_factory.mktemp('data'))
+    generate_data.generate(data_dir, SAMPLE_EVENTS, days=SAMPLE_DAYS, seed=1)
+    return data_dir
+
+
+@pytest.fixture
+def duckdb_config(tmp_path):
+    """
+    Description:
+        Config file of the embedded DuckDB backend, one database per test.
+
+    Returns:
+        path of the config file, path of the database
+    """
+    pytest.importorskip('duckdb')
+    database = str(tmp_path / 'sparkify.duckdb')
+    config_file = str(tmp_path / 'dwh-test.cfg')
+    with open(config_file, 'w') as f:
+        f.write(DUCKDB_CONFIG.format(database))
+    return config_file, database
+
+
+@pytest.fixture
+def run_etl(tmp_path, source_data, duckdb_config):
+    """
+    Description:
+        Run etl.main on the DuckDB backend over the sample data.
+
+    Returns:
+        callable(**main arguments) returning the path of the database
+    """
+    import etl
+    config_file, database = duckdb_config
+
+    def run(**kwargs):
+        kwargs.setdefault('checkpoint_file', str(tmp_path / 'etl_checkpoint.json'))
+        etl.main(config_file=config_file, local_data=source_data, **kwargs)
+        return database
+    return run
+
+
+def table_rows(database, table, exclude=()):
+    """
+    Description:
+        All rows of a table in a repeatable order, without the columns in exclude.
+    """
+    import duckdb
+    db = duckdb.connect(database)
+    try:
+        select = '* EXCLUDE ({})'.format(', '.join(exclude)) if exclude else '*'
+        return db.execute('SELECT {} FROM {} ORDER BY ALL'.format(select, table)).fetchall()
+    finally:
+        db.close()
+
+
+class FakeS3:
+    """
+    Description:
+        boto3 S3 client over an in-memory bucket: list_objects_v2 pages and put_object.
+
+    Arguments:
+        objects - dict of key -> size of the source objects
+        page_size - keys per list_objects_v2 page
+    """
+
+    def __init__(self, objects, page_size=1000):
+        self.objects = dict(objects)
+        self.page_size = page_size
+        self.puts = {}
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        keys = sorted(k for k in self.objects if k.startswith(Prefix))
+        for i in range(0, max(len(keys), 1), self.page_size):
+            page = keys[i:i + self.page_size]
+            yield {'Contents': [{'Key': k, 'Size': self.objects[k]} for k in page]} if page else {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.puts['s3://{}/{}'.format(Bucket, Key)] = Body
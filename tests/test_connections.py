@@ -0,0 +1,258 @@
+import threading
+import pytest
+import psycopg2
+import psycopg2.extensions
+import create_tables
+from create_tables import (resolve_DWH_endpoint, clear_endpoint_cache, connect_DWH_db, get_DWH_pool,
+                           DWHConnectionPool)
+
+DWH_CONFIG = """
+[AWS]
+KEY = test-key
+SECRET = test-secret
+
+[DWH]
+DWH_CLUSTER_IDENTIFIER = sparkify
+DWH_DB = sparkify
+DWH_DB_USER = sparkify
+DWH_DB_PASSWORD = secret
+DWH_PORT = 5439
+"""
+
+
+class FakeRedshift:
+    """
+    Description:
+        boto3 Redshift client answering describe_clusters with a fixed endpoint.
+    """
+
+    def __init__(self, address='sparkify.example.redshift.amazonaws.com'):
+        self.address = address
+        self.calls = 0
+
+    def describe_clusters(self, ClusterIdentifier):
+        self.calls += 1
+        return {'Clusters': [{'ClusterIdentifier': ClusterIdentifier,
+                              'Endpoint': {'Address': self.address, 'Port': 5439}}]}
+
+
+class FakeCursor:
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, vars=None):
+        if self.conn.broken:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        if not self.conn.autocommit:
+            self.conn.in_transaction = True
+
+    def close(self):
+        pass
+
+
+class FakeInfo:
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    @property
+    def transaction_status(self):
+        if self.conn.in_transaction:
+            return psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeConnection:
+    """
+    Description:
+        psycopg2 connection as seen by the pool: health checked with SELECT 1,
+        broken connections fail it.  Like psycopg2, a statement outside autocommit
+        opens a transaction and set_session is refused inside one.
+    """
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.closed = 0
+        self.broken = False
+        self.refuse_cursors = False
+        self.autocommit = False
+        self.in_transaction = False
+        self.info = FakeInfo(self)
+
+    def cursor(self):
+        if self.refuse_cursors:
+            raise psycopg2.InterfaceError('connection already closed')
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.in_transaction = False
+
+    def set_session(self, autocommit=None):
+        if self.in_transaction:
+            raise psycopg2.ProgrammingError('set_session cannot be used inside a transaction')
+        self.autocommit = autocommit
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture(autouse=True)
+def endpoint_cache():
+    clear_endpoint_cache()
+    yield
+    clear_endpoint_cache()
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    path = str(tmp_path / 'dwh-test.cfg')
+    with open(path, 'w') as f:
+        f.write(DWH_CONFIG)
+    return path
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    """
+    Description:
+        Replace psycopg2.connect, also used by psycopg2.pool, with FakeConnection.
+
+    Returns:
+        list of the connections opened
+    """
+    opened = []
+
+    def connect(dsn):
+        opened.append(FakeConnection(dsn))
+        return opened[-1]
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    return opened
+
+
+def test_endpoint_is_cached(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(create_tables.time, 'monotonic', lambda: clock[0])
+    redshift = FakeRedshift()
+
+    assert resolve_DWH_endpoint(None, 'sparkify', redshift, ttl=60) == redshift.address
+    clock[0] += 59
+    assert resolve_DWH_endpoint(None, 'sparkify', redshift, ttl=60) == redshift.address
+    assert redshift.calls == 1
+
+    clock[0] += 2
+    resolve_DWH_endpoint(None, 'sparkify', redshift, ttl=60)
+    assert redshift.calls == 2
+
+    clear_endpoint_cache()
+    resolve_DWH_endpoint(None, 'sparkify', redshift, ttl=60)
+    assert redshift.calls == 3
+
+
+def test_endpoint_cache_per_cluster():
+    redshift = FakeRedshift()
+    resolve_DWH_endpoint(None, 'sparkify', redshift)
+    resolve_DWH_endpoint(None, 'other', redshift)
+    assert redshift.calls == 2
+
+
+def test_connect_resolves_endpoint_once(config_file, connections):
+    redshift = FakeRedshift()
+    for _ in range(3):
+        cur, conn = connect_DWH_db(config_file, redshift=redshift)
+        assert conn.autocommit
+    assert redshift.calls == 1
+    assert len(connections) == 3
+    assert all('host={} '.format(redshift.address) in c.dsn for c in connections)
+    assert all('port=5439' in c.dsn for c in connections)
+
+
+def test_connect_other_cluster_refused(config_file, connections):
+    assert connect_DWH_db(config_file, 'other', redshift=FakeRedshift()) == 'other'
+    assert connections == []
+
+
+def test_pool_reuses_connections(config_file, connections):
+    pool = get_DWH_pool(config_file, minconn=1, maxconn=2, redshift=FakeRedshift())
+    assert len(connections) == 1
+
+    with pool.connection() as (cur, conn):
+        assert conn is connections[0] and conn.autocommit
+    with pool.connection() as (cur, conn):
+        assert conn is connections[0]
+    assert len(connections) == 1
+
+
+def test_pool_replaces_broken_connection(connections):
+    pool = DWHConnectionPool('host=test', minconn=1, maxconn=2)
+    connections[0].broken = True
+
+    cur, conn = pool.acquire()
+    assert conn is connections[1]
+    assert connections[0].closed
+    pool.release(cur, conn)
+
+    connections[1].close()
+    cur, conn = pool.acquire()
+    assert conn is connections[2]
+    pool.release(cur, conn)
+
+
+def test_pool_blocks_at_maxconn(connections):
+    pool = DWHConnectionPool('host=test', minconn=1, maxconn=2)
+    held = [pool.acquire(), pool.acquire()]
+    acquired = threading.Event()
+
+    def checkout():
+        cur, conn = pool.acquire()
+        acquired.set()
+        pool.release(cur, conn)
+    waiting = threading.Thread(target=checkout)
+    waiting.start()
+
+    assert not acquired.wait(0.2)
+    pool.release(*held.pop())
+    assert acquired.wait(5)
+    waiting.join()
+    pool.release(*held.pop())
+    assert len(connections) <= 2
+
+
+def test_failed_checkout_frees_its_slot(monkeypatch):
+    pool = DWHConnectionPool('host=test', minconn=0, maxconn=1)
+
+    def refuse(dsn):
+        raise psycopg2.OperationalError('could not connect to server')
+    monkeypatch.setattr(psycopg2, 'connect', refuse)
+    with pytest.raises(psycopg2.OperationalError):
+        pool.acquire()
+
+    monkeypatch.setattr(psycopg2, 'connect', FakeConnection)
+    cur, conn = pool.acquire()
+    pool.release(cur, conn)
+
+
+def test_failed_checkout_returns_connection(monkeypatch):
+    opened = []
+
+    def connect(dsn):
+        opened.append(FakeConnection(dsn))
+        opened[-1].refuse_cursors = True
+        return opened[-1]
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    pool = DWHConnectionPool('host=test', minconn=1, maxconn=1)
+
+    with pytest.raises(psycopg2.InterfaceError):
+        pool.acquire()
+    assert len(opened) == 2 and all(c.closed for c in opened)
+    assert pool.pool._used == {}
+
+    monkeypatch.setattr(psycopg2, 'connect', FakeConnection)
+    cur, conn = pool.acquire()
+    pool.release(cur, conn)
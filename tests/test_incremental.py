@@ -0,0 +1,47 @@
+import etl
+from create_tables import connect_DWH_db
+from sql_queries import songplay_table_incremental, etl_loaded_files_select
+
+
+def loaded_keys(cur, source):
+    cur.execute(etl_loaded_files_select, (source,))
+    return sorted(r[0] for r in cur.fetchall())
+
+
+def test_event_keys_are_loaded_with_the_watermark(run_etl, duckdb_config):
+    run_etl()
+    cur, conn = connect_DWH_db(duckdb_config[0])
+    try:
+        etl.reset_staged_files(cur)
+        etl.record_keys(cur, 'staging_events', ['log_data/a.json', 'log_data/b.json'])
+        etl.record_keys(cur, 'staging_songs', ['song_data/c.json'])
+        # a run failing now leaves the event logs to be staged again
+        assert loaded_keys(cur, 'staging_events') == []
+        assert loaded_keys(cur, 'staging_songs') == ['song_data/c.json']
+
+        etl.update_watermark(cur, conn)
+        assert loaded_keys(cur, 'staging_events') == ['log_data/a.json', 'log_data/b.json']
+        cur.execute('SELECT COUNT(*) FROM etl_staged_files')
+        assert cur.fetchone()[0] == 0
+    finally:
+        cur.close()
+        conn.close()
+
+
+def test_restaged_events_are_not_inserted_twice(run_etl, duckdb_config):
+    run_etl()
+    cur, conn = connect_DWH_db(duckdb_config[0])
+    try:
+        cur.execute('SELECT COUNT(*) FROM songplay')
+        plays = cur.fetchone()[0]
+        cur.execute(songplay_table_incremental)
+        assert cur.rowcount == 0
+
+        cur.execute('DELETE FROM songplay WHERE songplay_id < 10')
+        cur.execute(songplay_table_incremental)
+        assert cur.rowcount == 10
+        cur.execute('SELECT COUNT(*) FROM songplay')
+        assert cur.fetchone()[0] == plays
+    finally:
+        cur.close()
+        conn.close()
@@ -0,0 +1,67 @@
+import io
+import pytest
+import psycopg2
+from instrumentation import InstrumentedCursor, configure
+
+ROWS = ''.join('{},row {}\n'.format(i, i) for i in range(1000))
+
+
+class FakeConnection:
+    autocommit = True
+
+
+class FlakyCopyCursor:
+    """
+    Description:
+        Cursor whose first COPY FROM STDIN drops the connection after reading part of
+        the file; later COPYs read it to the end.
+    """
+
+    def __init__(self, failures=1):
+        self.connection = FakeConnection()
+        self.failures = failures
+        self.rowcount = -1
+        self.copied = []
+
+    def copy_expert(self, sql, file, size=8192):
+        if self.failures:
+            self.failures -= 1
+            file.read(size)
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        self.copied.append(file.read())
+        self.rowcount = self.copied[-1].count('\n')
+
+
+class Unseekable(io.RawIOBase):
+
+    def __init__(self, data):
+        self.data = io.StringIO(data)
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self.data.read(size)
+
+
+@pytest.fixture
+def retries():
+    configure(statement_retries=2)
+    yield
+    configure()
+
+
+def test_copy_retry_reads_the_whole_file(retries):
+    cur = FlakyCopyCursor()
+    data = io.StringIO('skipped header\n' + ROWS)
+    data.readline()
+
+    InstrumentedCursor(cur).copy_expert('COPY t FROM STDIN WITH CSV', data, size=100)
+    assert cur.copied == [ROWS]
+
+
+def test_copy_from_unseekable_file_is_not_retried(retries):
+    cur = FlakyCopyCursor()
+    with pytest.raises(psycopg2.OperationalError):
+        InstrumentedCursor(cur).copy_expert('COPY t FROM STDIN WITH CSV', Unseekable(ROWS), size=100)
+    assert cur.copied == []
@@ -0,0 +1,113 @@
+import re
+import json
+import random
+import threading
+import configparser
+from contextlib import contextmanager
+import pytest
+import etl
+from conftest import FakeS3
+from s3_manifest import balance, upload_manifests, slice_count
+
+CONFIG = """
+[S3]
+LOG_DATA = 's3://udacity-dend/log_data'
+SONG_DATA = 's3://udacity-dend/song_data'
+MANIFEST_PREFIX = 's3://sparkify-etl/manifests'
+
+[IAM_ROLE]
+ARN = 'arn:aws:iam::123456789012:role/dwhRole'
+
+[DWH]
+DWH_NUM_NODES = 4
+DWH_NODE_TYPE = dc2.large
+"""
+
+
+def objects(count, seed=1):
+    rng = random.Random(seed)
+    return [('log_data/{:05d}.json'.format(i), rng.randint(1000, 100000)) for i in range(count)]
+
+
+@pytest.fixture
+def config():
+    config = configparser.ConfigParser()
+    config.read_string(CONFIG)
+    return config
+
+
+def test_slice_count(config):
+    assert slice_count(config) == 8
+
+
+def test_balance_one_manifest_in_rounds_of_slices():
+    files = objects(1000)
+    manifest, = balance(files, 8)
+
+    assert sorted(manifest) == sorted(files)
+    sizes = [size for _, size in manifest]
+    assert sizes == sorted(sizes, reverse=True)
+
+
+@pytest.mark.parametrize('count', [1, 7, 8, 9, 100, 1003])
+@pytest.mark.parametrize('max_rounds', [1, 3, 10])
+def test_balance_manifests_hold_whole_rounds(count, max_rounds):
+    files = objects(count)
+    manifests = balance(files, 8, max_rounds)
+
+    assert sorted(f for m in manifests for f in m) == sorted(files)
+    assert all(len(m) <= 8 * max_rounds for m in manifests)
+    # every manifest but one is a multiple of the slice count
+    assert sum(len(m) % 8 != 0 for m in manifests) <= (1 if count % 8 else 0)
+    # every slice of a round gets a file of similar size: the rounds are consecutive in size
+    for m in manifests:
+        for first, second in zip(m[0::8], m[8::8]):
+            assert first[1] >= second[1]
+
+
+def test_balance_manifests_of_similar_size():
+    manifests = balance(objects(2000), 8, max_rounds=25)
+    totals = [sum(size for _, size in m) for m in manifests]
+    assert len(manifests) == 10
+    assert max(totals) - min(totals) < 0.05 * max(totals)
+
+
+def test_balance_nothing():
+    assert balance([], 8) == []
+
+
+def test_upload_manifests():
+    s3 = FakeS3({})
+    manifests = balance(objects(20), 8, max_rounds=1)
+    urls = upload_manifests(s3, 'udacity-dend', manifests, 's3://sparkify-etl/manifests/', 'staging_events')
+
+    assert len(urls) == len(manifests) == 3
+    for url, manifest in zip(urls, manifests):
+        assert url.startswith("'s3://sparkify-etl/manifests/staging_events-") and url.endswith(".manifest'")
+        document = json.loads(s3.puts[url.strip("'")])
+        assert document['entries'] == [{'url': 's3://udacity-dend/{}'.format(key), 'mandatory': True,
+                                         'meta': {'content_length': size}} for key, size in manifest]
+
+
+def test_copy_with_manifests_copies_tables_concurrently(config):
+    s3 = FakeS3({})
+    executed = {}
+    both_started = threading.Barrier(2, timeout=5)
+
+    class CopyCursor:
+        def execute(self, sql):
+            executed.setdefault(threading.get_ident(), []).append(sql)
+            both_started.wait()
+
+    @contextmanager
+    def connection():
+        yield CopyCursor(), None
+
+    sources = {'staging_events': objects(50), 'staging_songs': [('song_data/A/{}.json'.format(i), 100) for i in range(5)]}
+    durations = etl.copy_with_manifests(None, config, s3, sources, connection)
+
+    assert set(durations) == set(sources)
+    assert len(executed) == 2
+    statements = [sql for sqls in executed.values() for sql in sqls]
+    assert sorted(s3.puts) == sorted(re.search(r"FROM\s+'([^']+)'", sql).group(1) for sql in statements)
+    assert all('MANIFEST' in sql for sql in statements)
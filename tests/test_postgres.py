@@ -0,0 +1,130 @@
+import os
+import uuid
+import pytest
+import psycopg2
+import psycopg2.extensions
+from backends import PostgresCursor
+from benchmark_etl import bench_stages
+from bulk_writer import BulkWriter
+from create_tables import DWHConnectionPool
+from unit_of_work import unit_of_work
+from sql_queries import users_table_create, users_table_insert
+
+# Database these tests run in, each test in a schema of its own, e.g.
+#   SPARKIFY_TEST_DSN="dbname=sparkify_test" python -m pytest tests/test_postgres.py
+DSN = os.environ.get('SPARKIFY_TEST_DSN')
+
+pytestmark = pytest.mark.skipif(not DSN, reason='set SPARKIFY_TEST_DSN to run against PostgreSQL')
+
+TABLES = {'songplay': ('songplay_id',), 'users': (), 'songs': (), 'artists': (), 'time': (),
+          'agg_daily_plays': (), 'agg_daily_song_plays': (), 'agg_daily_artist_plays': (),
+          'agg_daily_level_plays': (), 'agg_hourly_plays': ()}
+
+
+def connect(dsn):
+    conn = psycopg2.connect(dsn, cursor_factory=PostgresCursor)
+    conn.set_session(autocommit=True)
+    return conn.cursor(), conn
+
+
+@pytest.fixture
+def new_schema():
+    """
+    Description:
+        Factory of empty schemas, dropped after the test.
+
+    Returns:
+        callable() returning the connection string of a new schema
+    """
+    admin = psycopg2.connect(DSN)
+    admin.set_session(autocommit=True)
+    schemas = []
+
+    def create():
+        schemas.append('sparkify_test_{}'.format(uuid.uuid4().hex[:12]))
+        with admin.cursor() as cur:
+            cur.execute('CREATE SCHEMA {}'.format(schemas[-1]))
+        return psycopg2.extensions.make_dsn(DSN, options='-c search_path={}'.format(schemas[-1]))
+
+    yield create
+    with admin.cursor() as cur:
+        for schema in schemas:
+            cur.execute('DROP SCHEMA {} CASCADE'.format(schema))
+    admin.close()
+
+
+def run_pipeline(dsn, data_dir, mode, method):
+    """
+    Description:
+        Every stage of the ETL, staging loaded from the local JSON (benchmark_etl.bench_stages).
+    """
+    cur, conn = connect(dsn)
+    try:
+        for name, func, _ in bench_stages(data_dir, mode, {'batch_size': 500, 'method': method}, ingest_workers=2):
+            func(cur, conn)
+    finally:
+        conn.close()
+
+
+def table_rows(dsn, table, exclude=()):
+    cur, conn = connect(dsn)
+    try:
+        cur.execute('SELECT column_name FROM information_schema.columns WHERE table_name = %s '
+                    'AND table_schema = current_schema() ORDER BY ordinal_position', (table,))
+        columns = [c for c, in cur.fetchall() if c not in exclude]
+        cur.execute('SELECT {0} FROM {1} ORDER BY {0}'.format(', '.join(columns), table))
+        return cur.fetchall()
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('mode, method', [('client', 'copy'), ('client', 'values'), ('stream', 'copy')])
+def test_modes_produce_identical_tables(new_schema, source_data, mode, method):
+    reference, database = new_schema(), new_schema()
+    run_pipeline(reference, source_data, 'sql', 'copy')
+    run_pipeline(database, source_data, mode, method)
+
+    for table, exclude in TABLES.items():
+        expected = table_rows(reference, table, exclude)
+        assert expected, table
+        assert table_rows(database, table, exclude) == expected, table
+
+
+def test_bulk_writer_bisects_bad_rows(new_schema):
+    cur, conn = connect(new_schema())
+    cur.execute(users_table_create)
+    rows = [(i, 'first', 'last', 'F', 'free') for i in range(1, 101)]
+    bad = [(None, 'no', 'id', 'M', 'free'), (7, 'duplicate', 'id', 'M', 'paid')]
+
+    with unit_of_work(conn):
+        with BulkWriter(cur, users_table_insert, batch_size=64, isolate_errors=True) as writer:
+            writer.write_many(rows[:50] + bad + rows[50:])
+
+    assert [row for row, _ in writer.rejected] == bad
+    assert writer.row_count == len(rows)
+    cur.execute('SELECT COUNT(*), COUNT(DISTINCT user_id) FROM users')
+    assert cur.fetchone() == (100, 100)
+    conn.close()
+
+
+def test_pool_replaces_terminated_connection(new_schema):
+    dsn = new_schema()
+    pool = DWHConnectionPool(dsn, minconn=1, maxconn=2)
+    try:
+        for _ in range(3):
+            with pool.connection() as (cur, conn):
+                assert conn.autocommit
+                cur.execute('SELECT 1')
+                assert cur.fetchone() == (1,)
+                pid = conn.get_backend_pid()
+
+        admin, admin_conn = connect(dsn)
+        admin.execute('SELECT pg_terminate_backend(%s)', (pid,))
+        admin_conn.close()
+
+        with pool.connection() as (cur, conn):
+            assert conn.get_backend_pid() != pid
+            cur.execute('SELECT 1')
+            assert cur.fetchone() == (1,)
+    finally:
+        pool.closeall()
@@ -0,0 +1,181 @@
+import random
+import threading
+import pytest
+from botocore.exceptions import ClientError
+from create_DWH import provision_DWH, POLL_MAX_DELAY
+
+DWH_CONFIG = """
+[AWS]
+KEY = test-key
+SECRET = test-secret
+
+[DWH]
+DWH_CLUSTER_TYPE = multi-node
+DWH_NUM_NODES = 4
+DWH_NODE_TYPE = dc2.large
+DWH_IAM_ROLE_NAME = dwhRole
+DWH_CLUSTER_IDENTIFIER = sparkify
+DWH_DB = sparkify
+DWH_DB_USER = sparkify
+DWH_DB_PASSWORD = secret
+DWH_PORT = 5439
+"""
+
+ROLE_ARN = 'arn:aws:iam::123456789012:role/dwhRole'
+ENDPOINT = 'sparkify.example.us-west-2.redshift.amazonaws.com'
+
+
+def client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class FakeClock:
+    """
+    Description:
+        monotonic clock advanced by sleep, so the polling runs without waiting.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+
+class FakeRedshift:
+    """
+    Description:
+        Redshift client of one account: a created cluster becomes available after
+        polls describe_clusters calls.
+    """
+
+    def __init__(self, polls=3):
+        self.polls = polls
+        self.clusters = {}
+        self.create_calls = []
+
+    def create_cluster(self, **kwargs):
+        self.create_calls.append(kwargs)
+        if kwargs['ClusterIdentifier'] in self.clusters:
+            raise client_error('ClusterAlreadyExists', 'CreateCluster')
+        self.clusters[kwargs['ClusterIdentifier']] = {'describes': 0}
+
+    def describe_clusters(self, ClusterIdentifier):
+        if ClusterIdentifier not in self.clusters:
+            raise client_error('ClusterNotFound', 'DescribeClusters')
+        cluster = self.clusters[ClusterIdentifier]
+        cluster['describes'] += 1
+        if cluster['describes'] < self.polls:
+            return {'Clusters': [{'ClusterIdentifier': ClusterIdentifier, 'ClusterStatus': 'creating'}]}
+        return {'Clusters': [{'ClusterIdentifier': ClusterIdentifier, 'ClusterStatus': 'available',
+                              'Endpoint': {'Address': ENDPOINT, 'Port': 5439}}]}
+
+
+class FakeIAM:
+
+    def get_role(self, RoleName):
+        return {'Role': {'RoleName': RoleName, 'Arn': ROLE_ARN}}
+
+
+class FakeEC2:
+    """
+    Description:
+        EC2 client with a default VPC and its default security group.
+    """
+
+    def __init__(self):
+        self.rules = set()
+        self.authorize_calls = 0
+
+    def describe_vpcs(self, Filters):
+        return {'Vpcs': [{'VpcId': 'vpc-1', 'IsDefault': True}]}
+
+    def describe_security_groups(self, Filters):
+        return {'SecurityGroups': [{'GroupId': 'sg-1', 'GroupName': 'default', 'VpcId': 'vpc-1'}]}
+
+    def authorize_security_group_ingress(self, GroupId, IpProtocol, CidrIp, FromPort, ToPort):
+        self.authorize_calls += 1
+        rule = (GroupId, IpProtocol, CidrIp, FromPort, ToPort)
+        if rule in self.rules:
+            raise client_error('InvalidPermission.Duplicate', 'AuthorizeSecurityGroupIngress')
+        self.rules.add(rule)
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    path = str(tmp_path / 'dwh-test.cfg')
+    with open(path, 'w') as f:
+        f.write(DWH_CONFIG)
+    return path
+
+
+@pytest.fixture
+def clients():
+    return {'redshift': FakeRedshift(), 'iam': FakeIAM(), 'ec2': FakeEC2()}
+
+
+def provision(config_file, clients, clock, probe=lambda host, port: True, **kwargs):
+    return provision_DWH(config_file, clients, probe=probe, sleep=clock.sleep, clock=clock,
+                         rng=random.Random(1), **kwargs)
+
+
+def test_provision_new_cluster(config_file, clients):
+    clock = FakeClock()
+    probed = []
+
+    def probe(host, port):
+        probed.append((host, port))
+        return len(probed) > 1
+
+    ready = provision(config_file, clients, clock, probe)
+
+    assert ready['endpoint'] == ENDPOINT and ready['port'] == 5439
+    assert ready['role_arn'] == ROLE_ARN and ready['security_group'] == 'sg-1'
+    assert ready['props']['ClusterStatus'] == 'available'
+    created, = clients['redshift'].create_calls
+    assert created['IamRoles'] == [ROLE_ARN] and created['NumberOfNodes'] == 4
+    assert clients['ec2'].rules == {('sg-1', 'tcp', '0.0.0.0/0', 5439, 5439)}
+    assert probed == [(ENDPOINT, 5439)] * 2
+
+    # 2 polls until available, 1 until connectable, with jittered backoff in between
+    assert len(clock.sleeps) == 3
+    assert all(0 <= s <= POLL_MAX_DELAY for s in clock.sleeps)
+    assert set(ready['timings']) == {'ingress', 'role', 'create', 'available', 'connectable', 'total'}
+    assert ready['timings']['total'] == pytest.approx(sum(clock.sleeps), abs=1e-3)
+
+
+def test_provision_is_idempotent(config_file, clients):
+    first = provision(config_file, clients, FakeClock())
+    again = provision(config_file, clients, FakeClock())
+
+    assert len(clients['redshift'].clusters) == 1
+    assert len(clients['redshift'].create_calls) == 2
+    assert clients['ec2'].authorize_calls == 2 and len(clients['ec2'].rules) == 1
+    assert {k: again[k] for k in ('endpoint', 'port', 'role_arn', 'security_group')} == \
+           {k: first[k] for k in ('endpoint', 'port', 'role_arn', 'security_group')}
+    assert again['timings']['available'] == 0
+
+
+def test_provision_raises_other_errors(config_file, clients):
+    def denied(**kwargs):
+        raise client_error('UnauthorizedOperation', 'AuthorizeSecurityGroupIngress')
+    clients['ec2'].authorize_security_group_ingress = denied
+
+    with pytest.raises(ClientError):
+        provision(config_file, clients, FakeClock())
+
+
+def test_provision_times_out(config_file, clients):
+    clients['redshift'].polls = float('inf')
+    clock = FakeClock()
+
+    with pytest.raises(TimeoutError):
+        provision(config_file, clients, clock, timeout=600)
+    assert clock.now <= 600
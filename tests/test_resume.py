@@ -0,0 +1,107 @@
+import os
+import sys
+import json
+import subprocess
+import pytest
+from conftest import DUCKDB_CONFIG, table_rows
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Step of the run -> function of etl.py doing its work
+STEP_FUNCTIONS = {'create': 'create_tables', 'staging': 'load_staging_tables_local',
+                  'validate': 'validate_staging', 'artists': 'insert_artists_table',
+                  'users': 'insert_users_table', 'time': 'insert_time_table',
+                  'songs': 'insert_songs_table', 'songplay': 'insert_songplay_table',
+                  'aggregates': 'refresh_aggregates', 'watermark': 'update_watermark'}
+
+TABLES = {'staging_events': (), 'staging_songs': (), 'songplay': ('songplay_id',), 'users': (),
+          'songs': (), 'artists': (), 'time': (), 'agg_daily_plays': (), 'agg_daily_song_plays': (),
+          'agg_daily_artist_plays': (), 'agg_daily_level_plays': (), 'agg_hourly_plays': ()}
+
+# etl.main in a process of its own; the function of the failing step raises once its work
+# is done, through a decorator so the code fingerprinted for the step stays the same
+RUN = """
+import sys
+import functools
+sys.path.insert(0, {root!r})
+import etl
+
+def fail_after(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        func(*args, **kwargs)
+        raise RuntimeError('injected failure in ' + func.__name__)
+    return wrapper
+
+if {failing!r}:
+    setattr(etl, {failing!r}, fail_after(getattr(etl, {failing!r})))
+etl.main(config_file={config_file!r}, local_data={data!r}, checkpoint_file={checkpoint!r},
+         mode={mode!r}, atomic_stages={atomic_stages!r}, resume={resume!r})
+"""
+
+
+def run_process(config_file, data, checkpoint, failing=None, resume=False, mode='sql', atomic_stages=True):
+    script = RUN.format(root=ROOT, config_file=config_file, data=data, checkpoint=checkpoint,
+                        failing=failing, resume=resume, mode=mode, atomic_stages=atomic_stages)
+    return subprocess.run([sys.executable, '-c', script], capture_output=True, text=True)
+
+
+def database_in(directory):
+    """
+    Returns:
+        path of its config file, path of its database
+    """
+    database = str(directory / 'sparkify.duckdb')
+    config_file = str(directory / 'dwh-test.cfg')
+    with open(config_file, 'w') as f:
+        f.write(DUCKDB_CONFIG.format(database))
+    return config_file, database
+
+
+@pytest.fixture(scope='module')
+def reference(tmp_path_factory, source_data):
+    pytest.importorskip('duckdb')
+    directory = tmp_path_factory.mktemp('reference')
+    config_file, database = database_in(directory)
+    done = run_process(config_file, source_data, str(directory / 'etl_checkpoint.json'))
+    assert done.returncode == 0, done.stderr
+    return database
+
+
+def fail_and_resume(tmp_path, source_data, reference, step, **options):
+    """
+    Description:
+        Fail a run right after the work of step, resume it in a new process and check
+        the completed steps are skipped and the tables match an uninterrupted run.
+    """
+    config_file, database = database_in(tmp_path)
+    checkpoint = str(tmp_path / 'etl_checkpoint.json')
+
+    failed = run_process(config_file, source_data, checkpoint, failing=STEP_FUNCTIONS[step], **options)
+    assert failed.returncode != 0
+    assert 'injected failure' in failed.stderr
+    with open(checkpoint) as f:
+        completed = json.load(f)['steps']
+    assert step not in completed
+
+    resumed = run_process(config_file, source_data, checkpoint, resume=True, **options)
+    assert resumed.returncode == 0, resumed.stderr
+    # the fingerprints of a fresh process match, the completed steps are not run twice
+    for name, recorded in completed.items():
+        assert 'skip  step {} (checkpoint {})'.format(name, recorded['fingerprint']) in resumed.stdout
+
+    for table, exclude in TABLES.items():
+        expected = table_rows(reference, table, exclude)
+        assert expected, table
+        assert table_rows(database, table, exclude) == expected, table
+
+
+@pytest.mark.parametrize('atomic_stages', [True, False], ids=['unit_of_work', 'autocommit'])
+@pytest.mark.parametrize('step', list(STEP_FUNCTIONS))
+def test_resume_after_failure(tmp_path, source_data, reference, step, atomic_stages):
+    fail_and_resume(tmp_path, source_data, reference, step, atomic_stages=atomic_stages)
+
+
+@pytest.mark.parametrize('mode', ['client', 'stream'])
+def test_resume_songplay_client_side(tmp_path, source_data, reference, mode):
+    fail_and_resume(tmp_path, source_data, reference, 'songplay', mode=mode, atomic_stages=False)
@@ -0,0 +1,71 @@
+import random
+import pytest
+from create_tables import connect_DWH_db, run_queries
+from sql_queries import create_staging_table_queries, match_key_queries, song_match_join
+
+# Offsets of an event length from the song duration: inside, on and just outside the
+# +-1 second window of the original predicate
+OFFSETS = [-1.0, -0.999, -0.5, -0.001, 0.0, 0.001, 0.5, 0.999, 1.0, 1.001]
+# Durations on, just below and just above the 1 second bucket boundaries
+DURATIONS = [0.0, 0.001, 0.999, 1.0, 99.0, 99.999, 100.0, 100.001, 100.5, 238.0]
+
+original_pairs = """
+    SELECT se.sessionid, ss.song_id
+        FROM staging_events se
+        JOIN staging_songs ss ON se.song = ss.title
+        WHERE abs(ss.duration - se.length) < 1.0
+"""
+
+match_key_pairs = "SELECT se.sessionid, ss.song_id FROM {}".format(song_match_join)
+
+
+@pytest.fixture
+def staging(duckdb_config):
+    cur, conn = connect_DWH_db(duckdb_config[0])
+    run_queries(cur, conn, create_staging_table_queries)
+    yield cur, conn
+    cur.close()
+    conn.close()
+
+
+def load(cur, songs, events):
+    cur.executemany('INSERT INTO staging_songs (song_id, title, duration) VALUES (%s, %s, %s)', songs)
+    cur.executemany("INSERT INTO staging_events (sessionid, song, length, page) VALUES (%s, %s, %s, 'NextSong')",
+                    events)
+    for q in match_key_queries:
+        cur.execute(q)
+
+
+def pairs(cur, query):
+    cur.execute(query)
+    return sorted(cur.fetchall())
+
+
+def test_boundaries_match_the_original_predicate(staging):
+    cur, _ = staging
+    songs, events = [], []
+    for i, duration in enumerate(DURATIONS):
+        songs.append(('S{:04d}'.format(i), 'title {}'.format(i % 3), duration))
+        for offset in OFFSETS:
+            events.append((len(events), 'title {}'.format(i % 3), round(duration + offset, 3)))
+    load(cur, songs, events)
+
+    expected = pairs(cur, original_pairs)
+    assert expected
+    # one row per pair: a song is keyed into three buckets, an event only into one
+    assert pairs(cur, match_key_pairs) == expected
+
+
+def test_random_lengths_match_the_original_predicate(staging):
+    cur, _ = staging
+    rng = random.Random(7)
+    titles = ['song {}'.format(i) for i in range(20)]
+    songs = [('S{:04d}'.format(i), rng.choice(titles), round(rng.uniform(30, 600), 5)) for i in range(300)]
+    events = []
+    for i in range(3000):
+        song_id, title, duration = rng.choice(songs)
+        length = duration + rng.choice(OFFSETS + [rng.uniform(-1.5, 1.5)])
+        events.append((i, title if rng.random() < 0.9 else 'unknown', round(length, 5)))
+    load(cur, songs, events)
+
+    assert pairs(cur, match_key_pairs) == pairs(cur, original_pairs)
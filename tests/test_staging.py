@@ -0,0 +1,118 @@
+import pytest
+import configparser
+from contextlib import contextmanager
+import psycopg2.extensions
+import etl
+from conftest import FakeS3
+from unit_of_work import unit_of_work
+
+S3_CONFIG = """
+[S3]
+LOG_DATA = 's3://udacity-dend/log_data'
+SONG_DATA = 's3://udacity-dend/song_data'
+LOG_JSONPATH = 's3://udacity-dend/log_json_path.json'
+MANIFEST_PREFIX = 's3://sparkify-etl/manifests'
+
+[IAM_ROLE]
+ARN = 'arn:aws:iam::123456789012:role/dwhRole'
+
+[DWH]
+DWH_NUM_NODES = 2
+DWH_NODE_TYPE = dc2.large
+"""
+
+SOURCE_OBJECTS = dict([('log_data/2018/11/2018-11-{:02d}-events.json'.format(d), 1000 * d) for d in range(1, 31)]
+                      + [('song_data/A/A/{:03d}.json'.format(i), 250) for i in range(40)])
+
+
+class RecordingCursor:
+    """
+    Description:
+        Cursor recording the statements it is given; nothing was loaded before.
+    """
+
+    def __init__(self, conn):
+        self.connection = conn
+        self.rowcount = 0
+
+    def execute(self, query, vars=None):
+        self.connection.statements.append(' '.join(query.split()))
+
+    def execute_values(self, query, values):
+        self.connection.statements.append(' '.join(query.split()))
+        self.rowcount = len(list(values))
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class RecordingConnection:
+
+    def __init__(self):
+        self.autocommit = True
+        self.statements = []
+        self.commits = 0
+
+    def cursor(self):
+        return RecordingCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    s3 = FakeS3(SOURCE_OBJECTS)
+    monkeypatch.setattr(etl, 's3_client', lambda config: s3)
+    return s3
+
+
+@pytest.fixture
+def config(s3):
+    config = configparser.ConfigParser()
+    config.read_string(S3_CONFIG)
+    return config
+
+
+def copies(statements):
+    return [s for s in statements if s.startswith('COPY')]
+
+
+def test_atomic_staging_runs_in_the_stage_transaction(config, s3):
+    conn = RecordingConnection()
+    with unit_of_work(conn) as uow:
+        etl.load_staging_tables_incremental(conn.cursor(), uow, config, connection=None)
+
+    assert conn.commits == 1
+    assert not [s for s in conn.statements if s.startswith('TRUNCATE')]
+    assert len(copies(conn.statements)) == len(s3.puts)
+    assert 'INSERT INTO etl_loaded_files (source, s3_key, loaded_at) VALUES %s' in conn.statements
+    assert 'INSERT INTO etl_staged_files (source, s3_key, staged_at) VALUES %s' in conn.statements
+
+
+def test_autocommit_staging_copies_concurrently(config, s3):
+    conn = RecordingConnection()
+    side = []
+
+    @contextmanager
+    def connection():
+        side.append(RecordingConnection())
+        yield side[-1].cursor(), side[-1]
+
+    etl.load_staging_tables_incremental(conn.cursor(), conn, config, connection=connection)
+
+    assert 'TRUNCATE staging_events' in conn.statements
+    assert copies(conn.statements) == []
+    assert sum(len(copies(c.statements)) for c in side) == len(s3.puts)
+    # every manifest is recorded in the transaction of its COPY
+    assert all(c.commits == 1 for c in side)
+
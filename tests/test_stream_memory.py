@@ -0,0 +1,63 @@
+import tracemalloc
+import pytest
+import etl
+import generate_data
+from conftest import DUCKDB_CONFIG
+from create_tables import connect_DWH_db
+
+SMALL_EVENTS = 10000
+LARGE_EVENTS = 80000
+CHUNK_SIZE = 500
+# Allowed growth of the peak from the small to the 8 times larger source
+PEAK_GROWTH = 1.5
+
+
+def staged_database(tmp_path, events):
+    """
+    Description:
+        DuckDB database loaded from a generated source of events log events.
+
+    Returns:
+        path of its config file
+    """
+    data_dir = tmp_path / 'data_{}'.format(events)
+    generate_data.generate(str(data_dir), events, days=5, seed=3)
+    config_file = str(tmp_path / 'dwh_{}.cfg'.format(events))
+    with open(config_file, 'w') as f:
+        f.write(DUCKDB_CONFIG.format(tmp_path / 'sparkify_{}.duckdb'.format(events)))
+    etl.main(config_file=config_file, local_data=str(data_dir),
+             checkpoint_file=str(tmp_path / 'checkpoint_{}.json'.format(events)))
+    return config_file
+
+
+def stream_peak(config_file):
+    """
+    Description:
+        Reload songplay with the streaming load under tracemalloc.
+
+    Returns:
+        rows loaded, peak bytes allocated by the client while streaming
+    """
+    cur, conn = connect_DWH_db(config_file)
+    try:
+        cur.execute('DELETE FROM songplay')
+        tracemalloc.start()
+        try:
+            etl.insert_songplay_stream(cur, conn, chunk_size=CHUNK_SIZE, batch_size=CHUNK_SIZE)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        cur.execute('SELECT COUNT(*) FROM songplay')
+        return cur.fetchone()[0], peak
+    finally:
+        cur.close()
+        conn.close()
+
+
+def test_stream_memory_does_not_grow_with_rows(tmp_path):
+    pytest.importorskip('duckdb')
+    small_rows, small_peak = stream_peak(staged_database(tmp_path, SMALL_EVENTS))
+    large_rows, large_peak = stream_peak(staged_database(tmp_path, LARGE_EVENTS))
+
+    assert large_rows > 6 * small_rows
+    assert large_peak < PEAK_GROWTH * small_peak, (small_peak, large_peak)
@@ -0,0 +1,50 @@
+import time
+import shutil
+import datetime as dt
+import pytest
+from conftest import table_rows
+from sql_queries import TIME_GRAIN_MS
+
+# songplay_id is an IDENTITY and depends on the insert order, not on the mode
+TABLES = {'songplay': ('songplay_id',), 'users': (), 'songs': (), 'artists': (), 'time': (),
+          'agg_daily_plays': (), 'agg_daily_song_plays': (), 'agg_daily_artist_plays': (),
+          'agg_daily_level_plays': (), 'agg_hourly_plays': ()}
+
+
+@pytest.fixture
+def sql_tables(run_etl, tmp_path):
+    reference = str(tmp_path / 'sql.duckdb')
+    shutil.copy(run_etl(mode='sql'), reference)
+    return reference
+
+
+@pytest.fixture
+def host_timezone(monkeypatch):
+    """
+    Description:
+        Run the test with a host timezone far from UTC.
+    """
+    monkeypatch.setenv('TZ', 'America/Los_Angeles')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.mark.parametrize('mode', ['client', 'stream'])
+def test_modes_produce_identical_tables(run_etl, sql_tables, host_timezone, mode):
+    database = run_etl(mode=mode, full_refresh=True)
+
+    for table, exclude in TABLES.items():
+        expected = table_rows(sql_tables, table, exclude)
+        assert expected, table
+        assert table_rows(database, table, exclude) == expected, table
+
+
+@pytest.mark.parametrize('mode', ['sql', 'client'])
+def test_start_time_is_utc(run_etl, host_timezone, mode):
+    database = run_etl(mode=mode)
+    epoch = dt.datetime(1970, 1, 1)
+    for start_time, time_key in (r[:2] for r in table_rows(database, 'songplay', ('songplay_id',))):
+        ms = (dt.datetime.strptime(start_time, '%Y-%m-%dT%H:%M:%S.%f') - epoch) // dt.timedelta(milliseconds=1)
+        assert ms // TIME_GRAIN_MS == time_key
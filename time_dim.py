@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+
+# Time parts of a timestamp; with time_key first, the column order of time_table_insert in sql_queries.py
+TIME_COLUMNS = ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday']
+CALENDAR_COLUMNS = ['time_key'] + TIME_COLUMNS
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def to_datetime64(ts_values):
+    """
+    Description:
+        Convert epoch-ms timestamps (int, float or Decimal) to a datetime64[ms] array (UTC).
+    """
+    ms = np.asarray(ts_values)
+    if ms.dtype == object:
+        # Decimal values from a numeric column
+        ms = pd.to_numeric(pd.Series(ms), errors='raise').to_numpy()
+    if ms.dtype.kind == 'f':
+        ms = np.rint(ms)
+    return ms.astype('int64').astype('datetime64[ms]')
+
+
+def start_times(ts_values):
+    """
+    Description:
+        Vectorized epoch-ms to start_time text (ISO 8601 with microseconds, UTC).
+    """
+    return np.datetime_as_string(to_datetime64(ts_values).astype('datetime64[us]'), unit='us')
+
+
+def time_parts(ts_values):
+    """
+    Description:
+        Vectorized conversion of epoch-ms timestamps into the time dimension columns.
+        All values are derived in UTC in one pass over the whole array, so the result
+        does not depend on the host timezone and matches the SQL transform.
+
+    Arguments:
+        ts_values - array-like of epoch timestamps in milliseconds (int, float or Decimal)
+
+    Returns:
+        DataFrame with columns start_time, hour, day, week, month, year, weekday
+        start_time is ISO 8601 text with microseconds, weekday is 0 for Monday
+    """
+    dts = pd.DatetimeIndex(to_datetime64(ts_values))
+
+    return pd.DataFrame({
+        'start_time': np.datetime_as_string(dts.values.astype('datetime64[us]'), unit='us'),
+        'hour':       dts.hour.to_numpy(),
+        'day':        dts.day.to_numpy(),
+        'week':       dts.isocalendar().week.to_numpy(dtype='int64'),
+        'month':      dts.month.to_numpy(),
+        'year':       dts.year.to_numpy(),
+        'weekday':    dts.weekday.to_numpy(),
+    }, columns=TIME_COLUMNS)
+
+
+
+def time_keys(ts_values, grain_ms):
+    """
+    Description:
+        Vectorized epoch-ms to time_key, the number of the grain_ms period since the epoch.
+    """
+    return to_datetime64(ts_values).astype('int64') // grain_ms
+
+
+def calendar_range(min_ts, max_ts, grain_ms):
+    """
+    Description:
+        First and last time_key of the whole UTC days from min_ts to max_ts.
+    """
+    first_day, last_day = (int(v) for v in time_keys([min_ts, max_ts], DAY_MS))
+    return first_day * DAY_MS // grain_ms, (last_day + 1) * DAY_MS // grain_ms - 1
+
+
+def missing_ranges(needed, covered):
+    """
+    Description:
+        Key ranges of needed that a contiguous calendar covering covered lacks.
+        The calendar is only ever extended at either end, so it stays contiguous.
+
+    Arguments:
+        needed - (first, last) time_key of the data
+        covered - (first, last) time_key already in the time table, (None, None) when empty
+
+    Returns:
+        list of (first, last) ranges to generate
+    """
+    first, last = needed
+    low, high = covered
+    if low is None:
+        return [(first, last)]
+    ranges = []
+    if first < low:
+        ranges.append((first, low - 1))
+    if last > high:
+        ranges.append((high + 1, last))
+    return ranges
+
+
+def calendar(first_key, last_key, grain_ms):
+    """
+    Description:
+        Calendar time dimension rows for the periods first_key..last_key at grain_ms.
+        start_time is the start of each period.
+
+    Returns:
+        DataFrame with columns time_key, start_time, hour, day, week, month, year, weekday
+    """
+    keys = np.arange(first_key, last_key + 1, dtype='int64')
+    parts = time_parts(keys * grain_ms)
+    parts.insert(0, 'time_key', keys)
+    return parts
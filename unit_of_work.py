@@ -0,0 +1,124 @@
+import functools
+from contextlib import contextmanager
+import psycopg2.extensions
+
+
+class UnitOfWorkError(Exception):
+    """
+    Description:
+        Raised when a statement of a unit of work failed; nothing of it was committed.
+    """
+
+
+class UnitOfWork:
+    """
+    Description:
+        Connection proxy handed to a stage running as one transaction.  commit() is
+        deferred to the end of the unit and autocommit stays off, so the stage functions,
+        written for autocommit connections, need no change.  rollback() discards the
+        whole unit.  Everything else is delegated to the connection.
+
+    Arguments:
+        conn - psycopg2 connection with autocommit off
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.failed = None
+        self.deferred_commits = 0
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    @property
+    def autocommit(self):
+        return False
+
+    @autocommit.setter
+    def autocommit(self, value):
+        pass
+
+    def commit(self):
+        self.deferred_commits += 1
+
+    def rollback(self):
+        self.conn.rollback()
+        self.failed = self.failed or 'rolled back by the stage'
+
+
+@contextmanager
+def unit_of_work(conn):
+    """
+    Description:
+        Run a block as one transaction: commit at the end, roll everything back when it
+        raises or when any statement in it failed, even if the error was caught.  A nested
+        unit_of_work joins the enclosing one.
+
+    Arguments:
+        conn - connection to the target database, or a UnitOfWork
+
+    Yields:
+        UnitOfWork proxy of conn
+
+    Raises:
+        UnitOfWorkError when a caught error left the transaction failed
+    """
+    if isinstance(conn, UnitOfWork):
+        yield conn
+        return
+
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    uow = UnitOfWork(conn)
+    try:
+        yield uow
+        if uow.failed is None and conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            uow.failed = 'a statement failed'
+        if uow.failed is not None:
+            raise UnitOfWorkError('Unit of work rolled back: {}'.format(uow.failed))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = autocommit
+
+
+def atomic(func):
+    """
+    Description:
+        Wrap a stage function taking (cur, conn, ...) so it runs as one unit of work.
+    """
+    @functools.wraps(func)
+    def wrapper(cur, conn, *args, **kwargs):
+        with unit_of_work(conn) as uow:
+            return func(cur, uow, *args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def savepoint(cur, name):
+    """
+    Description:
+        Run a block under SAVEPOINT name.  On an error the block is rolled back to the
+        savepoint and the error re-raised, the enclosing transaction stays usable.
+    """
+    cur.execute('SAVEPOINT {}'.format(name))
+    try:
+        yield
+    except BaseException:
+        cur.execute('ROLLBACK TO SAVEPOINT {}'.format(name))
+        cur.execute('RELEASE SAVEPOINT {}'.format(name))
+        raise
+    cur.execute('RELEASE SAVEPOINT {}'.format(name))
+
+
+def supports_savepoints(cur):
+    """
+    Description:
+        Redshift runs transactions but has no SAVEPOINT; PostgreSQL has both, DuckDB
+        has no SAVEPOINT either.
+    """
+    cur.execute('SELECT version()')
+    version = cur.fetchone()[0].lower()
+    return 'postgresql' in version and 'redshift' not in version